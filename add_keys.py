@@ -31,9 +31,12 @@ def main():
     file_lines_set.update(new_lines)
     new_size = len(file_lines_set)
 
-    with open(filename, 'w') as f:
+    # Written to a temporary file first, so that the bot never reads a half-written list
+    temporary_filename = filename + '.tmp'
+    with open(temporary_filename, 'w') as f:
         for line in file_lines_set:
             f.write(line + '\n')
+    os.replace(temporary_filename, filename)
 
     print(f'Old size: {old_size}')
     print(f'New size: {new_size} ( +{new_size - old_size} )')
@@ -1,4 +1,5 @@
 import traceback
+from typing import Awaitable, Callable
 
 from aiogram.types import Message
 from loguru import logger
@@ -8,9 +9,10 @@ import api.openai
 import db
 
 
-async def generate_response(message: Message, endpoint: str) -> str:
+async def generate_response(message: Message, endpoint: str,
+                            on_partial: Callable[[str], Awaitable[None]] = None) -> str:
     if endpoint == "google":
-        return await api.google.generate_response(message)
+        return await api.google.generate_response(message, on_partial)
     elif endpoint == "openai":
         try:
             out = await api.openai.generate_response(message)
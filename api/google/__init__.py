@@ -1,2 +1,3 @@
 from .google import count_tokens_for_chat, ERROR_MESSAGES, generate_response, get_available_models
 from .prompts import format_message_for_prompt
+from .token_ledger import can_recount, get_token_count
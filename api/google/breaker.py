@@ -0,0 +1,124 @@
+import os
+import time
+from collections import defaultdict, deque
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+FAILURE_THRESHOLD = int(os.getenv("GEMINI_BREAKER_FAILURES", 5))
+FAILURE_WINDOW = float(os.getenv("GEMINI_BREAKER_WINDOW", 60))  # in seconds
+OPEN_DURATION = float(os.getenv("GEMINI_BREAKER_COOLDOWN", 30))  # in seconds
+FALLBACK_CHAIN = [model.strip() for model in os.getenv(
+    "GEMINI_FALLBACK_MODELS", "gemini-2.0-flash-exp, gemini-1.5-flash, gemini-1.5-pro"
+).split(",") if model.strip()]
+
+# Failure reasons (see retry.py) that say something about the model rather than the key or the prompt
+MODEL_FAILURES = ["UNAVAILABLE", "INTERNAL", "DEADLINE_EXCEEDED", "HTTP_5XX", "TIMEOUT", "MODEL_NOT_FOUND"]
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Opens after FAILURE_THRESHOLD model failures within FAILURE_WINDOW seconds.
+    After OPEN_DURATION seconds a single probe request is let through:
+    if it succeeds, the breaker closes, otherwise it opens again.
+    """
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = deque()
+        self.opened_at = 0.0
+        self.probe_started_at: Optional[float] = None
+
+    def allow_request(self) -> bool:
+        now = time.time()
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if now - self.opened_at < OPEN_DURATION:
+                return False
+            self.state = HALF_OPEN
+            self.probe_started_at = None
+
+        # Half-open: let one probe through at a time, in case the previous one was never reported
+        if self.probe_started_at is None or now - self.probe_started_at >= OPEN_DURATION:
+            self.probe_started_at = now
+            return True
+        return False
+
+    def is_open(self) -> bool:
+        return self.state == OPEN and time.time() - self.opened_at < OPEN_DURATION
+
+    def record_success(self) -> bool:
+        """Returns True if this closed the breaker"""
+        if self.state == CLOSED:
+            return False
+        self.state = CLOSED
+        self.failures.clear()
+        self.probe_started_at = None
+        return True
+
+    def record_failure(self) -> bool:
+        """Returns True if this opened the breaker"""
+        now = time.time()
+        self.failures.append(now)
+        while self.failures and now - self.failures[0] > FAILURE_WINDOW:
+            self.failures.popleft()
+
+        if self.state == HALF_OPEN or (self.state == CLOSED and len(self.failures) >= FAILURE_THRESHOLD):
+            self.state = OPEN
+            self.opened_at = now
+            self.probe_started_at = None
+            return True
+        return False
+
+
+breakers: Dict[str, CircuitBreaker] = defaultdict(CircuitBreaker)
+
+
+def _fallbacks_for(model: str) -> List[str]:
+    if model in FALLBACK_CHAIN:
+        return FALLBACK_CHAIN[FALLBACK_CHAIN.index(model) + 1:]
+    return FALLBACK_CHAIN
+
+
+def route(model: str) -> str:
+    """Returns the model a request for `model` should go to, following the fallback chain while breakers are open"""
+    if breakers[model].allow_request():
+        return model
+    for fallback in _fallbacks_for(model):
+        if fallback != model and breakers[fallback].allow_request():
+            return fallback
+    return model  # Everything is down, so the original model is as good as any
+
+
+def get_fallback(model: str) -> Optional[str]:
+    """Returns the next model in the chain that is not known to be down"""
+    for fallback in _fallbacks_for(model):
+        if fallback != model and breakers[fallback].allow_request():
+            return fallback
+    return None
+
+
+def report(model: str, reason: Optional[str]) -> None:
+    """Feeds the outcome of an attempt (a retry.py failure reason, or None for success) to the model's breaker"""
+    if reason is None:
+        if breakers[model].record_success():
+            logger.success(f"GOOGLE | Circuit breaker for {model} closed")
+    elif reason in MODEL_FAILURES:
+        if breakers[model].record_failure():
+            logger.warning(f"GOOGLE | Circuit breaker for {model} opened")
+
+
+def get_breaker_states() -> Dict[str, dict]:
+    now = time.time()
+    return {
+        model: {
+            "state": breaker.state,
+            "recent_failures": sum(1 for failure in breaker.failures if now - failure <= FAILURE_WINDOW),
+        }
+        for model, breaker in breakers.items()
+    }
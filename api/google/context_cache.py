@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from asyncpg import Record
+from loguru import logger
+
+import db
+from .sessions import API_BASE_URL, session_manager
+
+CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", 600))  # in seconds
+MIN_CACHE_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", 32768))
+# How far past message_limit the history may grow before the cache is rebuilt from a fresh window
+HISTORY_SLACK = float(os.getenv("GEMINI_CONTEXT_CACHE_SLACK", 0.25))
+
+TAIL_BLOCKS = 2  # The newest blocks change all the time, so they are never cached
+FAILURE_COOLDOWN = 3600
+
+
+@dataclass
+class CachedPrefix:
+    name: str
+    key: str
+    model: str
+    first_umid: int
+    block_count: int
+    prefix_hash: str
+    expires_at: float
+
+
+_entries: Dict[int, CachedPrefix] = {}
+_failures: Dict[Tuple[int, str], float] = {}  # (chat_id, model): timestamp of the last failed creation
+_locks = defaultdict(asyncio.Lock)
+
+
+def _hash_prefix(model: str, system_prompt: Optional[dict], blocks: List[Dict]) -> str:
+    serialized = json.dumps([model, system_prompt, blocks], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def _estimate_tokens(blocks: List[Dict], system_prompt: Optional[dict]) -> int:
+    # ~4 characters per token is good enough to tell whether the cache minimum can be reached
+    return len(json.dumps([system_prompt, blocks], ensure_ascii=False)) // 4
+
+
+async def _request(method: str, path: str, key: str, body: dict = None) -> Tuple[int, dict]:
+    async with session_manager.get_session().request(
+            method,
+            f"{API_BASE_URL}/v1beta/{path}",
+            headers={"Content-Type": "application/json", "x-goog-api-key": key},
+            json=body
+    ) as response:
+        try:
+            decoded_response = await response.json()
+        except Exception:
+            decoded_response = {}
+        return response.status, decoded_response
+
+
+async def _delete_remote(entry: CachedPrefix) -> None:
+    try:
+        status, _ = await _request("DELETE", entry.name, entry.key)
+        if status != 200:
+            logger.debug(f"Context cache {entry.name} was not deleted: HTTP {status}")
+    except Exception as e:
+        logger.debug(f"Failed to delete context cache {entry.name}: {e}")
+
+
+def _drop(chat_id: int) -> None:
+    entry = _entries.pop(chat_id, None)
+    if entry and entry.expires_at > time.time():
+        asyncio.create_task(_delete_remote(entry))
+
+
+def invalidate(chat_id: int) -> None:
+    """Forgets the cached history prefix of a chat. Call this whenever the history is altered."""
+    if chat_id in _entries:
+        logger.debug(f"{chat_id} | Context cache invalidated")
+    _drop(chat_id)
+
+
+def get_bound_key(chat_id: int) -> Optional[str]:
+    """Returns the key whose project holds the chat's cache, if there is a live one"""
+    entry = _entries.get(chat_id)
+    if entry and entry.expires_at > time.time():
+        return entry.key
+    return None
+
+
+async def extend_history(chat_id: int, chat_messages: List[Record]) -> List[Record]:
+    """
+    Once the message window starts sliding, the oldest messages fall out of it and the cached prefix
+    no longer matches. To keep the cache usable, the history keeps starting from the first cached message
+    until it grows HISTORY_SLACK past message_limit, at which point the cache gets rebuilt.
+    """
+    entry = _entries.get(chat_id)
+    if not entry or not chat_messages or entry.expires_at <= time.time():
+        return chat_messages
+    if any(message["umid"] == entry.first_umid for message in chat_messages):
+        return chat_messages
+
+    message_limit = await db.get_chat_parameter(chat_id, "message_limit")
+    extended = await db.get_messages(chat_id, int(message_limit * (1 + HISTORY_SLACK)))
+    for index, message in enumerate(extended):
+        if message["umid"] == entry.first_umid:
+            return extended[index:]
+    return chat_messages
+
+
+async def _create(request_id: int, chat_id: int, key: str, model: str, system_prompt: Optional[dict],
+                  blocks: List[Dict], first_umid: int) -> Optional[CachedPrefix]:
+    body = {
+        "model": f"models/{model}",
+        "contents": blocks,
+        "ttl": f"{CACHE_TTL}s"
+    }
+    if system_prompt:
+        body["systemInstruction"] = system_prompt
+
+    status, decoded_response = await _request("POST", "cachedContents", key, body)
+    if status != 200 or "name" not in decoded_response:
+        logger.warning(f"{request_id} | Failed to create a context cache: "
+                       f"{decoded_response.get('error', {}).get('message', status)}")
+        _failures[(chat_id, model)] = time.time()
+        return None
+
+    cached_tokens = decoded_response.get("usageMetadata", {}).get("totalTokenCount", "?")
+    logger.info(f"{request_id} | Created context cache {decoded_response['name']} ({cached_tokens} tokens)")
+    return CachedPrefix(
+        name=decoded_response["name"],
+        key=key,
+        model=model,
+        first_umid=first_umid,
+        block_count=len(blocks),
+        prefix_hash=_hash_prefix(model, system_prompt, blocks),
+        expires_at=time.time() + CACHE_TTL
+    )
+
+
+async def _extend_ttl(entry: CachedPrefix) -> None:
+    if entry.expires_at - time.time() > CACHE_TTL / 2:
+        return
+    status, _ = await _request("PATCH", f"{entry.name}?updateMask=ttl", entry.key, {"ttl": f"{CACHE_TTL}s"})
+    if status == 200:
+        entry.expires_at = time.time() + CACHE_TTL
+
+
+async def apply(request_id: int, chat_id: int, key: str, model: str, system_prompt: Optional[dict],
+                contents: List[Dict], first_umid: int, data: dict) -> bool:
+    """
+    Makes `data` reference a cachedContents entry holding the stable part of the history
+    (system instruction and all but the newest blocks), creating or rebuilding it if necessary.
+    Returns True if the request now uses the cache.
+    """
+    if len(contents) <= TAIL_BLOCKS:
+        return False
+
+    async with _locks[chat_id]:
+        entry = _entries.get(chat_id)
+        if entry and (entry.expires_at <= time.time() or entry.model != model):
+            _drop(chat_id)
+            entry = None
+
+        if entry and len(contents) > entry.block_count and \
+                _hash_prefix(model, system_prompt, contents[:entry.block_count]) == entry.prefix_hash:
+            if entry.key != key:
+                return False  # Caches are bound to the project that created them
+            try:
+                await _extend_ttl(entry)
+            except Exception as e:
+                logger.debug(f"{request_id} | Failed to extend context cache TTL: {e}")
+        else:
+            if entry:
+                logger.debug(f"{request_id} | History prefix changed, rebuilding the context cache")
+                _drop(chat_id)
+
+            prefix = contents[:-TAIL_BLOCKS]
+            if _estimate_tokens(prefix, system_prompt) < MIN_CACHE_TOKENS:
+                return False
+            if time.time() - _failures.get((chat_id, model), 0) < FAILURE_COOLDOWN:
+                return False
+
+            try:
+                entry = await _create(request_id, chat_id, key, model, system_prompt, prefix, first_umid)
+            except Exception as e:
+                logger.warning(f"{request_id} | Failed to create a context cache: {e}")
+                _failures[(chat_id, model)] = time.time()
+                entry = None
+            if not entry:
+                return False
+            _entries[chat_id] = entry
+
+    data["cachedContent"] = entry.name
+    data["contents"] = contents[entry.block_count:]
+    data.pop("system_instruction", None)
+    return True
@@ -1,13 +1,14 @@
+import asyncio
+import json
 import os
 import random
 import time
 import traceback
-from typing import List
+from typing import List, Optional, Tuple, Union
 
 import aiohttp
 from aiogram.types import Message
 from aiohttp import ContentTypeError
-from aiohttp_socks import ProxyConnector
 from async_lru import alru_cache
 from asyncpg import Record
 from loguru import logger
@@ -15,13 +16,26 @@ from loguru import logger
 import db
 from api.prompt import get_system_prompt
 from utils import simulate_typing
+from . import breaker, context_cache, token_ledger
+from .hedging import HEDGING_ENABLED, latency_tracker, send_hedged
+from .key_state import create_state_backend
 from .keys import ApiKeyManager, OutOfBillingKeysException, OutOfKeysException
-from .prompts import _prepare_prompt, get_system_messages
+from .media import get_preloaded_key, upload_other_media, wait_for_ingestion
+from .payload import compile_request
+from .prober import KeyProber
+from .prompts import _attach_file, _prepare_prompt, get_system_messages
+from .retry import RetryAction, RetryState, classify_exception, classify_response, get_exhaustion_cooldown
+from .sessions import API_BASE_URL, session_manager
+from .streaming import PartialCallback, read_stream
+from .usage_ledger import UsageLedger
 
 bot_id = int(os.getenv("TELEGRAM_TOKEN").split(":")[0])
 
 keys_path = os.path.join(os.getenv("DATA_PATH"), "gemini_api_keys.txt")
-key_manager = ApiKeyManager(keys_path)
+key_state_path = os.path.join(os.getenv("DATA_PATH"), "gemini_key_state.json")
+key_manager = ApiKeyManager(keys_path, state_file_path=key_state_path, state_backend=create_state_backend(),
+                            usage_ledger=UsageLedger())
+key_prober = KeyProber(key_manager)
 
 admin_ids_str = os.getenv("ADMIN_IDS", "")
 admin_ids = [int(x.strip()) for x in admin_ids_str.split(",") if x.strip()]
@@ -44,134 +58,202 @@ async def _get_api_key(billing_only=False) -> str:
 
 async def _call_gemini_api(request_id: int, trigger_message: Message, messages: List[Record], system_prompt: dict,
                            model_name: str, temperature: float, top_p: float, top_k: int, max_output_tokens: int,
-                           code_execution: bool, safety_threshold: str, grounding: bool, grounding_threshold: float):
-    if os.getenv("GROUNDING_PROXY_URL") and grounding:
-        connector = ProxyConnector.from_url(os.getenv("GROUNDING_PROXY_URL"))
-    elif os.getenv("PROXY_URL"):
-        connector = ProxyConnector.from_url(os.getenv("PROXY_URL"))
-    else:
-        connector = None
-
-    async with aiohttp.ClientSession(connector=connector) as session:
-
-        MAX_API_ATTEMPTS = int(os.getenv("MAX_KEY_ROTATION_ATTEMPTS"))
-
-        censor_evade_attempts = 0
-        bad_key_attempts = 0
-        generating = True
-        while generating:
-            try:
-                key = await key_manager.get_api_key(billing_only=grounding)
-            except OutOfBillingKeysException:
-                logger.error(f"{request_id} | No billing API keys available.")
-                return {"error": {"status": "NO_BILLING", "message": "No billing API keys available."}}
-            except OutOfKeysException:
-                logger.error(f"{request_id} | No active API keys available.")
-                return {"error": {"status": "RESOURCE_EXHAUSTED", "message": "No active API keys available."}}
-
-            prompt = await _prepare_prompt(trigger_message, messages, key)
-
-            safety_settings = []
-            for safety_setting in ["HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_HATE_SPEECH",
-                                   "HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_DANGEROUS_CONTENT",
-                                   "HARM_CATEGORY_CIVIC_INTEGRITY"]:
-                safety_settings.append({
-                    "category": safety_setting,
-                    "threshold": "BLOCK_" + safety_threshold.upper()
-                })
-
-            data = {
-                "contents": prompt,
-                "safetySettings": safety_settings,
-                "generationConfig": {
-                    "temperature": temperature,
-                    "topP": top_p,
-                    "topK": top_k,
-                    "maxOutputTokens": max_output_tokens,
-                }
-            }
-            if system_prompt:
-                data["system_instruction"] = system_prompt
-
-            if code_execution:
-                # noinspection PyTypedDict
-                data["tools"] = [{'code_execution': {}}]
-
-            if grounding:
-                if "2.0" in model_name:
-                    # noinspection PyTypedDict
-                    data["tools"] = [{
-                        "googleSearch": {}
-                    }]
-                else:
-                    data["tools"] = [{
-                        "googleSearchRetrieval": {
-                            "dynamic_retrieval_config": {
-                                "mode": "MODE_DYNAMIC",
-                                "dynamic_threshold": grounding_threshold,
-                            }
-                        }
-                    }]
-
+                           code_execution: bool, safety_threshold: str, grounding: bool, grounding_threshold: float,
+                           context_caching: bool = False, on_partial: PartialCallback = None):
+    session = session_manager.get_session(grounding)
+
+    # Cached contents can't be combined with tools in the same request
+    context_caching = context_caching and not code_execution and not grounding
+
+    routed_model_name = breaker.route(model_name)
+    if routed_model_name != model_name:
+        logger.warning(f"{request_id} | {model_name} is unavailable, using {routed_model_name} instead")
+        model_name = routed_model_name
+
+    compiled = await compile_request(trigger_message, messages, system_prompt, model_name, temperature, top_p, top_k,
+                                     max_output_tokens, code_execution, safety_threshold, grounding,
+                                     grounding_threshold)
+    retry_state = RetryState()
+    avoided_groups = set()  # Projects whose keys have already failed this request
+
+    routing = {"billing_only": grounding, "tier": await get_routing_tier(trigger_message),
+               "with_file": bool(compiled.file_id)}
+
+    # A file uploaded in the background is reused if the first attempt goes to the key it was uploaded on
+    preferred_key = None
+    if compiled.file_id:
+        await wait_for_ingestion(compiled.file_id)
+        preferred_key = get_preloaded_key(compiled.file_id)
+
+    while True:
+        try:
+            key = context_cache.get_bound_key(trigger_message.chat.id) if context_caching else None
+            if not key and preferred_key:
+                key, preferred_key = preferred_key, None
+            if key and key_manager.is_key_available(key, model=model_name, **routing):
+                key_manager.record_request(key, model_name)
+            else:
+                key = await key_manager.get_api_key(model=model_name, avoid_groups=avoided_groups, **routing)
+        except OutOfBillingKeysException:
+            logger.error(f"{request_id} | No billing API keys available.")
+            return {"error": {"status": "NO_BILLING", "message": "No billing API keys available."}}, model_name
+        except OutOfKeysException:
+            logger.error(f"{request_id} | No active API keys available.")
+            return {"error": {"status": "RESOURCE_EXHAUSTED", "message": "No active API keys available."}}, model_name
+
+        body = None
+        using_context_cache = False
+        if context_caching:
+            data = dict(await compiled.get_data(key))
+            using_context_cache = await context_cache.apply(request_id, trigger_message.chat.id, key, model_name,
+                                                            system_prompt, data["contents"], messages[0]["umid"], data)
+            if using_context_cache:
+                body = json.dumps(data).encode("utf-8")
+        if body is None:
+            body = await compiled.get_body(key)
+
+        # Thinking models send their reasoning as an unmarked first part, which a merged stream can't tell apart
+        streaming = on_partial is not None and "thinking" not in model_name
+        method = "streamGenerateContent?alt=sse" if streaming else "generateContent"
+        url = f"{API_BASE_URL}/v1beta/models/{model_name}:{method}"
+        # Compiling, uploading and caching may have used up the deadline, and a zero timeout means none at all
+        time_left = retry_state.time_left()
+        if time_left <= 0:
+            logger.warning(f"{request_id} | The deadline passed before the request could be sent")
+            return {"error": {"status": "DEADLINE_EXCEEDED", "message": "Request deadline exceeded."}}, model_name
+        timeout = aiohttp.ClientTimeout(total=time_left)
+
+        async def send(attempt_key: str) -> Tuple[int, dict]:
             headers = {
                 "Content-Type": "application/json",
-                "x-goog-api-key": key
+                "x-goog-api-key": attempt_key
             }
+            attempt_body = body if attempt_key == key else await compiled.get_body(attempt_key)
 
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
-            logger.info(f"{request_id} | Generating: key ...{key[-6:]}, model {model_name}")
-            async with session.post(url, headers=headers, json=data) as response:
+            logger.info(f"{request_id} | Generating: key ...{attempt_key[-6:]}, model {model_name}")
+            async with session.post(url, headers=headers, data=attempt_body, timeout=timeout) as response:
                 try:
-                    decoded_response = await response.json()
+                    if streaming and response.status == 200:
+                        return response.status, await read_stream(request_id, response, on_partial)
+                    return response.status, await response.json()
                 except ContentTypeError:
                     logger.error(f"{request_id} Response is not JSON, but {response.content_type}")
                     logger.debug(await response.text())
-                    return {'error': {'status': 'INTERNAL', 'message': 'Response is not JSON.'}}
-
-                if response.status != 200:
-                    error = decoded_response.get('error', {})
-                    status_code = error.get('status', '')
-                    if status_code:
-                        logger.error(f"{request_id} | Got an error: {status_code} | Key: ...{key[-6:]}")
-                        if status_code == "RESOURCE_EXHAUSTED":
-                            logger.warning(f"{request_id} | Key {key[-6:]} is exhausted")
-                            key_manager.timeout_key(key, grounding)
-
-                            bad_key_attempts += 1
-                            if bad_key_attempts <= MAX_API_ATTEMPTS:
-                                continue
-                        elif status_code == "INVALID_ARGUMENT":
-                            retry = False
-                            for detail in error.get('details', []):
-                                reason = detail.get('reason', '')
-                                if reason == 'API_KEY_INVALID':
-                                    key_manager.remove_key_permanently(key, grounding)
-
-                                    bad_key_attempts += 1
-                                    if bad_key_attempts <= MAX_API_ATTEMPTS:
-                                        retry = True
-                            if retry:
-                                continue
-                        else:
-                            logger.debug(f"{request_id} | {error}")
-                    else:
-                        logger.error(f"Unknown error: {decoded_response}")
-
-                if decoded_response.get("promptFeedback", {}).get("blockReason", "") in ["OTHER", "PROHIBITED_CONTENT"]:
-                    logger.warning(f"{request_id} | Got censored for no apparent reason")
-
-                    censor_evade_attempts += 1
-                    if censor_evade_attempts <= 3:
-                        continue
-
-                return decoded_response
+                    return response.status, {'error': {'status': 'INTERNAL', 'message': 'Response is not JSON.'}}
+
+        attempt_start_time = time.perf_counter()
+        try:
+            if HEDGING_ENABLED and not streaming and not using_context_cache:
+                key, (status, decoded_response) = await send_hedged(
+                    request_id, model_name, key, send,
+                    lambda: key_manager.get_api_key(model=model_name, avoid_groups={key_manager.get_key_group(key)},
+                                                    **routing),
+                    lambda attempt_key, outcome, latency: _report_discarded_attempt(
+                        request_id, attempt_key, grounding, model_name, outcome, latency
+                    )
+                )
+            else:
+                status, decoded_response = await send(key)
+        except Exception as e:
+            reason = classify_exception(e)
+            if reason is None:
+                raise
+            key_manager.record_result(key, time.perf_counter() - attempt_start_time, reason, model_name)
+            status = 0
+            decoded_response = {"error": {
+                "status": "DEADLINE_EXCEEDED" if reason == "TIMEOUT" else "UNAVAILABLE",
+                "message": f"{type(e).__name__}: {e}"
+            }}
+        else:
+            reason = classify_response(status, decoded_response, using_context_cache)
+            key_manager.record_result(key, time.perf_counter() - attempt_start_time, reason, model_name)
+            if status == 200:
+                latency_tracker.record(model_name, time.perf_counter() - attempt_start_time)
+                key_manager.record_usage(key, model_name,
+                                         decoded_response.get("usageMetadata", {}).get("totalTokenCount", 0))
+
+        breaker.report(model_name, reason)
+        if reason is None:
+            return decoded_response, model_name
+
+        error = decoded_response.get('error', {})
+        logger.error(f"{request_id} | Got an error: {reason} | Key: ...{key[-6:]}")
+        if error:
+            logger.debug(f"{request_id} | {error}")
+
+        if reason == "RESOURCE_EXHAUSTED":
+            logger.warning(f"{request_id} | Key {key[-6:]} is exhausted for {model_name}")
+            key_manager.timeout_key(key, grounding, model_name, get_exhaustion_cooldown(error))
+        elif reason == "API_KEY_INVALID":
+            key_manager.remove_key_permanently(key, grounding)
+        elif reason == "CACHE_REJECTED":
+            logger.warning(f"{request_id} | Context cache was rejected, retrying without it")
+            context_cache.invalidate(trigger_message.chat.id)
+            context_caching = False
+
+        decision = retry_state.decide(reason, error)
+        if decision.action == RetryAction.ROTATE_KEY and key_manager.get_key_group(key):
+            avoided_groups.add(key_manager.get_key_group(key))
+        if decision.action == RetryAction.FAIL:
+            logger.warning(f"{request_id} | Giving up after {reason}")
+            return decoded_response, model_name
+
+        # No point in waiting for a model whose breaker has just opened
+        if decision.action == RetryAction.SWITCH_MODEL or \
+                (decision.action == RetryAction.BACKOFF and breaker.breakers[model_name].is_open()):
+            fallback_model_name = breaker.get_fallback(model_name)
+            if fallback_model_name:
+                logger.warning(f"{request_id} | Switching from {model_name} to {fallback_model_name}")
+                model_name = fallback_model_name
+                compiled = compiled.for_model(model_name)
+                continue
+            if decision.action == RetryAction.SWITCH_MODEL:
+                return decoded_response, model_name
+
+        if decision.delay:
+            logger.info(f"{request_id} | Retrying in {round(decision.delay, 2)}s after {reason}")
+            await asyncio.sleep(decision.delay)
+
+
+async def get_routing_tier(message: Message) -> Optional[str]:
+    """The reserved key pool requests for the message go to first, see ApiKeyManager._route"""
+    if message.from_user.id in admin_ids:
+        return "admin"
+    if await db.get_chat_parameter(message.chat.id, "priority"):
+        return "priority"
+    return None
+
+
+def _report_discarded_attempt(request_id: int, key: str, grounding: bool, model_name: str,
+                              outcome: Union[Tuple[int, dict], BaseException], latency: float) -> None:
+    """Holds a key to account for a hedged attempt whose result wasn't used"""
+    if isinstance(outcome, BaseException):
+        reason = classify_exception(outcome)
+        error = {}
+        if reason is None:
+            logger.debug(f"{request_id} | Discarded attempt on key ...{key[-6:]} failed: {outcome}")
+            return
+    else:
+        status, decoded_response = outcome
+        reason = classify_response(status, decoded_response)
+        error = decoded_response.get("error", {})
+
+    key_manager.record_result(key, latency, reason, model_name)
+    if reason is None:
+        return
+    logger.warning(f"{request_id} | Discarded attempt on key ...{key[-6:]} failed: {reason}")
+    if reason == "RESOURCE_EXHAUSTED":
+        key_manager.timeout_key(key, grounding, model_name, get_exhaustion_cooldown(error))
+    elif reason == "API_KEY_INVALID":
+        key_manager.remove_key_permanently(key, grounding)
 
 
 async def _handle_api_response(
         request_id: int,
         response: dict,
         message: Message,
-        show_error_message: bool
+        show_error_message: bool,
+        model_name: str
 ) -> str:
     censordict = {
         "HARM_CATEGORY_SEXUALLY_EXPLICIT": "Сексуальный контент",
@@ -187,7 +269,8 @@ async def _handle_api_response(
         "INTERNAL": "Произошел сбой на стороне Google. Пожалуйста, попробуйте через пару минут.",
         "UNAVAILABLE": "Выбранная модель недоступна на стороне Gemini API. Возможно, сервера Google перегружены.",
         "NO_BILLING": "Ресурс веб-поиска закончился. Пожалуйста, попробуйте через несколько часов.",
-        "INVALID_ARGUMENT": "В API был отправлен неверный параметр."
+        "INVALID_ARGUMENT": "В API был отправлен неверный параметр.",
+        "DEADLINE_EXCEEDED": "Gemini API не успел ответить. Пожалуйста, попробуйте через пару минут."
     }
 
     try:
@@ -230,8 +313,11 @@ async def _handle_api_response(
                 prompt_tokens = usage.get('promptTokenCount', 0)
                 completion_tokens = usage.get('candidatesTokenCount', 0)
 
+                cached_tokens = usage.get('cachedContentTokenCount', 0)
+
                 logger.debug(
-                    f"{request_id} | Tokens: {total_tokens} total ({prompt_tokens} prompt, {completion_tokens} completion)")
+                    f"{request_id} | Tokens: {total_tokens} total ({prompt_tokens} prompt, {completion_tokens} completion"
+                    f"{f', {cached_tokens} cached' if cached_tokens else ''})")
 
                 await db.statistics.log_generation(
                     message.chat.id,
@@ -239,7 +325,7 @@ async def _handle_api_response(
                     "google",
                     prompt_tokens,
                     completion_tokens,
-                    await db.get_chat_parameter(message.chat.id, "g_model")
+                    model_name
                 )
             except KeyError:
                 logger.exception(f"{request_id} | Failed to process token usage metadata.")
@@ -273,8 +359,7 @@ async def _handle_api_response(
 
                 return output
 
-            non_default_model = await db.get_chat_parameter(message.chat.id, "g_model")
-            if "thinking" in non_default_model and len(response["candidates"][0]["content"]["parts"]) > 1:
+            if "thinking" in model_name and len(response["candidates"][0]["content"]["parts"]) > 1:
                 part = -1  # use the last part since the first one is reasoning
             else:
                 part = 0
@@ -329,17 +414,7 @@ async def _handle_api_response(
         return output
 
 
-async def generate_response(message: Message) -> str:
-    request_id = random.randint(100000, 999999)
-
-    logger.info(
-        f"R: {request_id} | U: {message.from_user.id} ({message.from_user.first_name}) | C: {message.chat.id} ({message.chat.title}) | M: {message.message_id}"
-    )
-
-    chat_messages = await db.get_messages(message.chat.id)
-
-    model_name = await db.get_chat_parameter(message.chat.id, "g_model")
-
+async def _get_system_prompt(message: Message, chat_messages: List[Record]) -> Optional[dict]:
     chat_type = "direct message (DM)" if message.from_user.id == message.chat.id else "group"
     chat_title = f" called {message.chat.title}" if message.from_user.id != message.chat.id else f" with {message.from_user.first_name}"
 
@@ -359,21 +434,35 @@ async def generate_response(message: Message) -> str:
             ) + sys_prompt
 
         if sys_prompt:
-            system_prompt = {
+            return {
                 "parts": {
                     "text": sys_prompt
                 }
             }
-        else:
-            system_prompt = None
-    else:
-        system_prompt = None
+    return None
+
+
+async def generate_response(message: Message, on_partial: PartialCallback = None) -> str:
+    request_id = random.randint(100000, 999999)
+
+    logger.info(
+        f"R: {request_id} | U: {message.from_user.id} ({message.from_user.first_name}) | C: {message.chat.id} ({message.chat.title}) | M: {message.message_id}"
+    )
+
+    chat_messages = await db.get_messages(message.chat.id)
+
+    context_caching = bool(await db.get_chat_parameter(message.chat.id, "g_context_cache"))
+    if context_caching:
+        chat_messages = await context_cache.extend_history(message.chat.id, chat_messages)
+
+    model_name = await db.get_chat_parameter(message.chat.id, "g_model")
+    system_prompt = await _get_system_prompt(message, chat_messages)
 
     gen_start_time = time.perf_counter()
 
     async with simulate_typing(message.chat.id):
         try:
-            response = await _call_gemini_api(
+            response, used_model_name = await _call_gemini_api(
                 request_id,
                 message,
                 chat_messages,
@@ -386,11 +475,16 @@ async def generate_response(message: Message) -> str:
                 bool(await db.get_chat_parameter(message.chat.id, "g_code_execution")),
                 str(await db.get_chat_parameter(message.chat.id, "g_safety_threshold")),
                 bool(await db.get_chat_parameter(message.chat.id, "g_web_search")),
-                float(await db.get_chat_parameter(message.chat.id, "g_web_threshold"))
+                float(await db.get_chat_parameter(message.chat.id, "g_web_threshold")),
+                context_caching,
+                on_partial
             )
         except Exception as api_error:
             traceback.print_exc()
-            response = api_error
+            response, used_model_name = api_error, model_name
+
+    if isinstance(response, dict):
+        token_ledger.record(message.chat.id, chat_messages, response.get("usageMetadata", {}).get("promptTokenCount"))
 
     gen_end_time = time.perf_counter()
     gen_timedelta = gen_end_time - gen_start_time
@@ -400,7 +494,10 @@ async def generate_response(message: Message) -> str:
     show_error_message = await db.get_chat_parameter(message.chat.id, "show_error_messages")
 
     try:
-        return await _handle_api_response(request_id, response, message, show_error_message)
+        output = await _handle_api_response(request_id, response, message, show_error_message, used_model_name)
+        if used_model_name != model_name and not output.startswith("❌"):
+            output += f"\n⎯⎯⎯⎯⎯\n_⚠️ Модель {model_name} сейчас недоступна, ответила {used_model_name}_"
+        return output
     except Exception as e:
         logger.error(f"{request_id} | Failed to generate message. Exception: {e}")
         error_message = (": " + str(e)) if show_error_message else ""
@@ -410,28 +507,40 @@ async def generate_response(message: Message) -> str:
 async def count_tokens_for_chat(trigger_message: Message) -> int:
     key = await _get_api_key()
 
+    chat_messages = await db.get_messages(trigger_message.chat.id)
     try:
-        prompt = await _prepare_prompt(trigger_message, await db.get_messages(trigger_message.chat.id), key)
+        prompt, file_id = await _prepare_prompt(trigger_message, chat_messages)
     except IndexError:
         return 0
+    if file_id:
+        uploaded_file = await upload_other_media(file_id, key)
+        if uploaded_file:
+            prompt = _attach_file(prompt, uploaded_file)
 
     headers = {
         "Content-Type": "application/json"
     }
+    model = await db.get_chat_parameter(trigger_message.chat.id, "g_model")
+    # Counted as a whole request, so that the result is on the same basis as promptTokenCount of the generations
     data = {
-        "contents": prompt
+        "generateContentRequest": {
+            "model": f"models/{model}",
+            "contents": prompt
+        }
     }
-    model = await db.get_chat_parameter(trigger_message.chat.id, "g_model")
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:countTokens?key={key}"
+    system_prompt = await _get_system_prompt(trigger_message, chat_messages)
+    if system_prompt:
+        data["generateContentRequest"]["systemInstruction"] = system_prompt
+    url = f"{API_BASE_URL}/v1beta/models/{model}:countTokens?key={key}"
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data, proxy=os.getenv("PROXY_URL")) as response:
-            decoded_response = await response.json()
+    async with session_manager.get_session().post(url, headers=headers, json=data) as response:
+        decoded_response = await response.json()
 
     if not decoded_response:
         return 0
 
     try:
+        token_ledger.record(trigger_message.chat.id, chat_messages, decoded_response["totalTokens"])
         return decoded_response["totalTokens"]
     except Exception as e:
         logger.warning(f"Failed to count tokens: {e}")
@@ -445,16 +554,12 @@ async def _get_available_models() -> List[str]:
     try:
         key = await key_manager.get_api_key()
 
-        proxy = os.getenv("PROXY_URL")
-        connector = ProxyConnector.from_url(proxy) if proxy else None
-
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.get(
-                    f"https://generativelanguage.googleapis.com/v1beta/models?key={key}",
-                    timeout=10
-            ) as response:
-                response.raise_for_status()
-                decoded_response = await response.json()
+        async with session_manager.get_session().get(
+                f"{API_BASE_URL}/v1beta/models?key={key}",
+                timeout=aiohttp.ClientTimeout(total=10)
+        ) as response:
+            response.raise_for_status()
+            decoded_response = await response.json()
 
         hidden = ["bison", "aqa", "embedding", "gecko"]
         for model in decoded_response.get("models", []):
@@ -0,0 +1,151 @@
+import math
+import random
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from .quotas import KEY_LIMITS, get_model_family
+
+EWMA_ALPHA = 0.2
+RECOVERY_TIME = 300  # in seconds, how long it takes for a bad record to be mostly forgiven
+EXPLORATION = 0.05  # Share of choices made at random, so that degraded keys keep getting probed
+RECENT_ERRORS = 5
+
+# Failure reasons (see retry.py) that say something about the key rather than the model or the prompt
+KEY_FAILURES = ["RESOURCE_EXHAUSTED", "PERMISSION_DENIED", "API_KEY_INVALID", "UNAVAILABLE", "INTERNAL",
+                "DEADLINE_EXCEEDED", "HTTP_5XX", "TIMEOUT", "CONNECTION"]
+
+
+def ewma(average: Optional[float], value: float) -> float:
+    return value if average is None else EWMA_ALPHA * value + (1 - EWMA_ALPHA) * average
+
+
+def get_latency_family(model: str) -> str:
+    """Models of one family take about as long, so response times are only compared within a family"""
+    return get_model_family(model, KEY_LIMITS) or model
+
+
+class KeyHealth:
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.latencies: Dict[str, float] = {}  # family: EWMA of successful response times, in seconds
+        self.success_rate = 1.0  # EWMA
+        self.recent_errors: Deque[str] = deque(maxlen=RECENT_ERRORS)
+        self.samples = 0
+        self.clock = clock
+        self.updated_at = clock()
+
+    def record(self, latency: float, reason: Optional[str], family: Optional[str]) -> None:
+        if reason is None:
+            if family:
+                self.latencies[family] = ewma(self.latencies.get(family), latency)
+            self.success_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.success_rate
+        elif reason in KEY_FAILURES:
+            self.success_rate = (1 - EWMA_ALPHA) * self.success_rate
+            self.recent_errors.append(reason)
+        else:
+            return
+        self.samples += 1
+        self.updated_at = self.clock()
+
+    def get_state(self) -> dict:
+        return {
+            "latencies": dict(self.latencies),
+            "success_rate": self.success_rate,
+            "recent_errors": list(self.recent_errors),
+            "samples": self.samples,
+            "updated_at": self.updated_at,
+        }
+
+    def restore_state(self, state: dict) -> None:
+        self.latencies = dict(state.get("latencies", {}))
+        self.success_rate = state.get("success_rate", 1.0)
+        self.recent_errors.extend(state.get("recent_errors", []))
+        self.samples = state.get("samples", 0)
+        self.updated_at = state.get("updated_at", self.updated_at)
+
+    def effective_success_rate(self) -> float:
+        # Failures fade away with time, so a key that had a bad minute isn't shunned forever
+        decay = math.exp(-(self.clock() - self.updated_at) / RECOVERY_TIME)
+        return 1 - (1 - self.success_rate) * decay
+
+
+class HealthTracker:
+    """Per-key latency (by model family) and success rate, used to prefer fast and healthy keys"""
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self.keys: Dict[str, KeyHealth] = {}
+        self.average_latencies: Dict[str, float] = {}  # family: EWMA over all keys
+
+    def record(self, key: str, latency: float, reason: Optional[str], model: Optional[str] = None) -> None:
+        family = get_latency_family(model) if model else None
+        if key not in self.keys:
+            self.keys[key] = KeyHealth(self.clock)
+        self.keys[key].record(latency, reason, family)
+        if reason is None and family:
+            self.average_latencies[family] = ewma(self.average_latencies.get(family), latency)
+
+    def forget(self, key: str) -> None:
+        self.keys.pop(key, None)
+
+    def get_state(self) -> dict:
+        return {
+            "average_latencies": dict(self.average_latencies),
+            "keys": {key: health.get_state() for key, health in self.keys.items()},
+        }
+
+    def restore_state(self, state: dict, known_keys) -> None:
+        """Restores the records of the keys that are still in use. Failures keep fading from when they happened."""
+        self.average_latencies.update(state.get("average_latencies", {}))
+        for key, health_state in state.get("keys", {}).items():
+            if key in known_keys:
+                self.keys[key] = KeyHealth(self.clock)
+                self.keys[key].restore_state(health_state)
+
+    def relative_speed(self, key: str, model: Optional[str] = None) -> float:
+        """
+        How much faster than average a key answers requests to `model`'s family,
+        or, without a model, on average over the families it has served
+        """
+        health = self.keys.get(key)
+        if not health:
+            return 1.0  # Unknown keys are as good as an average one
+        families = [get_latency_family(model)] if model else list(health.latencies)
+        speeds = [self.average_latencies[family] / health.latencies[family] for family in families
+                  if health.latencies.get(family) and self.average_latencies.get(family)]
+        return sum(speeds) / len(speeds) if speeds else 1.0
+
+    def score(self, key: str, model: Optional[str] = None) -> float:
+        health = self.keys.get(key)
+        if not health:
+            return 1.0
+        return health.effective_success_rate() * self.relative_speed(key, model)
+
+    def choose(self, first_key: str, second_key: str, model: Optional[str] = None) -> str:
+        """Power of two choices: the healthier of two keys, or a random one now and then"""
+        if random.random() < EXPLORATION:
+            return random.choice([first_key, second_key])
+        return first_key if self.score(first_key, model) >= self.score(second_key, model) else second_key
+
+    def get_stats(self, count: int = 3) -> Dict[str, List[dict]]:
+        """The healthiest and the least healthy keys among those with enough samples"""
+        ranked = sorted(
+            (key for key, health in self.keys.items() if health.samples >= 3),
+            key=self.score, reverse=True
+        )
+
+        def describe(key: str) -> dict:
+            health = self.keys[key]
+            return {
+                "key": key[-6:],
+                "score": self.score(key),
+                "speed": self.relative_speed(key),
+                "success_rate": health.effective_success_rate(),
+                "recent_errors": list(health.recent_errors),
+            }
+
+        worst = ranked[max(count, len(ranked) - count):]
+        return {
+            "best": [describe(key) for key in ranked[:count]],
+            "worst": [describe(key) for key in reversed(worst)],
+        }
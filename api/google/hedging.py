@@ -0,0 +1,140 @@
+import asyncio
+import os
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, Union
+
+from loguru import logger
+
+HEDGING_ENABLED = os.getenv("GEMINI_HEDGING", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", 95))
+HEDGE_BUDGET = float(os.getenv("GEMINI_HEDGE_BUDGET", 0.05))  # extra requests per regular request
+
+MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+MAX_BUDGET_TOKENS = 10
+
+AttemptResult = Tuple[int, dict]  # HTTP status, decoded response
+
+
+class LatencyTracker:
+    """Keeps the latest successful generation latencies per model"""
+
+    def __init__(self):
+        self.latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+    def record(self, model: str, seconds: float) -> None:
+        self.latencies[model].append(seconds)
+
+    def percentile(self, model: str, percentile: float) -> Optional[float]:
+        samples = self.latencies.get(model)
+        if not samples or len(samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+
+class HedgeBudget:
+    """
+    Token bucket limiting hedges to a fraction of all requests:
+    every request earns `ratio` of a token, every hedge spends a whole one.
+    """
+
+    def __init__(self, ratio: float):
+        self.ratio = ratio
+        self.tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def on_request(self) -> None:
+        self.requests += 1
+        self.tokens = min(MAX_BUDGET_TOKENS, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.hedges += 1
+        return True
+
+
+latency_tracker = LatencyTracker()
+hedge_budget = HedgeBudget(HEDGE_BUDGET)
+
+
+def get_hedge_stats() -> dict:
+    return {
+        "requests": hedge_budget.requests,
+        "hedges": hedge_budget.hedges,
+        "hedge_wins": hedge_budget.hedge_wins,
+    }
+
+
+async def send_hedged(request_id: int, model: str, primary_key: str,
+                      send: Callable[[str], Awaitable[AttemptResult]],
+                      get_backup_key: Callable[[], Awaitable[str]],
+                      on_discarded: Callable[[str, Union[AttemptResult, BaseException], float], None]
+                      ) -> Tuple[str, AttemptResult]:
+    """
+    Sends a request on `primary_key`. If it takes longer than HEDGE_PERCENTILE of the recent latencies
+    of this model and the budget allows it, a duplicate is sent on another key.
+    The first successful response wins and the other request is cancelled.
+    Returns the key that produced the result along with the result itself. The outcome of the other
+    finished attempt, if any, is passed to `on_discarded` with its key and latency, so that the key
+    still answers for its failures.
+    """
+    hedge_budget.on_request()
+    loop = asyncio.get_running_loop()
+    primary = asyncio.create_task(send(primary_key))
+    backup = None
+    try:
+        delay = latency_tracker.percentile(model, HEDGE_PERCENTILE)
+        if delay is None:
+            return primary_key, await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not hedge_budget.try_spend():
+            return primary_key, await primary
+
+        try:
+            backup_key = await get_backup_key()
+        except Exception as e:
+            logger.debug(f"{request_id} | Not hedging, no backup key: {e}")
+            return primary_key, await primary
+        if backup_key == primary_key:
+            return primary_key, await primary
+
+        logger.info(f"{request_id} | Hedging after {round(delay, 2)}s: key ...{backup_key[-6:]}")
+        backup = asyncio.create_task(send(backup_key))
+        keys = {primary: primary_key, backup: backup_key}
+        started_at = {primary: loop.time() - delay, backup: loop.time()}
+        finished_at = {}
+
+        def report(task: asyncio.Task) -> None:
+            outcome = task.exception() or task.result()
+            on_discarded(keys[task], outcome, finished_at[task] - started_at[task])
+
+        pending = {primary, backup}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                finished_at[task] = loop.time()
+            for task in done:
+                if task.exception() is None and task.result()[0] == 200:
+                    for loser in pending:
+                        loser.cancel()
+                    for other in finished_at.keys() - {task}:
+                        report(other)  # Failed before the winner came in
+                    if task is backup:
+                        hedge_budget.hedge_wins += 1
+                        logger.info(f"{request_id} | Hedged request won")
+                    return keys[task], task.result()
+
+        # Neither succeeded, so report on the original attempt, and let the backup answer for its own failure
+        report(backup)
+        return primary_key, primary.result()
+    finally:
+        for task in [primary, backup]:
+            if task is not None and not task.done():
+                task.cancel()
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+KEY_STATE_BACKEND = os.getenv("GEMINI_KEY_STATE_BACKEND", "memory").lower()
+FLUSH_INTERVAL = float(os.getenv("GEMINI_KEY_STATE_FLUSH_INTERVAL", 0.05))  # in seconds
+RECONNECT_INTERVAL = 5  # in seconds
+CHANNEL = "gemini_key_state"
+# Keep notification payloads well under the 8000 bytes Postgres allows
+USAGE_ENTRIES_PER_NOTIFICATION = 50
+EVENTS_PER_NOTIFICATION = 30
+
+
+class KeyStateBackend:
+    """
+    Shares what one worker learns about the keys with the others. Events are dicts with an "event" field:
+    "timeout" (key, billing, model, timestamp, guessed), "reactivate" (key, billing, model), "remove" (key, billing)
+    and "usage" (entries of [key, model, requests, tokens]).
+    """
+
+    async def start(self, manager) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    def publish(self, event: dict) -> None:
+        pass
+
+    def add_usage(self, key: str, model: str, requests: int = 0, tokens: int = 0) -> None:
+        pass
+
+
+class MemoryKeyStateBackend(KeyStateBackend):
+    """A single worker keeps everything in its own memory, so there's nothing to share"""
+
+
+class PostgresKeyStateBackend(KeyStateBackend):
+    """
+    Exhaustion and removal are stored in a table, so that workers started later catch up, and broadcast
+    with NOTIFY together with usage counters, so that running workers apply them right away.
+    Everything is sent in batches from a single task, so that the callers never wait for the database.
+    Keys are only stored and sent as their fingerprints.
+    """
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self.manager = None
+        self.listener = None
+        self.events: List[dict] = []
+        self.usage: Dict[Tuple[str, str], List[int]] = {}  # (key, model): [requests, tokens]
+        self.wakeup = asyncio.Event()
+        self.sender_task = None
+
+    async def start(self, manager) -> None:
+        from db import shared  # Imported here so that the key manager can be used without a database
+
+        self.manager = manager
+        async with shared.pool.acquire() as conn:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS gemini_key_state (
+                    key TEXT NOT NULL,
+                    is_billing BOOLEAN NOT NULL,
+                    model TEXT NOT NULL DEFAULT '',
+                    state TEXT NOT NULL,
+                    timestamp DOUBLE PRECISION NOT NULL,
+                    PRIMARY KEY (key, is_billing, model)
+                );
+            """)
+            now = time.time()
+            await conn.execute(
+                "DELETE FROM gemini_key_state WHERE state = 'exhausted' AND "
+                "((model = '' AND timestamp < $1) OR (model != '' AND timestamp < $2));",
+                now - manager.exhausted_key_lifetime, now
+            )
+            rows = await conn.fetch("SELECT key, is_billing, model, state, timestamp FROM gemini_key_state;")
+
+        for row in rows:
+            if row["state"] == "removed":
+                event = {"event": "remove", "key": row["key"], "billing": row["is_billing"]}
+            else:
+                event = {"event": "timeout", "key": row["key"], "billing": row["is_billing"],
+                         "model": row["model"] or None, "timestamp": row["timestamp"]}
+            event = self._reveal(event)
+            if event:
+                self.manager.apply_remote_event(event)
+        logger.info(f"Loaded {len(rows)} shared key states.")
+
+        await self._listen()
+        self.sender_task = asyncio.create_task(self._send_loop())
+
+    async def close(self) -> None:
+        if self.sender_task:
+            self.sender_task.cancel()
+            self.sender_task = None
+            await self._flush()
+        if self.listener and not self.listener.is_closed():
+            await self.listener.close()
+
+    def publish(self, event: dict) -> None:
+        if self.manager is None:
+            return  # Not started, the event is only known locally
+        self.events.append(event)
+        self.wakeup.set()
+
+    def add_usage(self, key: str, model: str, requests: int = 0, tokens: int = 0) -> None:
+        if self.manager is None:
+            return
+        counters = self.usage.setdefault((key, model), [0, 0])
+        counters[0] += requests
+        counters[1] += tokens
+
+    async def _listen(self) -> None:
+        from db import shared
+
+        self.listener = await shared.create_connection()
+        await self.listener.add_listener(CHANNEL, self._on_notification)
+
+    def _on_notification(self, connection, pid, channel, payload) -> None:
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Ignoring malformed key state notification: {payload[:100]}")
+            return
+        if message.get("origin") == self.worker_id:
+            return
+        for event in message.get("events", []):
+            try:
+                event = self._reveal(event)
+                if event:
+                    self.manager.apply_remote_event(event)
+            except Exception as e:
+                logger.error(f"Failed to apply a shared key state event {event.get('event')}: {e}")
+
+    async def _send_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+            try:
+                if self.listener is None or self.listener.is_closed():
+                    logger.warning("Lost the shared key state listener, reconnecting...")
+                    await self._listen()
+                await self._flush()
+            except Exception as e:
+                logger.error(f"Failed to share key state: {e}")
+                await asyncio.sleep(RECONNECT_INTERVAL)
+
+    def _reveal(self, event: dict) -> Optional[dict]:
+        """Replaces the fingerprints in a shared event with the keys, None if none of them is known here"""
+        if event["event"] == "usage":
+            entries = [[self.manager.get_key_by_fingerprint(fingerprint), *counts]
+                       for fingerprint, *counts in event["entries"]]
+            entries = [entry for entry in entries if entry[0]]
+            return dict(event, entries=entries) if entries else None
+        key = self.manager.get_key_by_fingerprint(event["key"])
+        return dict(event, key=key) if key else None
+
+    async def _flush(self) -> None:
+        from .keys import get_key_fingerprint  # Imported here because of a circular import
+
+        events, self.events = self.events, []
+        usage, self.usage = self.usage, {}
+        if not events and not usage:
+            return
+
+        from db import shared
+
+        shared_events = [dict(event, key=get_key_fingerprint(event["key"])) for event in events]
+        usage_entries = [[get_key_fingerprint(key), model, requests, tokens]
+                         for (key, model), (requests, tokens) in usage.items()]
+        payloads = [shared_events[start:start + EVENTS_PER_NOTIFICATION]
+                    for start in range(0, len(shared_events), EVENTS_PER_NOTIFICATION)]
+        payloads += [[{"event": "usage", "entries": usage_entries[start:start + USAGE_ENTRIES_PER_NOTIFICATION]}]
+                     for start in range(0, len(usage_entries), USAGE_ENTRIES_PER_NOTIFICATION)]
+
+        try:
+            async with shared.pool.acquire() as conn:
+                async with conn.transaction():
+                    for event in shared_events:
+                        await self._store(conn, event)
+                    for payload in payloads:
+                        await conn.execute(
+                            "SELECT pg_notify($1, $2);",
+                            CHANNEL, json.dumps({"origin": self.worker_id, "events": payload})
+                        )
+        except BaseException:
+            # Nothing was sent, so it's all sent again with the next flush
+            self.events = events + self.events
+            for (key, model), (requests, tokens) in usage.items():
+                counters = self.usage.setdefault((key, model), [0, 0])
+                counters[0] += requests
+                counters[1] += tokens
+            raise
+
+    @staticmethod
+    async def _store(conn, event: dict) -> None:
+        if event["event"] == "timeout":
+            await conn.execute(
+                "INSERT INTO gemini_key_state (key, is_billing, model, state, timestamp) "
+                "VALUES ($1, $2, $3, 'exhausted', $4) "
+                "ON CONFLICT (key, is_billing, model) DO UPDATE SET state = 'exhausted', timestamp = $4;",
+                event["key"], event["billing"], event["model"] or "", event["timestamp"]
+            )
+        elif event["event"] == "reactivate":
+            await conn.execute(
+                "DELETE FROM gemini_key_state WHERE key = $1 AND is_billing = $2 AND model = $3;",
+                event["key"], event["billing"], event.get("model") or ""
+            )
+        elif event["event"] == "remove":
+            await conn.execute(
+                "INSERT INTO gemini_key_state (key, is_billing, model, state, timestamp) "
+                "VALUES ($1, $2, '', 'removed', $3) "
+                "ON CONFLICT (key, is_billing, model) DO UPDATE SET state = 'removed', timestamp = $3;",
+                event["key"], event["billing"], time.time()
+            )
+
+
+def create_state_backend() -> KeyStateBackend:
+    if KEY_STATE_BACKEND == "postgres":
+        return PostgresKeyStateBackend()
+    if KEY_STATE_BACKEND != "memory":
+        logger.error(f"Unknown key state backend '{KEY_STATE_BACKEND}', keeping the key state in memory")
+    return MemoryKeyStateBackend()
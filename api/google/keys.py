@@ -1,11 +1,52 @@
 import asyncio
+import hashlib
+import heapq
+import json
 import os
 import time
-from collections import defaultdict
 
 from loguru import logger
 
-from main import bot
+from .health import HealthTracker
+from .key_state import MemoryKeyStateBackend
+from .quotas import QuotaTracker
+
+try:
+    from watchfiles import awatch
+except ImportError:
+    awatch = None
+
+QUOTA_PROBES = 32  # How many keys to look at before settling for one that is over its limits
+STATE_SAVE_DELAY = 1.0  # in seconds, changes made within this time are saved together
+HEALTH_SAVE_INTERVAL = 60  # in seconds, key health changes with every request, so it's saved less often
+KEYS_FILE_POLL_INTERVAL = float(os.getenv("GEMINI_KEYS_POLL_INTERVAL", 10))  # in seconds, without watchfiles
+# A reload that would retire a bigger share of the keys is more likely a half-written file than an edit
+MAX_RETIRED_SHARE = float(os.getenv("GEMINI_KEYS_MAX_RETIRED_SHARE", 0.5))
+
+DEFAULT_POOL = "default"
+BILLING_POOL = "billing"
+# Keys with these tags only serve the requests routed to them, and are kept out of the default pool
+RESERVED_KEY_TAGS = {tag.strip() for tag in os.getenv("GEMINI_RESERVED_KEY_TAGS", "uploads, priority, admin").split(",")
+                     if tag.strip()}
+
+
+def parse_model_key_tags(value):
+    """model substring=tag, comma-separated"""
+    model_tags = {}
+    for entry in value.split(","):
+        if "=" in entry:
+            model, tag = entry.split("=", maxsplit=1)
+            model_tags[model.strip()] = tag.strip()
+    return model_tags
+
+
+# Requests for a model containing the substring only go to keys with the tag, as long as any key has it
+MODEL_KEY_TAGS = parse_model_key_tags(os.getenv("GEMINI_MODEL_KEY_TAGS", "pro=pro, thinking=pro"))
+
+
+def get_key_fingerprint(key):
+    """Identifies a key in the database without storing the key itself"""
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
 
 
 class OutOfKeysException(Exception):
@@ -16,121 +57,749 @@ class OutOfBillingKeysException(Exception):
     pass
 
 
-class ApiKeyManager:
-    def __init__(self, keys_file_path, exhaust_bantime=18 * 3600):
-        self.keys_file_path = keys_file_path
-        self.exhausted_key_lifetime = exhaust_bantime  # in seconds
+class KeysFileRejectedException(Exception):
+    pass
 
-        self.api_keys = []
-        self.billing_api_keys = []
 
-        self.active_api_keys = []
-        self.active_billing_api_keys = []
+class KeyRing:
+    """
+    Keys in round-robin order with O(1) membership checks, insertion and removal.
+    Removal swaps the key with the last one, so the order is only approximately preserved.
+    """
 
-        self.exhausted_api_keys = {}  # key: timestamp when exhausted
-        self.exhausted_billing_api_keys = {}
+    def __init__(self, keys=()):
+        self.keys = []
+        self.positions = {}  # key: index in self.keys
+        self.cursor = 0
+        for key in keys:
+            self.add(key)
 
-        self.api_key_index = 0
-        self.billing_api_key_index = 0
+    def __len__(self):
+        return len(self.keys)
 
-        self.api_keys_error_counts = defaultdict(int)
-        self.billing_api_keys_error_counts = defaultdict(int)
+    def __contains__(self, key):
+        return key in self.positions
 
-        self.keys_lock = asyncio.Lock()
+    def add(self, key):
+        if key in self.positions:
+            return
+        self.positions[key] = len(self.keys)
+        self.keys.append(key)
 
-        self._load_keys()
+    def remove(self, key):
+        index = self.positions.pop(key, None)
+        if index is None:
+            return
+        last_key = self.keys.pop()
+        if last_key != key:
+            self.keys[index] = last_key
+            self.positions[last_key] = index
+
+    def next(self):
+        if not self.keys:
+            return None
+        self.cursor %= len(self.keys)
+        key = self.keys[self.cursor]
+        self.cursor += 1
+        return key
+
+
+class KeyPool:
+    """Active keys of one routing pool and the ones waiting out an exhaustion cooldown"""
+
+    def __init__(self, keys, exhausted_key_lifetime, key_filter=None):
+        self.exhausted_key_lifetime = exhausted_key_lifetime
+        self.key_filter = key_filter  # (key, model): whether the key may serve the model at all
+        self.active = KeyRing(keys)
+        self.exhausted = {}  # key: timestamp when exhausted
+        self.retired = {}  # key: timestamp when exhausted, for keys that left the pool while exhausted
+        self.expiries = []  # min-heap of (timestamp when exhausted, key), may hold stale entries
+        self.removed = set()
+
+        # Exhaustion of a single model's quota, which doesn't take the key out of rotation
+        self.model_exhausted = {}  # (key, model): timestamp when the cooldown ends
+        self.model_expiries = []  # min-heap of (timestamp when the cooldown ends, key, model)
+        self.model_guessed = set()  # (key, model) whose cooldown wasn't known, and may end early
+        # model: active keys that may serve it and aren't exhausted for it, kept up to date once built
+        self.model_rings = {}
+
+    def __contains__(self, key):
+        return key in self.active or key in self.exhausted
+
+    def is_available(self, key, model=None):
+        return key in self.active and (model is None or not self.is_exhausted_for(key, model))
+
+    def is_exhausted_for(self, key, model):
+        return (key, model) in self.model_exhausted
+
+    def _is_usable_for(self, key, model):
+        return not self.is_exhausted_for(key, model) and (self.key_filter is None or self.key_filter(key, model))
+
+    def get_ring(self, model=None):
+        """The keys that can serve `model` right now, so that exhausted ones cost nothing to skip"""
+        if model is None:
+            return self.active
+        ring = self.model_rings.get(model)
+        if ring is None:
+            ring = KeyRing(key for key in self.active.keys if self._is_usable_for(key, model))
+            self.model_rings[model] = ring
+        return ring
+
+    def reset_rings(self):
+        """Needed when the key filter changes its mind, the rings are rebuilt on next use"""
+        self.model_rings = {}
+
+    def _activate(self, key):
+        self.active.add(key)
+        for model, ring in self.model_rings.items():
+            if self._is_usable_for(key, model):
+                ring.add(key)
+
+    def _deactivate(self, key):
+        self.active.remove(key)
+        for ring in self.model_rings.values():
+            ring.remove(key)
+
+    def timeout_for_model(self, key, model, until, guessed=False):
+        self.model_exhausted[(key, model)] = until
+        heapq.heappush(self.model_expiries, (until, key, model))
+        if guessed:
+            self.model_guessed.add((key, model))
+        else:
+            self.model_guessed.discard((key, model))
+        if model in self.model_rings:
+            self.model_rings[model].remove(key)
+
+    def timeout(self, key, now):
+        self._deactivate(key)
+        self.exhausted[key] = now
+        heapq.heappush(self.expiries, (now, key))
+
+    def remove(self, key):
+        self._deactivate(key)
+        self.exhausted.pop(key, None)  # Its heap entry becomes stale and is skipped later
+        self.removed.add(key)
+
+    def reactivate(self, key):
+        if self.exhausted.pop(key, None) is not None:
+            self._activate(key)
+
+    def reactivate_for_model(self, key, model):
+        self.model_guessed.discard((key, model))
+        if self.model_exhausted.pop((key, model), None) is not None:
+            self._reactivate_model_ring(key, model)  # Its heap entry becomes stale and is skipped later
+
+    def _reactivate_model_ring(self, key, model):
+        if key in self.active and model in self.model_rings and self._is_usable_for(key, model):
+            self.model_rings[model].add(key)
+
+    def add(self, key):
+        if key in self.removed or key in self.exhausted or key in self.active:
+            return
+        exhausted_at = self.retired.pop(key, None)
+        if exhausted_at is not None:
+            self.timeout(key, exhausted_at)  # Reactivated as usual once the cooldown is over
+        else:
+            self._activate(key)
+
+    def retire(self, key):
+        """
+        Takes a key out of the pool. Whether it was invalid or exhausted is remembered,
+        so that a key coming back to the list doesn't come back as a fresh one.
+        """
+        self._deactivate(key)
+        exhausted_at = self.exhausted.pop(key, None)
+        if exhausted_at is not None:
+            self.retired[key] = exhausted_at
+
+    def get_state(self):
+        return {
+            "exhausted": dict(self.exhausted),
+            "removed": list(self.removed),
+            "model_exhausted": [[key, model, until, (key, model) in self.model_guessed]
+                                for (key, model), until in self.model_exhausted.items()],
+        }
+
+    def restore_state(self, state, now):
+        for key in state.get("removed", []):
+            if key in self.active:
+                self.remove(key)
+        for key, timestamp in state.get("exhausted", {}).items():
+            if key in self.active and now - timestamp < self.exhausted_key_lifetime:
+                self.timeout(key, timestamp)
+        for key, model, until, *guessed in state.get("model_exhausted", []):
+            if key in self.active and until > now:
+                self.timeout_for_model(key, model, until, bool(guessed and guessed[0]))
+
+    def reactivate_expired(self, now):
+        while self.expiries and now - self.expiries[0][0] >= self.exhausted_key_lifetime:
+            timestamp, key = heapq.heappop(self.expiries)
+            if self.exhausted.get(key) != timestamp:
+                continue  # Removed or exhausted again since then
+            del self.exhausted[key]
+            self._activate(key)
+            logger.info(f"Key {key[-6:]} reactivated after cooldown.")
 
-    async def get_api_key(self, billing_only=False):
-        async with self.keys_lock:
-            # Reactivate exhausted keys if their cooldown has expired
-            self._reactivate_exhausted_keys(billing_only)
+        while self.model_expiries and self.model_expiries[0][0] <= now:
+            until, key, model = heapq.heappop(self.model_expiries)
+            if self.model_exhausted.get((key, model)) == until:
+                del self.model_exhausted[(key, model)]
+                self.model_guessed.discard((key, model))
+                self._reactivate_model_ring(key, model)
+                logger.info(f"Key {key[-6:]} reactivated for {model} after cooldown.")
 
-            keys, index, error_counts = self._select_key_set(billing_only)
 
-            if not keys:
-                if billing_only:
-                    raise OutOfBillingKeysException("No active billing API keys available")
-                else:
-                    raise OutOfKeysException("No active API keys available")
+class ApiKeyManager:
+    def __init__(self, keys_file_path, exhaust_bantime=18 * 3600, state_file_path=None, state_backend=None,
+                 usage_ledger=None, clock=None):
+        self.keys_file_path = keys_file_path
+        self.state_file_path = state_file_path  # Exhausted and removed keys and key health are kept here
+        self.state_backend = state_backend or MemoryKeyStateBackend()  # Shares the state with other workers
+        self.usage_ledger = usage_ledger  # Persists per-key usage for capacity planning, if given
+        # Replaceable, so that the selection logic can be replayed in simulated time
+        self.clock = clock or time.time
+        self.exhausted_key_lifetime = exhaust_bantime  # in seconds
 
-            key = keys[index % len(keys)]
-            self._increment_index(billing_only)
+        self.api_keys = []
+        self.billing_api_keys = []
 
-            return key
+        # Routing pools: the default one, billing-enabled keys, and one per key tag
+        self.pools = {
+            DEFAULT_POOL: KeyPool([], self.exhausted_key_lifetime, self.is_model_allowed),
+            BILLING_POOL: KeyPool([], self.exhausted_key_lifetime, self.is_model_allowed),
+        }
+        self.quotas = QuotaTracker(clock or time.monotonic)
+        self.health = HealthTracker(self.clock)
+
+        self._state_dirty = False
+        self._save_task = None
+        self._health_saved_at = self.clock()
+        self._keys_file_signature = None
+        self.key_groups = {}  # key: project it belongs to, keys of one project share its quota
+        self.group_keys = {}  # project: its keys
+        self.key_models = {}  # key: model substrings it's allowed to serve, if limited
+        self.key_fingerprints = {}  # fingerprint: key
 
-    def _load_keys(self):
-        if not os.path.exists(self.keys_file_path):
-            logger.exception(
-                f"Couldn't find the key list file in the configured data folder. "
-                f"Please make sure that {self.keys_file_path} exists."
-            )
-            exit(1)
+        self._load_keys()
+
+    @property
+    def pool(self):
+        return self.pools[DEFAULT_POOL]
+
+    @property
+    def billing_pool(self):
+        return self.pools[BILLING_POOL]
+
+    async def get_api_key(self, billing_only=False, model=None, avoid_groups=None, tier=None, with_file=False,
+                          count=True):
+        """
+        Picks the healthier of the next two keys in rotation, from the pools the request is routed to.
+        If `model` is given, keys that are predictably over their per-model quota are skipped,
+        and unless `count` is False, the request is counted against the chosen key.
+        Keys from the projects in `avoid_groups` are only used if no other key is found.
+        """
+        # Everything here is O(1) amortized and never awaits, so no lock is needed
+        pools = self._route(billing_only, model, tier, with_file)
+        now = self.clock()
+        for pool in pools:
+            pool.reactivate_expired(now)
+
+        if not any(pool.active for pool in pools):
+            if billing_only:
+                raise OutOfBillingKeysException("No active billing API keys available")
+            else:
+                raise OutOfKeysException("No active API keys available")
+
+        key = None
+        for pool in pools:
+            key = self._choose_key(pool, model, avoid_groups) if pool.active else None
+            if key is not None:
+                break
+        if key is None:
+            if billing_only:
+                raise OutOfBillingKeysException(f"No billing API keys available for {model}")
+            else:
+                raise OutOfKeysException(f"No API keys available for {model}")
+        if model is not None and count:
+            self.record_request(key, model)
+        return key
+
+    def _route(self, billing_only, model, tier, with_file):
+        """
+        The pools to pick a key from, in order of preference. Priority and admin chats, and requests with files,
+        go to the keys reserved for them first. Models with a key tag never fall through to the default pool,
+        so that expensive traffic can't drain the keys everything else depends on.
+        """
+        if billing_only:
+            return [self.billing_pool]
 
+        pools = []
+        if tier and tier in self.pools:
+            pools.append(self.pools[tier])
+        if with_file and "uploads" in self.pools:
+            pools.append(self.pools["uploads"])
+
+        model_tag = self._get_model_tag(model)
+        if model_tag:
+            pools.append(self.pools[model_tag])
+        else:
+            pools.append(self.pool)
+        return pools
+
+    def _get_model_tag(self, model):
+        """The tag of the keys reserved for `model`, if there are any such keys"""
+        if not model:
+            return None
+        matching = [model_part for model_part in MODEL_KEY_TAGS if model_part in model]
+        if not matching:
+            return None
+        tag = MODEL_KEY_TAGS[max(matching, key=len)]
+        return tag if tag in self.pools and tag not in [DEFAULT_POOL, BILLING_POOL] else None
+
+    def is_model_allowed(self, key, model):
+        allowed_models = self.key_models.get(key)
+        return not allowed_models or any(model_part in model for model_part in allowed_models)
+
+    def _choose_key(self, pool, model, avoid_groups=None):
+        # Keys exhausted for the model or not allowed to serve it aren't in its ring, so every probe counts
+        ring = pool.get_ring(model)
+        candidates = []
+        avoided_candidates = []
+        fullest_key, fullest_fill_level = None, -1.0
+        for _ in range(min(len(ring), QUOTA_PROBES)):
+            key = ring.next()
+            if model is None or self.quotas.has_capacity(key, model):
+                group = self.key_groups.get(key)
+                if group and avoid_groups and group in avoid_groups:
+                    avoided_candidates.append(key)
+                    continue
+                candidates.append(key)
+                if len(candidates) == 2:
+                    return self.health.choose(*candidates, model)
+                continue
+            fill_level = self.quotas.fill_level(key, model)
+            if fill_level > fullest_fill_level:
+                fullest_key, fullest_fill_level = key, fill_level
+
+        if candidates:
+            return candidates[0]
+        if avoided_candidates:
+            return avoided_candidates[0]
+        if fullest_key is None:
+            return None  # No key in the pool can serve this model
+        logger.debug(f"No key with spare {model} quota among {QUOTA_PROBES} probed, using the fullest one")
+        return fullest_key
+
+    def record_request(self, key, model):
+        self.quotas.record_request(key, model)
+        self.state_backend.add_usage(key, model, requests=1)
+        if self.usage_ledger:
+            self.usage_ledger.record(key, model, requests=1)
+
+    def record_usage(self, key, model, tokens):
+        self.quotas.record_tokens(key, model, tokens)
+        self.state_backend.add_usage(key, model, tokens=tokens)
+        if self.usage_ledger:
+            self.usage_ledger.record(key, model, tokens=tokens)
+
+    def record_result(self, key, latency, reason, model=None):
+        """Feeds the outcome of a request (a retry.py failure reason, or None for success) to the key's health"""
+        self.health.record(key, latency, reason, model)
+        if self.clock() - self._health_saved_at >= HEALTH_SAVE_INTERVAL:
+            self._health_saved_at = self.clock()
+            self._schedule_state_save()
+        if self.usage_ledger and model and reason is not None:
+            self.usage_ledger.record(key, model, errors=1)
+
+    def is_key_available(self, key, billing_only=False, model=None, tier=None, with_file=False):
+        """
+        Whether a key picked beforehand can take a request routed like this. Only the pools the request is routed to
+        count, so that a key bound to a chat can't carry a request into a pool it must stay out of.
+        """
+        if model is not None and not self.is_model_allowed(key, model):
+            return False
+        return any(pool.is_available(key, model) for pool in self._route(billing_only, model, tier, with_file))
+
+    def _get_pools_of(self, key, is_billing):
+        """
+        The pools holding a key. Billing-enabled keys used for grounding are tracked separately from their
+        use as regular keys, tag pools share the state of the key with the default one.
+        """
+        if is_billing:
+            return [self.billing_pool] if key in self.billing_pool else []
+        return [pool for name, pool in self.pools.items() if name != BILLING_POOL and key in pool]
+
+    def _read_keys_file(self):
+        """
+        Each line is a key, optionally followed by tags: "b" or "| billing enabled" marks a billing-enabled key,
+        "project=<name>" (or "group=<name>") the project it belongs to, "models=<part>,<part>" limits it to
+        the models containing one of the parts, and any other word is a tag that puts it in a routing pool,
+        e.g. "AIzaSy... b project=bot-3 pro" or "AIzaSy... uploads models=flash".
+        """
+        keys = []
+        billing_keys = []
+        key_groups = {}
+        key_tags = {}
+        key_models = {}
+        seen_keys = set()
         with open(self.keys_file_path, "r") as f:
+            self._keys_file_signature = self._get_keys_file_signature()
             for line in f:
                 line = line.strip()
                 if line.startswith("AIzaSy"):
                     key_parts = line.split(" ", maxsplit=1)
                     key = key_parts[0]
-                    if key in self.api_keys:
+                    if key in seen_keys:
                         logger.warning(f"Key {key[-6:]} has duplicates in the list file.")
                         continue
-                    self.api_keys.append(key)
-                    if len(key_parts) > 1 and key_parts[1].lower() in ["b", "| billing enabled"]:
-                        self.billing_api_keys.append(key)
+                    seen_keys.add(key)
+                    keys.append(key)
+                    if len(key_parts) < 2:
+                        continue
+
+                    tags = key_parts[1].lower().replace("|", " ").split()
+                    for tag in tags:
+                        if tag in ["b", "billing"]:
+                            billing_keys.append(key)
+                        elif tag.startswith(("project=", "group=")):
+                            key_groups[key] = tag.split("=", maxsplit=1)[1]
+                        elif tag.startswith("models="):
+                            key_models[key] = [part for part in tag.split("=", maxsplit=1)[1].split(",") if part]
+                        elif tag not in ["enabled", DEFAULT_POOL] and "=" not in tag:
+                            key_tags.setdefault(key, set()).add(tag)
+        return keys, billing_keys, key_groups, key_tags, key_models
+
+    @staticmethod
+    def _get_pool_members(keys, billing_keys, key_tags):
+        members = {
+            DEFAULT_POOL: [key for key in keys if not key_tags.get(key, set()) & RESERVED_KEY_TAGS],
+            BILLING_POOL: list(billing_keys),
+        }
+        for key in keys:
+            for tag in sorted(key_tags.get(key, [])):
+                members.setdefault(tag, []).append(key)
+        return members
+
+    def _set_key_groups(self, key_groups):
+        self.key_groups = key_groups
+        self.group_keys = {}
+        for key, group in key_groups.items():
+            self.group_keys.setdefault(group, []).append(key)
+
+    def get_key_group(self, key):
+        return self.key_groups.get(key)
+
+    def get_key_by_fingerprint(self, fingerprint):
+        """The key with the fingerprint, None if it's not in the list (anymore)"""
+        return self.key_fingerprints.get(fingerprint)
+
+    def _get_siblings(self, key):
+        """The key itself and every other key of its project"""
+        group = self.key_groups.get(key)
+        return self.group_keys[group] if group else [key]
+
+    def _get_keys_file_signature(self):
+        try:
+            stat = os.stat(self.keys_file_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load_keys(self):
+        if not os.path.exists(self.keys_file_path):
+            logger.exception(
+                f"Couldn't find the key list file in the configured data folder. "
+                f"Please make sure that {self.keys_file_path} exists."
+            )
+            exit(1)
+
+        self.api_keys, self.billing_api_keys, key_groups, key_tags, self.key_models = self._read_keys_file()
+        self._set_key_groups(key_groups)
+        self.key_fingerprints = {get_key_fingerprint(key): key for key in self.api_keys}
 
         # Initialize active keys
-        self.active_api_keys = self.api_keys.copy()
-        self.active_billing_api_keys = self.billing_api_keys.copy()
+        self.quotas.billing_keys = set(self.billing_api_keys)
+        self.pools = {
+            name: KeyPool(members, self.exhausted_key_lifetime, self.is_model_allowed)
+            for name, members in self._get_pool_members(self.api_keys, self.billing_api_keys, key_tags).items()
+        }
 
         logger.info(
             f"Loaded {len(self.api_keys)} API keys, "
             f"{len(self.billing_api_keys)} of them marked as billing-enabled."
         )
+        tag_pools = [f"{name} ({len(pool.active)})" for name, pool in self.pools.items()
+                     if name not in [DEFAULT_POOL, BILLING_POOL]]
+        if tag_pools:
+            logger.info(f"Tagged key pools: {', '.join(tag_pools)}.")
+
+        self._load_state()
+
+    def reload_keys(self, force=False):
+        """
+        Applies changes of the key list file: new keys join the rotation, keys that are gone leave it,
+        and everything known about the unchanged keys is kept. Requests already running on a retired key
+        are not affected, it just won't be handed out anymore.
+        An empty list, or one missing more than MAX_RETIRED_SHARE of the keys unless `force` is set,
+        is rejected with KeysFileRejectedException, since it's most likely caught in the middle of a write.
+        """
+        keys, billing_keys, key_groups, key_tags, key_models = self._read_keys_file()
+
+        old_keys, old_billing_keys = set(self.api_keys), set(self.billing_api_keys)
+        new_keys, new_billing_keys = set(keys), set(billing_keys)
+        changes = {
+            "added": [key for key in keys if key not in old_keys],
+            "retired": [key for key in self.api_keys if key not in new_keys],
+            "billing_added": [key for key in billing_keys if key not in old_billing_keys],
+            "billing_retired": [key for key in self.billing_api_keys if key not in new_billing_keys],
+        }
+        if not keys:
+            raise KeysFileRejectedException("The key list file has no keys")
+        if not force and len(changes["retired"]) > MAX_RETIRED_SHARE * len(old_keys):
+            raise KeysFileRejectedException(
+                f"The key list file is missing {len(changes['retired'])} of {len(old_keys)} keys"
+            )
 
-    def _select_key_set(self, billing_only):
-        if billing_only:
-            keys = [k for k in self.active_billing_api_keys if k not in self.exhausted_billing_api_keys]
-            return keys, self.billing_api_key_index, self.billing_api_keys_error_counts
+        # Keys whose tags changed move between the pools the same way
+        members = self._get_pool_members(keys, billing_keys, key_tags)
+        for name in list(self.pools):
+            if name not in members:
+                del self.pools[name]
+        for name, pool_keys in members.items():
+            pool = self.pools.setdefault(name, KeyPool([], self.exhausted_key_lifetime, self.is_model_allowed))
+            pool_key_set = set(pool_keys)
+            for key in [key for key in list(pool.active.keys) + list(pool.exhausted) if key not in pool_key_set]:
+                pool.retire(key)
+            for key in pool_keys:
+                pool.add(key)
+
+        for key in changes["retired"]:
+            self.health.forget(key)
+        for key in changes["retired"] + changes["billing_added"] + changes["billing_retired"]:
+            self.quotas.forget_key(key)  # Gone, or now has different limits
+
+        self.api_keys, self.billing_api_keys = keys, billing_keys
+        self.key_fingerprints = {get_key_fingerprint(key): key for key in keys}
+        self.quotas.billing_keys = new_billing_keys
+        self._set_key_groups(key_groups)
+        self.key_models = key_models
+        for pool in self.pools.values():
+            pool.reset_rings()
+
+        if any(changes.values()):
+            logger.info(
+                f"Reloaded API keys: +{len(changes['added'])} -{len(changes['retired'])} "
+                f"(billing: +{len(changes['billing_added'])} -{len(changes['billing_retired'])})."
+            )
+            self._schedule_state_save()
+        return changes
+
+    async def watch_keys_file(self):
+        """Reloads the keys whenever the list file changes, with inotify if watchfiles is installed"""
+        if awatch is not None:
+            # The directory is watched, since the file itself may be replaced rather than written to
+            keys_file_path = os.path.abspath(self.keys_file_path)
+            async for file_changes in awatch(os.path.dirname(keys_file_path)):
+                if any(os.path.abspath(path) == keys_file_path for _, path in file_changes):
+                    self._reload_if_changed()
         else:
-            keys = [k for k in self.active_api_keys if k not in self.exhausted_api_keys]
-            return keys, self.api_key_index, self.api_keys_error_counts
+            while True:
+                await asyncio.sleep(KEYS_FILE_POLL_INTERVAL)
+                self._reload_if_changed()
 
-    def _increment_index(self, billing_only):
-        if billing_only:
-            self.billing_api_key_index += 1
-        else:
-            self.api_key_index += 1
+    def _reload_if_changed(self):
+        if self._get_keys_file_signature() in [None, self._keys_file_signature]:
+            return
+        try:
+            self.reload_keys()
+        except KeysFileRejectedException as e:
+            # Retried with the next change of the file, /reloadkeys force applies it as it is
+            logger.error(f"Not reloading the API keys: {e}")
+        except Exception as e:
+            logger.error(f"Failed to reload the API keys: {e}")
 
-    def timeout_key(self, key, is_billing):
-        now = time.time()
-        if is_billing:
-            if key in self.active_billing_api_keys:
-                self.active_billing_api_keys.remove(key)
-            self.exhausted_billing_api_keys[key] = now
-            logger.info(f"Billing API key {key[-6:]} exhausted and moved to exhausted list.")
+    def _load_state(self):
+        if not self.state_file_path or not os.path.exists(self.state_file_path):
+            return
+        try:
+            with open(self.state_file_path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load the key state, starting from scratch: {e}")
+            return
+
+        now = self.clock()
+        self.pool.restore_state(state.get("api_keys", {}), now)
+        self.billing_pool.restore_state(state.get("billing_api_keys", {}), now)
+        for name, pool_state in state.get("tag_pools", {}).items():
+            if name in self.pools:
+                self.pools[name].restore_state(pool_state, now)
+        self.health.restore_state(state.get("health", {}), set(self.api_keys) | set(self.billing_api_keys))
+        logger.info(
+            f"Restored key state: {len(self.pool.exhausted)} exhausted, {len(self.pool.removed)} removed "
+            f"(billing: {len(self.billing_pool.exhausted)} exhausted, {len(self.billing_pool.removed)} removed)."
+        )
+
+    def _schedule_state_save(self):
+        if not self.state_file_path:
+            return
+        self._state_dirty = True
+        if self._save_task and not self._save_task.done():
+            return
+        try:
+            self._save_task = asyncio.get_running_loop().create_task(self._save_state_later())
+        except RuntimeError:
+            pass  # No event loop, nothing to save from
+
+    async def _save_state_later(self):
+        while self._state_dirty:
+            await asyncio.sleep(STATE_SAVE_DELAY)
+            self._state_dirty = False
+            await self.save_state()
+
+    async def save_state(self):
+        if not self.state_file_path:
+            return
+        state = {
+            "api_keys": self.pool.get_state(),
+            "billing_api_keys": self.billing_pool.get_state(),
+            "tag_pools": {name: pool.get_state() for name, pool in self.pools.items()
+                          if name not in [DEFAULT_POOL, BILLING_POOL]},
+            "health": self.health.get_state(),
+        }
+        try:
+            await asyncio.to_thread(self._write_state, state)
+        except OSError as e:
+            logger.error(f"Failed to save the key state: {e}")
+
+    def _write_state(self, state):
+        temporary_path = self.state_file_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temporary_path, self.state_file_path)
+
+    def timeout_key(self, key, is_billing, model=None, cooldown=None):
+        """
+        Takes a key out of rotation, or, if `model` is given, only for that model,
+        for `cooldown` seconds (`exhausted_key_lifetime` if unknown).
+        The other keys of its project share the quota, so they go along with it.
+        """
+        now = self.clock()
+        guessed = bool(model) and cooldown is None  # The prober checks these for an early end
+        if model:
+            cooldown = self.exhausted_key_lifetime if cooldown is None else cooldown
+            timestamp = now + cooldown
+        elif cooldown is not None:
+            # Counted as exhausted earlier, so that it's back when the lifetime runs out
+            timestamp = now - max(0.0, self.exhausted_key_lifetime - cooldown)
         else:
-            if key in self.active_api_keys:
-                self.active_api_keys.remove(key)
-            self.exhausted_api_keys[key] = now
-            logger.info(f"API key {key[-6:]} exhausted and moved to exhausted list.")
+            timestamp = now
+        siblings = self._apply_timeout(key, is_billing, model, timestamp, guessed)
+        self.state_backend.publish({
+            "event": "timeout", "key": key, "billing": is_billing, "model": model, "timestamp": timestamp,
+            "guessed": guessed
+        })
+
+        if model:
+            logger.info(f"{'Billing API' if is_billing else 'API'} key {key[-6:]} exhausted for {model}, "
+                        f"cooling down for {round(cooldown)}s.")
+        else:
+            if is_billing:
+                logger.info(f"Billing API key {key[-6:]} exhausted and moved to exhausted list.")
+            else:
+                logger.info(f"API key {key[-6:]} exhausted and moved to exhausted list.")
+        if len(siblings) > 1:
+            logger.info(f"{len(siblings) - 1} more keys of project {self.key_groups[key]} exhausted along with it.")
+
+    def _apply_timeout(self, key, is_billing, model, timestamp, guessed=False):
+        """`timestamp` is when the cooldown ends for a model, and when the key was exhausted otherwise"""
+        siblings = set()
+        for pool in self._get_pools_of(key, is_billing):
+            for sibling in self._get_siblings(key):
+                if sibling != key and sibling not in pool.active:
+                    continue
+                if model:
+                    pool.timeout_for_model(sibling, model, timestamp, guessed)
+                else:
+                    pool.timeout(sibling, timestamp)
+                siblings.add(sibling)
+        self._schedule_state_save()
+        return siblings
+
+    def reactivate_key(self, key, is_billing, model=None):
+        """Ends the cooldown of a key, or only its cooldown for `model`, along with the rest of its project"""
+        self._apply_reactivation(key, is_billing, model)
+        self.state_backend.publish({"event": "reactivate", "key": key, "billing": is_billing, "model": model})
+        logger.info(f"{'Billing API' if is_billing else 'API'} key {key[-6:]} reactivated early"
+                    f"{f' for {model}' if model else ''}.")
+
+    def _apply_reactivation(self, key, is_billing, model):
+        for pool in self._get_pools_of(key, is_billing):
+            if model:
+                # The project's quota is shared, so its keys were exhausted together and come back together
+                for sibling in self._get_siblings(key):
+                    pool.reactivate_for_model(sibling, model)
+            else:
+                pool.reactivate(key)
+        self._schedule_state_save()
 
     def remove_key_permanently(self, key, is_billing):
+        self._forget_key(key, is_billing)
+        self.state_backend.publish({"event": "remove", "key": key, "billing": is_billing})
         if is_billing:
-            self.active_billing_api_keys = [k for k in self.active_billing_api_keys if k != key]
-            self.exhausted_billing_api_keys.pop(key, None)
             logger.warning(f"Billing API key {key[-6:]} removed permanently due to invalidity.")
         else:
-            self.active_api_keys = [k for k in self.active_api_keys if k != key]
-            self.exhausted_api_keys.pop(key, None)
             logger.warning(f"API key {key[-6:]} removed permanently due to invalidity.")
 
-        asyncio.create_task(self._notify_admin(key, bot, "Invalid API key"))
+        asyncio.create_task(self._notify_admin(key, "Invalid API key"))
+
+    def _forget_key(self, key, is_billing):
+        for pool in self._get_pools_of(key, is_billing):
+            pool.remove(key)
+        self.quotas.forget_key(key)
+        self.health.forget(key)
+        self._schedule_state_save()
+
+    def apply_remote_event(self, event):
+        """Applies a change made by another worker, without publishing it again"""
+        now = self.clock()
+        if event["event"] == "usage":
+            for key, model, requests, tokens in event["entries"]:
+                if not any(key in pool.active for pool in self.pools.values()):
+                    continue
+                if requests:
+                    self.quotas.record_request(key, model, requests)
+                if tokens:
+                    self.quotas.record_tokens(key, model, tokens)
+            return
 
-    async def _notify_admin(self, key, bot, reason=''):
+        key, is_billing = event["key"], event["billing"]
+        pools = self._get_pools_of(key, is_billing)
+        if event["event"] == "timeout":
+            model, timestamp = event["model"], event["timestamp"]
+            expired = timestamp <= now if model else now - timestamp >= self.exhausted_key_lifetime
+            if any(key in pool.active for pool in pools) and not expired:
+                self._apply_timeout(key, is_billing, model, timestamp, event.get("guessed", False))
+                logger.debug(f"Key {key[-6:]} exhausted{f' for {model}' if model else ''} by another worker.")
+        elif event["event"] == "reactivate":
+            model = event.get("model")
+            if model:
+                exhausted = any(pool.is_exhausted_for(key, model) for pool in pools)
+            else:
+                exhausted = any(key in pool.exhausted for pool in pools)
+            if exhausted:
+                self._apply_reactivation(key, is_billing, model)
+                logger.debug(f"Key {key[-6:]} reactivated{f' for {model}' if model else ''} by another worker.")
+        elif event["event"] == "remove":
+            if pools:
+                self._forget_key(key, is_billing)
+                logger.info(f"Key {key[-6:]} removed by another worker.")
+
+    async def _notify_admin(self, key, reason=''):
         target_id = int(os.getenv("FEEDBACK_TARGET_ID"))
         if not target_id:
             return
+        from main import bot  # Imported here so that the manager can be used without a running bot
         try:
             await bot.send_message(
                 target_id,
@@ -139,38 +808,30 @@ class ApiKeyManager:
         except Exception as e:
             logger.error(f"Failed to send key removal notification: {e}")
 
-    def _reactivate_exhausted_keys(self, is_billing):
-        now = time.time()
-        if is_billing:
-            exhausted_keys = self.exhausted_billing_api_keys
-            active_keys = self.active_billing_api_keys
-        else:
-            exhausted_keys = self.exhausted_api_keys
-            active_keys = self.active_api_keys
-
-        keys_to_reactivate = []
-        for key, timestamp in exhausted_keys.items():
-            if now - timestamp >= self.exhausted_key_lifetime:
-                keys_to_reactivate.append(key)
-
-        for key in keys_to_reactivate:
-            exhausted_keys.pop(key)
-            active_keys.append(key)
-            logger.info(f"Key {key[-6:]} reactivated after cooldown.")
-
     def get_key_statuses(self):
+        # Keys of the reserved tag pools aren't in the default one, but count as regular keys all the same
+        regular_pools = [pool for name, pool in self.pools.items() if name != BILLING_POOL]
         statuses = {
             'active': {
-                'api_keys': len(self.active_api_keys),
-                'billing_api_keys': len(self.active_billing_api_keys)
+                'api_keys': len(set().union(*[pool.active.keys for pool in regular_pools])),
+                'billing_api_keys': len(self.billing_pool.active)
             },
             'exhausted': {
-                'api_keys': len(self.exhausted_api_keys),
-                'billing_api_keys': len(self.exhausted_billing_api_keys)
+                'api_keys': len(set().union(*[pool.exhausted for pool in regular_pools])),
+                'billing_api_keys': len(self.billing_pool.exhausted)
+            },
+            'exhausted_for_model': {
+                'api_keys': len(set().union(*[pool.model_exhausted for pool in regular_pools])),
+                'billing_api_keys': len(self.billing_pool.model_exhausted)
             },
             'total': {
                 'api_keys': len(self.api_keys),
                 'billing_api_keys': len(self.billing_api_keys)
+            },
+            'groups': len(self.group_keys),
+            'tag_pools': {
+                name: {'active': len(pool.active), 'exhausted': len(pool.exhausted)}
+                for name, pool in self.pools.items() if name not in [DEFAULT_POOL, BILLING_POOL]
             }
         }
         return statuses
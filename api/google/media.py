@@ -1,38 +1,164 @@
 import asyncio
 import base64
+import datetime
+import hashlib
 import os
 import traceback
-from typing import Dict, List
+from collections import OrderedDict
+from typing import Dict, List, Optional
 
-import aiohttp
 import magic
 from aiogram.types import Message
+from async_lru import alru_cache
 from asyncpg import Record
 from loguru import logger
 
 import db
 from main import bot
+from .sessions import API_BASE_URL, session_manager
 from ..media import get_file_id_from_chain
+from ..media_cache import media_cache
 
 cache_path = os.getenv('CACHE_PATH')
 
+UPLOAD_LIFETIME = datetime.timedelta(hours=48)  # How long the File API keeps a file
+UPLOAD_REUSE_MARGIN = datetime.timedelta(hours=1)  # Uploads closer than this to expiring are made again
+
+INGESTION_CONCURRENCY = int(os.getenv("MEDIA_INGESTION_CONCURRENCY", 4))
+PRELOADED_KEYS_SIZE = 1024
+ingestion_semaphore = asyncio.Semaphore(INGESTION_CONCURRENCY)
+ingestion_jobs: Dict[str, asyncio.Task] = {}  # file_id: running job
+preloaded_keys: "OrderedDict[str, str]" = OrderedDict()  # file_id: key it was uploaded on, most recent last
+
+
+async def _download(file_id: str, path: str):
+    logger.info(f"Downloading {file_id}")
+    await bot.download(file_id, path)
+
+
 async def _download_if_necessary(file_id: str):
-    if not os.path.exists(cache_path + file_id):
-        logger.info(f"Downloading {file_id}")
-        await bot.download(file_id, cache_path + file_id)
+    await media_cache.fetch(file_id, lambda path: _download(file_id, path))
 
 
-async def get_other_media(message: Message, gemini_token: str, all_messages: List[Record]) -> Dict[str, str] or None:
-    file_id = await get_file_id_from_chain(
+async def get_other_media_file_id(message: Message, all_messages: List[Record]) -> Optional[str]:
+    return await get_file_id_from_chain(
         message.message_id,
         all_messages,
         "other",
         int(await db.get_chat_parameter(message.chat.id, "media_context_max_depth"))
     )
 
+
+async def _ingest(message: Message, file_id: str, media_type: str) -> None:
+    from .google import get_routing_tier, key_manager  # Imported here because of a circular import
+
+    async with ingestion_semaphore:
+        try:
+            if media_type != "other":
+                await _download_if_necessary(file_id)
+                return  # Photos are sent inline, having them on disk is all the preparation they need
+            # Picked the way the request about the file will pick it, so that the upload can be reused there.
+            # The upload isn't a generation, so it isn't counted against the model's quota.
+            key = await key_manager.get_api_key(model=await db.get_chat_parameter(message.chat.id, "g_model"),
+                                                tier=await get_routing_tier(message), with_file=True, count=False)
+            if await _upload(file_id, key):
+                preloaded_keys[file_id] = key
+                preloaded_keys.move_to_end(file_id)
+                if len(preloaded_keys) > PRELOADED_KEYS_SIZE:
+                    preloaded_keys.popitem(last=False)
+        except Exception as e:
+            logger.warning(f"Failed to preload {file_id}: {e}")
+
+
+def start_ingestion(message: Message, file_id: str, media_type: str) -> None:
+    """
+    Downloads (and for documents, audio and video, uploads to the File API) a file in the background,
+    so that it's ready by the time someone asks about it
+    """
+    if file_id in ingestion_jobs or file_id in preloaded_keys:
+        return
+    job = asyncio.create_task(_ingest(message, file_id, media_type))
+    ingestion_jobs[file_id] = job
+    job.add_done_callback(lambda _: ingestion_jobs.pop(file_id, None))
+
+
+async def wait_for_ingestion(file_id: str) -> None:
+    job = ingestion_jobs.get(file_id)
+    if job:
+        # Shielded, so that a cancelled generation doesn't cancel the job for everyone else
+        await asyncio.shield(job)
+
+
+def get_preloaded_key(file_id: str) -> Optional[str]:
+    """The key a file was uploaded on in the background, using it for the request makes the upload reusable"""
+    return preloaded_keys.get(file_id)
+
+
+@alru_cache(maxsize=1024)
+async def get_content_hash(file_id: str) -> str:
+    """Hash of a file's content. Files uploaded before are looked up, so they don't need to be downloaded again."""
+    try:
+        content_hash = await db.get_uploaded_content_hash(file_id)
+    except Exception as e:
+        logger.warning(f"Failed to look up the content hash of {file_id}: {e}")
+        content_hash = None
+    if content_hash:
+        return content_hash
+
+    def hash_file() -> str:
+        digest = hashlib.sha256()
+        with open(cache_path + file_id, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    await _download_if_necessary(file_id)
+    return await asyncio.to_thread(hash_file)
+
+
+def _get_upload_owner(gemini_token: str) -> str:
+    """Uploads are shared by all keys of a project. The key itself isn't stored, only its hash."""
+    from .google import key_manager  # Imported here because of a circular import
+
+    group = key_manager.get_key_group(gemini_token)
+    if group:
+        return f"project:{group}"
+    return f"key:{hashlib.sha256(gemini_token.encode()).hexdigest()[:16]}"
+
+
+async def upload_other_media(file_id: str, gemini_token: str) -> Dict[str, str] or None:
+    """
+    Uploads a file to the File API. Uploaded files are only visible to the project of the key
+    that uploaded them, so this is the only key-bound part of a prompt.
+    Uploads are remembered by content and project, and reused while they are valid.
+    """
     if file_id:
-        await _download_if_necessary(file_id)
+        await wait_for_ingestion(file_id)
+        return await _upload(file_id, gemini_token)
+
+
+async def _upload(file_id: str, gemini_token: str) -> Dict[str, str] or None:
+    with media_cache.pinned(file_id):
+        return await _upload_cached_file(file_id, gemini_token)
+
+
+async def _upload_cached_file(file_id: str, gemini_token: str) -> Dict[str, str] or None:
+    if file_id:
+        content_hash = await get_content_hash(file_id)
+        owner = _get_upload_owner(gemini_token)
+        try:
+            cached_upload = await db.get_cached_upload(content_hash, owner, UPLOAD_REUSE_MARGIN)
+        except Exception as e:
+            logger.warning(f"Failed to look up a cached upload of {file_id}: {e}")
+            cached_upload = None
+        if cached_upload:
+            logger.info(f"Reusing the upload of {file_id} on token ...{gemini_token[-6:]}")
+            return {
+                "mime_type": cached_upload["mime_type"],
+                "uri": cached_upload["uri"],
+            }
 
+        await _download_if_necessary(file_id)
         try:
             mime_type = magic.from_file(cache_path + file_id, mime=True)
         except Exception as e:
@@ -66,49 +192,57 @@ async def get_other_media(message: Message, gemini_token: str, all_messages: Lis
             }
         }
 
-        async with aiohttp.ClientSession() as session:
+        session = session_manager.get_session()
+        async with session.post(
+                f"{API_BASE_URL}/upload/v1beta/files?key={gemini_token}",
+                headers=session_headers,
+                json=data
+        ) as response:
+            upload_headers = response.headers
+            upload_url = upload_headers.get("X-Goog-Upload-URL")
+
+        if upload_url:
             async with session.post(
-                    f"https://generativelanguage.googleapis.com/upload/v1beta/files?key={gemini_token}",
-                    headers=session_headers,
-                    json=data,
-                    proxy=os.getenv("PROXY_URL")
+                    upload_url,
+                    headers={
+                        "Content-Length": str(os.path.getsize(cache_path + file_id)),
+                        "X-Goog-Upload-Offset": "0",
+                        "X-Goog-Upload-Command": "upload, finalize"
+                    },
+                    data=open(cache_path + file_id, "rb")
             ) as response:
-                upload_headers = response.headers
-                upload_url = upload_headers.get("X-Goog-Upload-URL")
-
-            if upload_url:
-                async with session.post(
-                        upload_url,
-                        headers={
-                            "Content-Length": str(os.path.getsize(cache_path + file_id)),
-                            "X-Goog-Upload-Offset": "0",
-                            "X-Goog-Upload-Command": "upload, finalize"
-                        },
-                        data=open(cache_path + file_id, "rb"),
-                        proxy=os.getenv("PROXY_URL")
-                ) as response:
-                    upload_result = await response.json()
-
-                logger.info("Waiting for the file to become available...")
-                sleep_time = 0.25
-                total_sleep_time = 0
-                max_sleep_time = 7
-                while total_sleep_time < max_sleep_time:
-                    await asyncio.sleep(sleep_time)
-                    async with session.get(upload_result['file']['uri'] + f"?key={gemini_token}",
-                                           proxy=os.getenv("PROXY_URL")) as response:
-                        decoded_response = await response.json()
-                        if decoded_response['state'] == "ACTIVE":
-                            break
-                    total_sleep_time += sleep_time
-
-                if total_sleep_time > 1:
-                    logger.warning(f"Waited for {total_sleep_time}s for the file to process")
-
-                return {
-                    "mime_type": mime_type,
-                    "uri": upload_result['file']['uri'],
-                }
+                upload_result = await response.json()
+
+            uploaded_at = datetime.datetime.now(datetime.timezone.utc)
+            logger.info("Waiting for the file to become available...")
+            sleep_time = 0.25
+            total_sleep_time = 0
+            max_sleep_time = 7
+            active = False
+            while total_sleep_time < max_sleep_time:
+                await asyncio.sleep(sleep_time)
+                async with session.get(upload_result['file']['uri'] + f"?key={gemini_token}") as response:
+                    decoded_response = await response.json()
+                    if decoded_response['state'] == "ACTIVE":
+                        active = True
+                        break
+                total_sleep_time += sleep_time
+
+            if total_sleep_time > 1:
+                logger.warning(f"Waited for {total_sleep_time}s for the file to process")
+
+            # Only files known to be ready are reused, so that a hit never has to wait
+            if active:
+                try:
+                    await db.save_cached_upload(content_hash, owner, upload_result['file']['uri'], mime_type,
+                                                uploaded_at + UPLOAD_LIFETIME, file_id)
+                except Exception as e:
+                    logger.warning(f"Failed to cache the upload of {file_id}: {e}")
+
+            return {
+                "mime_type": mime_type,
+                "uri": upload_result['file']['uri'],
+            }
 
 
 async def get_photo(message: Message, all_messages: List[Record]) -> str:
@@ -120,10 +254,12 @@ async def get_photo(message: Message, all_messages: List[Record]) -> str:
     )
 
     if photo_file_id:
-        await _download_if_necessary(photo_file_id)
-        with open(cache_path + photo_file_id, "rb") as f:
-            try:
-                result = base64.b64encode(f.read()).decode("utf-8")
-            except Exception as exc:
-                traceback.print_exc()
+        await wait_for_ingestion(photo_file_id)
+        with media_cache.pinned(photo_file_id):
+            await _download_if_necessary(photo_file_id)
+            with open(cache_path + photo_file_id, "rb") as f:
+                try:
+                    result = base64.b64encode(f.read()).decode("utf-8")
+                except Exception as exc:
+                    traceback.print_exc()
         return result
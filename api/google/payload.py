@@ -0,0 +1,122 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.types import Message
+from asyncpg import Record
+from loguru import logger
+
+from .media import upload_other_media
+from .prompts import _attach_file, _prepare_prompt
+
+SAFETY_CATEGORIES = ["HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_HARASSMENT",
+                     "HARM_CATEGORY_DANGEROUS_CONTENT", "HARM_CATEGORY_CIVIC_INTEGRITY"]
+
+
+class CompiledRequest:
+    """
+    A generation request built once and reused for every attempt.
+    Everything except File API uploads is key-independent and is serialized a single time.
+    Uploads are bound to the project of the key, so they are done (and the body serialized)
+    once per key that actually gets used.
+    """
+
+    def __init__(self, data: dict, file_id: Optional[str], tool_settings: Tuple[bool, bool, float],
+                 uploads: Dict[str, Optional[dict]] = None):
+        self.data = data
+        self.file_id = file_id
+        self.tool_settings = tool_settings  # code_execution, grounding, grounding_threshold
+
+        self._serialized: Optional[bytes] = None
+        self._uploads = {} if uploads is None else uploads  # key: uploaded file, shared with other models
+        self._key_bound_data: Dict[str, dict] = {}
+        self._key_bound_serialized: Dict[str, bytes] = {}
+
+    def for_model(self, model_name: str) -> "CompiledRequest":
+        """The same request for another model. Only the tools depend on the model, the prompt and uploads are reused."""
+        data = dict(self.data)
+        tools = _get_tools(model_name, *self.tool_settings)
+        if tools:
+            data["tools"] = tools
+        else:
+            data.pop("tools", None)
+        return CompiledRequest(data, self.file_id, self.tool_settings, self._uploads)
+
+    async def get_data(self, key: str) -> dict:
+        if not self.file_id:
+            return self.data
+
+        if key not in self._key_bound_data:
+            if key not in self._uploads:
+                self._uploads[key] = await upload_other_media(self.file_id, key)
+                if not self._uploads[key]:
+                    logger.warning(f"Failed to upload {self.file_id}, sending the prompt without it")
+            data = self.data
+            if self._uploads[key]:
+                data = dict(self.data)
+                data["contents"] = _attach_file(self.data["contents"], self._uploads[key])
+            self._key_bound_data[key] = data
+        return self._key_bound_data[key]
+
+    async def get_body(self, key: str) -> bytes:
+        if not self.file_id:
+            if self._serialized is None:
+                self._serialized = json.dumps(self.data).encode("utf-8")
+            return self._serialized
+
+        if key not in self._key_bound_serialized:
+            self._key_bound_serialized[key] = json.dumps(await self.get_data(key)).encode("utf-8")
+        return self._key_bound_serialized[key]
+
+
+async def compile_request(trigger_message: Message, messages: List[Record], system_prompt: dict, model_name: str,
+                          temperature: float, top_p: float, top_k: int, max_output_tokens: int, code_execution: bool,
+                          safety_threshold: str, grounding: bool, grounding_threshold: float) -> CompiledRequest:
+    contents, file_id = await _prepare_prompt(trigger_message, messages)
+
+    safety_settings = []
+    for safety_setting in SAFETY_CATEGORIES:
+        safety_settings.append({
+            "category": safety_setting,
+            "threshold": "BLOCK_" + safety_threshold.upper()
+        })
+
+    data = {
+        "contents": contents,
+        "safetySettings": safety_settings,
+        "generationConfig": {
+            "temperature": temperature,
+            "topP": top_p,
+            "topK": top_k,
+            "maxOutputTokens": max_output_tokens,
+        }
+    }
+    if system_prompt:
+        data["system_instruction"] = system_prompt
+
+    tools = _get_tools(model_name, code_execution, grounding, grounding_threshold)
+    if tools:
+        data["tools"] = tools
+
+    return CompiledRequest(data, file_id, (code_execution, grounding, grounding_threshold))
+
+
+def _get_tools(model_name: str, code_execution: bool, grounding: bool, grounding_threshold: float) -> Optional[list]:
+    tools = None
+    if code_execution:
+        tools = [{'code_execution': {}}]
+
+    if grounding:
+        if "2.0" in model_name:
+            tools = [{
+                "googleSearch": {}
+            }]
+        else:
+            tools = [{
+                "googleSearchRetrieval": {
+                    "dynamic_retrieval_config": {
+                        "mode": "MODE_DYNAMIC",
+                        "dynamic_threshold": grounding_threshold,
+                    }
+                }
+            }]
+    return tools
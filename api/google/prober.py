@@ -0,0 +1,137 @@
+import asyncio
+import os
+import time
+from typing import Dict, Optional, Set
+
+import aiohttp
+from loguru import logger
+
+from .keys import BILLING_POOL, ApiKeyManager
+from .retry import classify_response, get_exhaustion_cooldown
+from .sessions import API_BASE_URL, session_manager
+
+PROBE_INTERVAL = float(os.getenv("GEMINI_PROBE_INTERVAL", 600))  # in seconds, 0 disables probing
+PROBE_CONCURRENCY = int(os.getenv("GEMINI_PROBE_CONCURRENCY", 4))
+PROBE_BATCH = int(os.getenv("GEMINI_PROBE_BATCH", 50))  # Keys per round
+PROBE_MODEL = os.getenv("GEMINI_PROBE_MODEL", "gemini-1.5-flash")
+PROBE_TIMEOUT = 15
+
+
+class KeyProber:
+    """
+    Periodically checks keys that nothing else would check soon:
+    never used keys get a models list request, which costs no quota and reveals invalid keys,
+    and keys exhausted without a known cooldown get a one-token generation of the exhausted model,
+    since only that tells whether their generation quota is back.
+    """
+
+    def __init__(self, manager: ApiKeyManager):
+        self.manager = manager
+        self.probed_at: Dict[str, float] = {}
+        self.validated: Set[str] = set()  # Keys that passed a validity check and don't need another one
+        self.semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+        self.last_round: Optional[dict] = None
+
+    def _pick_keys(self):
+        now = time.time()
+
+        def due(key):
+            return now - self.probed_at.get(key, 0) >= PROBE_INTERVAL
+
+        # A key can be in several pools, but is probed once. The keys of a project are exhausted
+        # for a model together, and come back together, so one of them is enough for the whole project.
+        exhausted = {}  # (key or project, billing, model): (key, billing, model)
+        active = {}
+        for name, pool in self.manager.pools.items():
+            is_billing = name == BILLING_POOL
+            for key in pool.exhausted:
+                if due(key):
+                    exhausted.setdefault((key, is_billing, None), (key, is_billing, None))
+            for key, model in pool.model_guessed:
+                if due(key):
+                    owner = self.manager.get_key_group(key) or key
+                    exhausted.setdefault((owner, is_billing, model), (key, is_billing, model))
+            if not is_billing:
+                active.update(dict.fromkeys(pool.active.keys))
+        exhausted = list(exhausted.values())
+
+        unused = [
+            (key, False) for key in active
+            if key not in self.manager.health.keys and key not in self.validated and due(key)
+        ]
+        return exhausted[:PROBE_BATCH], unused[:max(0, PROBE_BATCH - len(exhausted))]
+
+    async def _request(self, method: str, url: str, key: str, body: dict = None):
+        async with self.semaphore:
+            async with session_manager.get_session().request(
+                    method,
+                    url,
+                    headers={"Content-Type": "application/json", "x-goog-api-key": key},
+                    json=body,
+                    timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)
+            ) as response:
+                try:
+                    decoded_response = await response.json()
+                except Exception:
+                    decoded_response = {}
+                return response.status, decoded_response
+
+    async def _probe(self, key: str, is_billing: bool, exhausted: bool, model: Optional[str] = None) -> str:
+        """`model` is the model the key is exhausted for, if only for one"""
+        self.probed_at[key] = time.time()
+        if exhausted:
+            status, decoded_response = await self._request(
+                "POST", f"{API_BASE_URL}/v1beta/models/{model or PROBE_MODEL}:generateContent", key, {
+                    "contents": [{"role": "user", "parts": [{"text": "Hi"}]}],
+                    "generationConfig": {"maxOutputTokens": 1}
+                }
+            )
+        else:
+            status, decoded_response = await self._request("GET", f"{API_BASE_URL}/v1beta/models?pageSize=1", key)
+
+        reason = classify_response(status, decoded_response)
+        if reason is None:
+            if exhausted:
+                self.manager.reactivate_key(key, is_billing, model)
+                return "reactivated"
+            self.validated.add(key)
+            return "ok"
+        # Only an invalid key is gone for good, a denial may be about the model or the region,
+        # and requests only rotate away from it too
+        if reason == "API_KEY_INVALID":
+            self.manager.remove_key_permanently(key, is_billing)
+            return "invalid"
+        if reason == "RESOURCE_EXHAUSTED" and exhausted:
+            self.manager.timeout_key(key, is_billing, model,
+                                     get_exhaustion_cooldown(decoded_response.get("error", {})))
+        return "failed"
+
+    async def run_round(self) -> dict:
+        exhausted, unused = self._pick_keys()
+        probes = [(key, is_billing, True, model) for key, is_billing, model in exhausted] + \
+                 [(key, is_billing, False, None) for key, is_billing in unused]
+        results = await asyncio.gather(*[self._probe(*probe) for probe in probes], return_exceptions=True)
+
+        summary = {"probed": len(probes), "ok": 0, "reactivated": 0, "invalid": 0, "failed": 0,
+                   "finished_at": time.time()}
+        for (key, _, _, _), result in zip(probes, results):
+            if isinstance(result, Exception):
+                logger.debug(f"Failed to probe key {key[-6:]}: {result}")
+                result = "failed"
+            summary[result] += 1
+
+        if probes:
+            logger.info(f"Probed {summary['probed']} keys: {summary['reactivated']} reactivated, "
+                        f"{summary['invalid']} invalid, {summary['failed']} failed")
+        self.last_round = summary
+        return summary
+
+    async def run(self):
+        if not PROBE_INTERVAL:
+            return
+        while True:
+            await asyncio.sleep(PROBE_INTERVAL)
+            try:
+                await self.run_round()
+            except Exception as e:
+                logger.error(f"Key probing round failed: {e}")
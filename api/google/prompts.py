@@ -1,10 +1,10 @@
 import os
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 from aiogram.types import Message
 from asyncpg import Record
 
-from api.google.media import get_other_media, get_photo
+from api.google.media import get_other_media_file_id, get_photo
 
 bot_id = int(os.getenv("TELEGRAM_TOKEN").split(":")[0])
 
@@ -36,7 +36,12 @@ async def format_message_for_prompt(message: Record, add_reply_to: bool = True)
     return result
 
 
-async def _prepare_prompt(trigger_message: Message, chat_messages: List[Record], token: str) -> List[Dict]:
+async def _prepare_prompt(trigger_message: Message, chat_messages: List[Record]) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Builds the key-independent part of the prompt.
+    Returns the contents (with the photo inlined, if there is one) and the file id of a document
+    that still has to be attached with `_attach_file` after uploading it on the key that will be used.
+    """
     result = []
     message_buffer = []
     current_role = None
@@ -106,10 +111,8 @@ async def _prepare_prompt(trigger_message: Message, chat_messages: List[Record],
                 }],
             })
 
-    # Handle images and other media files
+    # Handle images and other media files. Photos take priority.
     image = await get_photo(trigger_message, chat_messages)
-    other_file = await get_other_media(trigger_message, token, chat_messages)
-
     if image:
         last_message = result[-1]
         parts = last_message["parts"]
@@ -123,21 +126,23 @@ async def _prepare_prompt(trigger_message: Message, chat_messages: List[Record],
             "role": last_message["role"],
             "parts": parts
         }
-    elif other_file:
-        last_message = result[-1]
-        parts = last_message["parts"]
-        parts.append({
+        return result, None
+
+    return result, await get_other_media_file_id(trigger_message, chat_messages)
+
+
+def _attach_file(contents: List[Dict], uploaded_file: Dict[str, str]) -> List[Dict]:
+    """Returns a copy of the contents with an uploaded file added to the last block"""
+    last_message = contents[-1]
+    return contents[:-1] + [{
+        "role": last_message["role"],
+        "parts": last_message["parts"] + [{
             "file_data": {
-                "mime_type": other_file["mime_type"],
-                "file_uri": other_file["uri"]
+                "mime_type": uploaded_file["mime_type"],
+                "file_uri": uploaded_file["uri"]
             }
-        })
-        result[-1] = {
-            "role": last_message["role"],
-            "parts": parts
-        }
-
-    return result
+        }]
+    }]
 
 
 async def get_system_messages(chat_messages: List[Record]) -> List[str]:
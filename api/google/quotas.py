@@ -0,0 +1,141 @@
+import os
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Optional, Tuple
+
+from loguru import logger
+
+# family=RPM/TPM/RPD, comma-separated. A model belongs to the longest family name it contains.
+DEFAULT_KEY_LIMITS = "flash=15/1000000/1500, pro=2/32000/50, 2.0-flash=10/4000000/1500, thinking=10/4000000/1500"
+DEFAULT_BILLING_KEY_LIMITS = ""  # Pay-as-you-go limits are high enough not to be tracked by default
+
+
+class TokenBucket:
+    """Holds up to `capacity` tokens and refills at `capacity` per `period` seconds. May go into debt."""
+
+    def __init__(self, capacity: float, period: float, clock: Callable[[], float] = time.monotonic):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.clock = clock
+        self.updated_at = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+    def fill_level(self) -> float:
+        return max(0.0, self.available() / self.capacity)
+
+
+class KeyQuota:
+    """Requests per minute, tokens per minute and requests per day of one key for one model family"""
+
+    def __init__(self, rpm: int, tpm: int, rpd: int, clock: Callable[[], float] = time.monotonic):
+        self.rpm = TokenBucket(rpm, 60, clock)
+        self.tpm = TokenBucket(tpm, 60, clock)
+        self.rpd = TokenBucket(rpd, 86400, clock)
+
+    def has_capacity(self) -> bool:
+        return self.rpm.available() >= 1 and self.rpd.available() >= 1 and self.tpm.available() > 0
+
+    def fill_level(self) -> float:
+        return min(self.rpm.fill_level(), self.tpm.fill_level(), self.rpd.fill_level())
+
+
+def parse_limits(value: str) -> Dict[str, Tuple[int, int, int]]:
+    limits = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        try:
+            family, numbers = entry.split("=")
+            rpm, tpm, rpd = (int(number) for number in numbers.split("/"))
+        except ValueError:
+            logger.error(f"Ignoring malformed key limit '{entry.strip()}', expected family=RPM/TPM/RPD")
+            continue
+        limits[family.strip()] = (rpm, tpm, rpd)
+    return limits
+
+
+KEY_LIMITS = parse_limits(os.getenv("GEMINI_KEY_LIMITS", DEFAULT_KEY_LIMITS))
+BILLING_KEY_LIMITS = parse_limits(os.getenv("GEMINI_BILLING_KEY_LIMITS", DEFAULT_BILLING_KEY_LIMITS))
+
+
+def get_model_family(model: str, limits: Dict[str, Tuple[int, int, int]]) -> Optional[str]:
+    matching_families = [family for family in limits if family in model]
+    return max(matching_families, key=len) if matching_families else None
+
+
+class QuotaTracker:
+    """
+    Keeps per-key quota buckets for every model family the key has been used with.
+    Keys whose family has no configured limits are never considered out of capacity.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.billing_keys = set()
+        self.quotas: Dict[str, Dict[str, KeyQuota]] = defaultdict(dict)  # key: {family: quota}
+        self.families: Dict[Tuple[str, bool], Optional[str]] = {}  # (model, is billing): family
+
+    def _get_quota(self, key: str, model: str) -> Optional[KeyQuota]:
+        is_billing = key in self.billing_keys
+        limits = BILLING_KEY_LIMITS if is_billing else KEY_LIMITS
+        if (model, is_billing) not in self.families:
+            self.families[(model, is_billing)] = get_model_family(model, limits)
+        family = self.families[(model, is_billing)]
+        if family is None:
+            return None
+
+        key_quotas = self.quotas[key]
+        if family not in key_quotas:
+            key_quotas[family] = KeyQuota(*limits[family], clock=self.clock)
+        return key_quotas[family]
+
+    def has_capacity(self, key: str, model: str) -> bool:
+        quota = self._get_quota(key, model)
+        return quota is None or quota.has_capacity()
+
+    def fill_level(self, key: str, model: str) -> float:
+        quota = self._get_quota(key, model)
+        return 1.0 if quota is None else quota.fill_level()
+
+    def record_request(self, key: str, model: str, count: int = 1) -> None:
+        quota = self._get_quota(key, model)
+        if quota:
+            quota.rpm.consume(count)
+            quota.rpd.consume(count)
+
+    def record_tokens(self, key: str, model: str, tokens: int) -> None:
+        quota = self._get_quota(key, model)
+        if quota and tokens:
+            quota.tpm.consume(tokens)
+
+    def forget_key(self, key: str) -> None:
+        self.quotas.pop(key, None)
+
+    def get_fill_levels(self) -> Dict[str, dict]:
+        """Average bucket fill levels per model family, over the keys that have been used with it"""
+        totals = defaultdict(lambda: {"keys": 0, "rpm": 0.0, "tpm": 0.0, "rpd": 0.0, "out_of_capacity": 0})
+        for family, quota in (item for key_quotas in self.quotas.values() for item in key_quotas.items()):
+            total = totals[family]
+            total["keys"] += 1
+            total["rpm"] += quota.rpm.fill_level()
+            total["tpm"] += quota.tpm.fill_level()
+            total["rpd"] += quota.rpd.fill_level()
+            total["out_of_capacity"] += not quota.has_capacity()
+
+        for total in totals.values():
+            for bucket in ["rpm", "tpm", "rpd"]:
+                total[bucket] /= total["keys"]
+        return dict(totals)
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+
+MAX_KEY_ROTATIONS = int(os.getenv("MAX_KEY_ROTATION_ATTEMPTS"))
+REQUEST_DEADLINE = float(os.getenv("GEMINI_REQUEST_DEADLINE", 300))  # in seconds, for all attempts together
+
+try:
+    from zoneinfo import ZoneInfo
+    PACIFIC_TIME = ZoneInfo("America/Los_Angeles")
+except Exception:  # No tz database on the system
+    PACIFIC_TIME = timezone(timedelta(hours=-8))
+
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 20.0
+
+
+class RetryAction(Enum):
+    RETRY = "retry"  # Same key, right away
+    ROTATE_KEY = "rotate_key"
+    BACKOFF = "backoff"  # Same request after a jittered delay
+    SWITCH_MODEL = "switch_model"
+    FAIL = "fail"
+
+
+@dataclass
+class RetryDecision:
+    action: RetryAction
+    reason: str
+    delay: float = 0.0
+
+
+# reason: (action, how many times it may be retried within one request)
+POLICY: Dict[str, Tuple[RetryAction, int]] = {
+    "RESOURCE_EXHAUSTED": (RetryAction.ROTATE_KEY, MAX_KEY_ROTATIONS),
+    "API_KEY_INVALID": (RetryAction.ROTATE_KEY, MAX_KEY_ROTATIONS),
+    "PERMISSION_DENIED": (RetryAction.ROTATE_KEY, 2),
+    "CENSORED": (RetryAction.RETRY, 3),
+    "CACHE_REJECTED": (RetryAction.RETRY, 1),
+    "UNAVAILABLE": (RetryAction.BACKOFF, 3),
+    "INTERNAL": (RetryAction.BACKOFF, 2),
+    "DEADLINE_EXCEEDED": (RetryAction.BACKOFF, 2),
+    "HTTP_5XX": (RetryAction.BACKOFF, 3),
+    "TIMEOUT": (RetryAction.BACKOFF, 2),
+    "CONNECTION": (RetryAction.BACKOFF, 3),
+    "MODEL_NOT_FOUND": (RetryAction.SWITCH_MODEL, 1),
+}
+
+retry_counts = Counter()  # reason: retries done
+failure_counts = Counter()  # reason: requests given up on
+
+
+def get_retry_delay(error: dict) -> Optional[float]:
+    """Extracts the delay suggested by google.rpc.RetryInfo, if the error has one"""
+    for detail in error.get("details", []):
+        if detail.get("@type", "").endswith("google.rpc.RetryInfo") and detail.get("retryDelay"):
+            try:
+                return float(detail["retryDelay"].rstrip("s"))
+            except ValueError:
+                return None
+    return None
+
+
+def get_exhaustion_cooldown(error: dict) -> Optional[float]:
+    """
+    Tells how long a key stays exhausted for the model, from the QuotaFailure and RetryInfo details.
+    Daily quotas reset at midnight Pacific time, per-minute ones after the suggested delay.
+    Returns None if the error doesn't say.
+    """
+    quota_ids = [
+        violation.get("quotaId", "")
+        for detail in error.get("details", []) if detail.get("@type", "").endswith("google.rpc.QuotaFailure")
+        for violation in detail.get("violations", [])
+    ]
+    if any("PerDay" in quota_id for quota_id in quota_ids):
+        now = datetime.now(PACIFIC_TIME)
+        next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=PACIFIC_TIME)
+        return (next_midnight - now).total_seconds()
+
+    retry_delay = get_retry_delay(error)
+    if retry_delay is not None:
+        return retry_delay
+    if any("PerMinute" in quota_id for quota_id in quota_ids):
+        return 60.0
+    return None
+
+
+def classify_response(status: int, response: dict, using_context_cache: bool = False) -> Optional[str]:
+    """Returns the reason a response should be considered failed, or None if it's fine"""
+    if status == 200 and "error" not in response:
+        if response.get("promptFeedback", {}).get("blockReason", "") in ["OTHER", "PROHIBITED_CONTENT"]:
+            return "CENSORED"
+        return None
+
+    error = response.get("error", {})
+    error_status = error.get("status", "")
+
+    if using_context_cache and "cache" in error.get("message", "").lower():
+        return "CACHE_REJECTED"
+    if any(detail.get("reason") == "API_KEY_INVALID" for detail in error.get("details", [])):
+        return "API_KEY_INVALID"
+    if error_status == "NOT_FOUND" and "model" in error.get("message", "").lower():
+        return "MODEL_NOT_FOUND"
+    if error_status:
+        return error_status
+    if status >= 500:
+        return "HTTP_5XX"
+    return f"HTTP_{status}"
+
+
+def classify_exception(exception: BaseException) -> Optional[str]:
+    if isinstance(exception, asyncio.TimeoutError):
+        return "TIMEOUT"
+    if isinstance(exception, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, ConnectionResetError)):
+        return "CONNECTION"
+    return None
+
+
+class RetryState:
+    """Keeps track of the retries of a single request and decides what to do after each failure"""
+
+    def __init__(self, deadline: float = REQUEST_DEADLINE):
+        self.deadline = time.monotonic() + deadline
+        self.attempts = Counter()
+        self.rotations = 0
+
+    def time_left(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def decide(self, reason: str, error: dict) -> RetryDecision:
+        action, max_retries = POLICY.get(reason, (RetryAction.FAIL, 0))
+
+        self.attempts[reason] += 1
+        if self.attempts[reason] > max_retries:
+            action = RetryAction.FAIL
+        if action == RetryAction.ROTATE_KEY:
+            self.rotations += 1
+            if self.rotations > MAX_KEY_ROTATIONS:
+                action = RetryAction.FAIL
+
+        delay = 0.0
+        if action == RetryAction.BACKOFF:
+            suggested_delay = get_retry_delay(error)
+            if suggested_delay is not None:
+                delay = suggested_delay
+            else:
+                delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (self.attempts[reason] - 1)))
+
+        if action != RetryAction.FAIL and delay >= self.time_left():
+            action = RetryAction.FAIL
+
+        if action == RetryAction.FAIL:
+            failure_counts[reason] += 1
+        else:
+            retry_counts[reason] += 1
+        return RetryDecision(action, reason, delay)
@@ -0,0 +1,113 @@
+import os
+from collections import defaultdict
+from typing import Dict
+
+import aiohttp
+from aiohttp_socks import ProxyConnector
+from loguru import logger
+
+API_BASE_URL = os.getenv("GEMINI_API_URL", "https://generativelanguage.googleapis.com").rstrip("/")
+
+POOL_LIMIT = int(os.getenv("GEMINI_POOL_LIMIT", 100))
+POOL_LIMIT_PER_HOST = int(os.getenv("GEMINI_POOL_LIMIT_PER_HOST", 50))
+DNS_CACHE_TTL = int(os.getenv("GEMINI_DNS_CACHE_TTL", 300))
+KEEPALIVE_TIMEOUT = int(os.getenv("GEMINI_KEEPALIVE_TIMEOUT", 60))
+
+
+class SessionManager:
+    """
+    Keeps one long-lived aiohttp session per outgoing route (direct, PROXY_URL, GROUNDING_PROXY_URL),
+    so Gemini API requests reuse already established keep-alive connections instead of
+    doing a new TCP + TLS (+ proxy) handshake every time.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._stats = defaultdict(lambda: defaultdict(int))
+
+    @staticmethod
+    def _resolve_proxy(grounding: bool) -> str | None:
+        if grounding and os.getenv("GROUNDING_PROXY_URL"):
+            return os.getenv("GROUNDING_PROXY_URL")
+        return os.getenv("PROXY_URL") or None
+
+    @staticmethod
+    def _route_name(proxy_url: str | None, grounding: bool) -> str:
+        if not proxy_url:
+            return "direct"
+        return "grounding" if grounding and os.getenv("GROUNDING_PROXY_URL") else "proxy"
+
+    def _trace_config(self, route: str) -> aiohttp.TraceConfig:
+        stats = self._stats[route]
+
+        async def on_request_start(session, context, params):
+            stats["requests"] += 1
+
+        async def on_connection_create_end(session, context, params):
+            stats["connections_created"] += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            stats["connections_reused"] += 1
+
+        async def on_dns_cache_hit(session, context, params):
+            stats["dns_cache_hits"] += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        return trace_config
+
+    @staticmethod
+    def _create_connector(proxy_url: str | None) -> aiohttp.BaseConnector:
+        connector_args = {
+            "limit": POOL_LIMIT,
+            "limit_per_host": POOL_LIMIT_PER_HOST,
+            "ttl_dns_cache": DNS_CACHE_TTL,
+            "keepalive_timeout": KEEPALIVE_TIMEOUT,
+        }
+        if proxy_url:
+            return ProxyConnector.from_url(proxy_url, **connector_args)
+        return aiohttp.TCPConnector(**connector_args)
+
+    def get_session(self, grounding: bool = False) -> aiohttp.ClientSession:
+        """
+        Returns the shared session for the route a request should take.
+        Must be called from within the running event loop.
+        """
+        proxy_url = self._resolve_proxy(grounding)
+        route = self._route_name(proxy_url, grounding)
+
+        session = self._sessions.get(route)
+        if session is None or session.closed:
+            logger.info(f"GOOGLE | Opening a pooled HTTP session for the {route} route")
+            session = aiohttp.ClientSession(
+                connector=self._create_connector(proxy_url),
+                trace_configs=[self._trace_config(route)]
+            )
+            self._sessions[route] = session
+        return session
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        result = {}
+        for route, stats in self._stats.items():
+            session = self._sessions.get(route)
+            result[route] = {
+                "requests": stats["requests"],
+                "connections_created": stats["connections_created"],
+                "connections_reused": stats["connections_reused"],
+                "dns_cache_hits": stats["dns_cache_hits"],
+                "open": session is not None and not session.closed,
+            }
+        return result
+
+    async def close(self) -> None:
+        for route, session in self._sessions.items():
+            if not session.closed:
+                await session.close()
+                logger.info(f"GOOGLE | Closed the pooled HTTP session for the {route} route")
+        self._sessions.clear()
+
+
+session_manager = SessionManager()
@@ -0,0 +1,78 @@
+import json
+from typing import Awaitable, Callable, Dict, List
+
+from aiohttp import ClientResponse
+from loguru import logger
+
+PartialCallback = Callable[[str], Awaitable[None]]
+
+
+def _merge_parts(merged_parts: List[Dict], new_parts: List[Dict]) -> None:
+    """
+    Glues streamed text parts back together. Consecutive text parts of the same kind
+    (regular answer or thoughts) are concatenated, everything else is appended as is.
+    """
+    for part in new_parts:
+        if "text" in part and merged_parts and "text" in merged_parts[-1] \
+                and merged_parts[-1].get("thought") == part.get("thought"):
+            merged_parts[-1]["text"] += part["text"]
+        else:
+            merged_parts.append(dict(part))
+
+
+def _merge_chunk(merged: Dict, chunk: Dict) -> None:
+    if "promptFeedback" in chunk and "promptFeedback" not in merged:
+        merged["promptFeedback"] = chunk["promptFeedback"]
+    if "usageMetadata" in chunk:
+        merged["usageMetadata"] = chunk["usageMetadata"]
+    if "citationSources" in chunk:
+        merged["citationSources"] = chunk["citationSources"]
+
+    for candidate in chunk.get("candidates", []):
+        if "candidates" not in merged:
+            merged["candidates"] = [{"content": {"role": "model", "parts": []}}]
+        merged_candidate = merged["candidates"][0]
+
+        _merge_parts(merged_candidate["content"]["parts"], candidate.get("content", {}).get("parts", []))
+        for field, value in candidate.items():
+            if field != "content":
+                merged_candidate[field] = value
+
+
+def get_visible_text(merged: Dict) -> str:
+    """Returns the answer text accumulated so far, without the model's thoughts"""
+    try:
+        parts = merged["candidates"][0]["content"]["parts"]
+    except (KeyError, IndexError):
+        return ""
+    return "".join(part["text"] for part in parts if "text" in part and not part.get("thought"))
+
+
+async def read_stream(request_id: int, response: ClientResponse, on_partial: PartialCallback) -> Dict:
+    """
+    Reads a `streamGenerateContent?alt=sse` response, calling `on_partial` with the text
+    generated so far after every event. Returns a dict shaped like a regular
+    `generateContent` response, so it can be handled the same way.
+    """
+    merged = {}
+    async for line in response.content:
+        line = line.decode("utf-8").strip()
+        if not line.startswith("data:"):
+            continue
+
+        try:
+            chunk = json.loads(line[len("data:"):])
+        except json.JSONDecodeError:
+            logger.warning(f"{request_id} | Failed to decode a stream event: {line[:100]}")
+            continue
+
+        if "error" in chunk:
+            return chunk
+
+        _merge_chunk(merged, chunk)
+
+        text = get_visible_text(merged)
+        if text:
+            await on_partial(text)
+
+    return merged
@@ -0,0 +1,71 @@
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from asyncpg import Record
+
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD = 4  # Role markers and the "Name: " prefix
+RECOUNT_COOLDOWN = 60  # in seconds, exact recounts cost a countTokens call (and media uploads)
+
+
+@dataclass
+class LedgerEntry:
+    tokens: int  # Exact prompt size reported by the API (system instruction included) for the messages below
+    estimates: Dict[int, int]  # umid: local estimate, for every message that was counted
+
+
+_entries: Dict[int, LedgerEntry] = {}
+_recount_attempts: Dict[int, float] = {}  # chat_id: when an exact recount was last started
+
+
+def estimate_message_tokens(message: Record) -> int:
+    length = len(message["sender_name"] or "") + len(message["text"] or "")
+    if message["reply_to_message_id"]:
+        length += len(message["reply_to_message_trimmed_text"] or "")
+    return length // CHARS_PER_TOKEN + MESSAGE_OVERHEAD
+
+
+def record(chat_id: int, messages: List[Record], tokens: int) -> None:
+    """Remembers an exact token count (e.g. usageMetadata.promptTokenCount) for a set of messages"""
+    if not tokens:
+        return
+    _entries[chat_id] = LedgerEntry(
+        tokens=tokens,
+        estimates={message["umid"]: estimate_message_tokens(message) for message in messages}
+    )
+
+
+def invalidate(chat_id: int) -> None:
+    """Drops the last exact count, since edited or deleted messages keep their umids and would skew it"""
+    _entries.pop(chat_id, None)
+
+
+def can_recount(chat_id: int) -> bool:
+    """
+    Returns whether an exact recount may be started now, and if so, counts it as started.
+    The cooldown runs from the last attempt, so failing or slow recounts can't be retried in a loop.
+    """
+    now = time.time()
+    if now - _recount_attempts.get(chat_id, 0) < RECOUNT_COOLDOWN:
+        return False
+    _recount_attempts[chat_id] = now
+    return True
+
+
+def get_token_count(chat_id: int, messages: List[Record]) -> Tuple[int, bool]:
+    """
+    Returns the token count of `messages` and whether it is exact.
+    Starts from the last exact count and adjusts it with local estimates
+    for the messages that were added or have left the memory since then.
+    """
+    entry: Optional[LedgerEntry] = _entries.get(chat_id)
+    current_umids = {message["umid"] for message in messages}
+    if not entry or current_umids.isdisjoint(entry.estimates):
+        # Nothing to start from, e.g. after a restart or once the memory was reset
+        return sum(estimate_message_tokens(message) for message in messages), False
+
+    added = sum(estimate_message_tokens(message) for message in messages if message["umid"] not in entry.estimates)
+    removed = sum(estimate for umid, estimate in entry.estimates.items() if umid not in current_umids)
+
+    return max(0, entry.tokens + added - removed), not added and not removed
@@ -0,0 +1,115 @@
+import asyncio
+import os
+from collections import defaultdict
+from datetime import date, datetime, time as datetime_time, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from .keys import get_key_fingerprint
+from .quotas import BILLING_KEY_LIMITS, KEY_LIMITS, get_model_family
+from .retry import PACIFIC_TIME
+
+FLUSH_INTERVAL = float(os.getenv("GEMINI_USAGE_FLUSH_INTERVAL", 60))  # in seconds
+
+
+def get_quota_day(moment: datetime = None) -> date:
+    """Gemini daily quotas reset at midnight Pacific time, so the days are counted in it too"""
+    return (moment or datetime.now(PACIFIC_TIME)).astimezone(PACIFIC_TIME).date()
+
+
+class UsageLedger:
+    """
+    Counts requests, tokens and errors per key, model and quota day, and writes them to
+    statistics_key_usage in batches. Counts that fail to be written are kept for the next flush.
+    Keys are written as their fingerprints, so that the table doesn't leak them.
+    """
+
+    def __init__(self):
+        self.pending: Dict[Tuple[date, str, str], List[int]] = {}  # (day, key, model): [requests, tokens, errors]
+        self.lock = asyncio.Lock()
+
+    def record(self, key: str, model: str, requests: int = 0, tokens: int = 0, errors: int = 0) -> None:
+        counters = self.pending.setdefault((get_quota_day(), key, model), [0, 0, 0])
+        counters[0] += requests
+        counters[1] += tokens
+        counters[2] += errors
+
+    async def flush(self) -> None:
+        import db  # Imported here so that the key manager can be used without a database
+
+        async with self.lock:
+            pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            rows = [(day, get_key_fingerprint(key), model, *counters)
+                    for (day, key, model), counters in pending.items()]
+            try:
+                await db.log_key_usage(rows)
+            except Exception as e:
+                logger.error(f"Failed to write {len(rows)} key usage records: {e}")
+                for (day, key, model), (requests, tokens, errors) in pending.items():
+                    counters = self.pending.setdefault((day, key, model), [0, 0, 0])
+                    counters[0] += requests
+                    counters[1] += tokens
+                    counters[2] += errors
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+
+async def get_usage_report(manager) -> Dict[str, dict]:
+    """
+    Today's usage per model family: how many keys served it, what's left of the daily request quota
+    of the keys that are still in use, and when it runs out if requests keep coming at today's rate.
+    Only regular keys count towards the headroom, billing keys have their own limits.
+    """
+    import db
+
+    await manager.usage_ledger.flush()
+    day = get_quota_day()
+    rows = await db.get_key_usage(day)
+
+    now = datetime.now(PACIFIC_TIME)
+    day_start = datetime.combine(day, datetime_time.min, tzinfo=PACIFIC_TIME)
+    day_end = day_start + timedelta(days=1)
+    elapsed = max((now - day_start).total_seconds(), 1)
+
+    billing_keys = set(manager.billing_api_keys)
+    usable_keys = [key for key in manager.api_keys if key not in manager.pool.removed]
+    regular_key_count = len([key for key in usable_keys if key not in billing_keys])
+
+    families = defaultdict(lambda: {"keys": set(), "requests": 0, "tokens": 0, "errors": 0, "limited_requests": 0})
+    for row in rows:
+        is_billing = manager.get_key_by_fingerprint(row["key"]) in billing_keys
+        family = get_model_family(row["model"], BILLING_KEY_LIMITS if is_billing else KEY_LIMITS)
+        totals = families[family or row["model"]]
+        totals["keys"].add(row["key"])
+        totals["requests"] += row["requests"]
+        totals["tokens"] += row["tokens"]
+        totals["errors"] += row["errors"]
+        if family and not is_billing:
+            totals["limited_requests"] += row["requests"]
+
+    report = {}
+    for family, totals in families.items():
+        headroom: Optional[int] = None
+        exhausted_at: Optional[datetime] = None
+        if family in KEY_LIMITS:
+            daily_limit = KEY_LIMITS[family][2]
+            headroom = max(0, daily_limit * regular_key_count - totals["limited_requests"])
+            rate = totals["limited_requests"] / elapsed
+            if rate > 0:
+                predicted = now + timedelta(seconds=headroom / rate)
+                exhausted_at = predicted if predicted < day_end else None
+        report[family] = {
+            "keys": len(totals["keys"]),
+            "requests": totals["requests"],
+            "tokens": totals["tokens"],
+            "errors": totals["errors"],
+            "headroom": headroom,
+            "exhausted_at": exhausted_at,
+        }
+    return report
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict
+
+from loguru import logger
+
+MEDIA_CACHE_MAX_SIZE = int(float(os.getenv("MEDIA_CACHE_MAX_SIZE_MB", 2048)) * 1024 * 1024)  # in bytes
+TEMPORARY_SUFFIX = ".tmp"
+
+
+class MediaCache:
+    """
+    Media files downloaded from Telegram, kept on disk under a byte quota. The least recently used files
+    are evicted first, except for the ones pinned by requests that are still reading them.
+    The access order is rebuilt from the modification times of the files at startup, and hits touch
+    the file, so that it survives restarts.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # file name: size, least recently used first
+        self.size = 0
+        self.pins = Counter()
+        self.downloads: Dict[str, asyncio.Task] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._scan()
+
+    def _scan(self) -> None:
+        if not self.path or not os.path.isdir(self.path):
+            return
+        files = []
+        for entry in os.scandir(self.path):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(TEMPORARY_SUFFIX):
+                os.remove(entry.path)  # Left over from an interrupted download
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+        logger.info(f"Media cache: {len(self.entries)} files, {self.size / 1024 / 1024:.1f} MB.")
+        self._evict()
+
+    def get_path(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    async def fetch(self, name: str, download: Callable[[str], Awaitable]) -> str:
+        """Returns the path of a cached file, calling `download` with a temporary path to fetch it on a miss"""
+        if name in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(name)
+            try:
+                os.utime(self.get_path(name))
+                return self.get_path(name)
+            except FileNotFoundError:
+                self._forget(name)  # Removed from the outside
+
+        if name not in self.downloads:
+            self.misses += 1
+            self.downloads[name] = asyncio.create_task(self._download(name, download))
+            self.downloads[name].add_done_callback(lambda _: self.downloads.pop(name, None))
+        # Shielded, so that a cancelled request doesn't cancel the download for the others waiting for it
+        await asyncio.shield(self.downloads[name])
+        return self.get_path(name)
+
+    async def _download(self, name: str, download: Callable[[str], Awaitable]) -> None:
+        temporary_path = self.get_path(f"{name}.{uuid.uuid4().hex}{TEMPORARY_SUFFIX}")
+        try:
+            await download(temporary_path)
+            os.replace(temporary_path, self.get_path(name))
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        size = os.path.getsize(self.get_path(name))
+        self._forget(name)
+        self.entries[name] = size
+        self.size += size
+        self._evict()
+
+    def _forget(self, name: str) -> None:
+        self.size -= self.entries.pop(name, 0)
+
+    def _evict(self) -> None:
+        if self.size <= self.max_size:
+            return
+        for name in list(self.entries):
+            if self.size <= self.max_size:
+                break
+            if self.pins[name]:
+                continue
+            try:
+                os.remove(self.get_path(name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Failed to evict {name} from the media cache: {e}")
+                continue
+            self._forget(name)
+            self.evictions += 1
+
+    @contextmanager
+    def pinned(self, name: str):
+        """Keeps a file from being evicted while it's in use"""
+        self.pins[name] += 1
+        try:
+            yield
+        finally:
+            self.pins[name] -= 1
+            if not self.pins[name]:
+                del self.pins[name]
+
+    def get_stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "size": f"{self.size / 1024 / 1024:.0f} МБ",
+            "maxsize": f"{self.max_size / 1024 / 1024:.0f} МБ",
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / requests * 100, 1) if requests else 0
+        }
+
+
+media_cache = MediaCache(os.getenv("CACHE_PATH"), MEDIA_CACHE_MAX_SIZE)
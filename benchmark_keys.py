@@ -0,0 +1,106 @@
+import asyncio
+import importlib
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+from loguru import logger
+
+KEY_COUNT = 10_000
+OPERATIONS = 100_000
+
+
+def load_keys_module():
+    # Registers bare packages, so that importing the key manager doesn't set up the bot and the database
+    root = os.path.dirname(os.path.abspath(__file__))
+    for name in ["api", "api.google"]:
+        package = types.ModuleType(name)
+        package.__path__ = [os.path.join(root, *name.split("."))]
+        sys.modules[name] = package
+    return importlib.import_module("api.google.keys")
+
+
+def make_keys_file(count):
+    keys = [f"AIzaSy{index:033d}" for index in range(count)]
+    file = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+    for index, key in enumerate(keys):
+        file.write(f"{key} b\n" if index % 10 == 0 else f"{key}\n")
+    file.close()
+    return file.name, keys
+
+
+def report(name, started, operations):
+    elapsed = time.perf_counter() - started
+    print(f"{name:<32} {elapsed * 1e6 / operations:8.2f} µs/op")
+
+
+async def benchmark():
+    keys_module = load_keys_module()
+    keys_file, keys = make_keys_file(KEY_COUNT)
+    manager = keys_module.ApiKeyManager(keys_file, exhaust_bantime=3600)
+    os.remove(keys_file)
+
+    print(f"{KEY_COUNT} keys, {OPERATIONS} operations each\n")
+
+    started = time.perf_counter()
+    for _ in range(OPERATIONS):
+        await manager.get_api_key()
+    report("get_api_key", started, OPERATIONS)
+
+    started = time.perf_counter()
+    for _ in range(OPERATIONS):
+        await manager.get_api_key(billing_only=True)
+    report("get_api_key (billing)", started, OPERATIONS)
+
+    started = time.perf_counter()
+    for _ in range(OPERATIONS):
+        await manager.get_api_key(model="gemini-1.5-flash")
+    report("get_api_key (quota-aware)", started, OPERATIONS)
+
+    # Exhaust half of the keys, then keep selecting with a large exhausted set
+    exhausted = random.sample(keys, KEY_COUNT // 2)
+    started = time.perf_counter()
+    for key in exhausted:
+        manager.timeout_key(key, False)
+    report("timeout_key", started, len(exhausted))
+
+    started = time.perf_counter()
+    for _ in range(OPERATIONS):
+        await manager.get_api_key()
+    report("get_api_key (half exhausted)", started, OPERATIONS)
+
+    # Let every cooldown expire at once
+    manager.pool.exhausted_key_lifetime = 0
+    started = time.perf_counter()
+    await manager.get_api_key()
+    report("reactivation of all keys", started, len(exhausted))
+    manager.pool.exhausted_key_lifetime = 3600
+
+    removed = random.sample(keys, KEY_COUNT // 10)
+    started = time.perf_counter()
+    for key in removed:
+        manager.remove_key_permanently(key, False)
+    report("remove_key_permanently", started, len(removed))
+
+    print(f"\n{len(manager.pool.active)} keys left active")
+
+    # The list-based selection the manager used before, for comparison
+    active_keys = list(keys)
+    exhausted_keys = {key: 0 for key in exhausted}
+    index = 0
+    operations = OPERATIONS // 100
+    started = time.perf_counter()
+    for _ in range(operations):
+        candidates = [key for key in active_keys if key not in exhausted_keys]
+        _ = candidates[index % len(candidates)]
+        index += 1
+    report("list-based selection (before)", started, operations)
+
+
+if __name__ == "__main__":
+    os.environ["FEEDBACK_TARGET_ID"] = "0"  # No admin notifications about removed keys
+    logger.remove()  # The removal warnings would drown the results
+    asyncio.run(benchmark())
@@ -0,0 +1,134 @@
+import asyncio
+import importlib
+import os
+import sys
+import time
+import types
+
+from aiohttp import web
+from loguru import logger
+
+from benchmark_keys import load_keys_module
+
+STUB_PORT = 8766
+MODEL = "gemini-1.5-flash-002"
+KEY = "AIzaSyCacheKey0001"
+OTHER_KEY = "AIzaSyCacheKey0002"
+
+os.environ.setdefault("MAX_KEY_ROTATION_ATTEMPTS", "15")
+os.environ["GEMINI_API_URL"] = f"http://127.0.0.1:{STUB_PORT}"
+os.environ["GEMINI_CONTEXT_CACHE_MIN_TOKENS"] = "100"  # Small histories are enough to get cached
+
+calls = []  # (method, path, key)
+created = {"count": 0}
+fail_creation = {"value": False}
+
+
+async def create_cache(request):
+    calls.append(("POST", request.path, request.headers["x-goog-api-key"]))
+    if fail_creation["value"]:
+        return web.json_response({"error": {"code": 400, "status": "INVALID_ARGUMENT", "message": "Too small."}},
+                                 status=400)
+    created["count"] += 1
+    return web.json_response({"name": f"cachedContents/stub{created['count']}",
+                              "usageMetadata": {"totalTokenCount": 1234}})
+
+
+async def update_cache(request):
+    calls.append((request.method, request.path, request.headers["x-goog-api-key"]))
+    return web.json_response({})
+
+
+def make_contents(count, edited_block=None):
+    contents = []
+    for index in range(count):
+        text = f"Message {index}: " + "lorem ipsum " * 20
+        if index == edited_block:
+            text = "Edited. " + text
+        contents.append({"role": "user" if index % 2 == 0 else "model", "parts": [{"text": text}]})
+    return contents
+
+
+def check(description, condition):
+    print(f"{'ok  ' if condition else 'FAIL'} {description}")
+    return condition
+
+
+async def run_checks():
+    app = web.Application()
+    app.router.add_post("/v1beta/cachedContents", create_cache)
+    app.router.add_route("PATCH", "/v1beta/cachedContents/{name}", update_cache)
+    app.router.add_route("DELETE", "/v1beta/cachedContents/{name}", update_cache)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", STUB_PORT).start()
+
+    # The history extension isn't checked here, so the module gets a bare database package
+    load_keys_module()
+    sys.modules["db"] = types.ModuleType("db")
+    context_cache = importlib.import_module("api.google.context_cache")
+    retry = importlib.import_module("api.google.retry")
+    sessions = importlib.import_module("api.google.sessions")
+
+    chat_id = 1
+    system_prompt = {"parts": [{"text": "You are a bot."}]}
+    results = []
+
+    async def apply(contents, key=KEY, chat=chat_id):
+        data = {"contents": contents, "system_instruction": system_prompt}
+        used = await context_cache.apply(1, chat, key, MODEL, system_prompt, contents, 1, data)
+        await asyncio.sleep(0.05)  # Deletions are sent in the background
+        return used, data
+
+    used, data = await apply(make_contents(10))
+    results.append(check("a long history is cached", used and calls == [("POST", "/v1beta/cachedContents", KEY)]))
+    results.append(check("the request only sends the newest blocks",
+                         data.get("cachedContent") == "cachedContents/stub1" and len(data["contents"]) == 2
+                         and "system_instruction" not in data))
+    results.append(check("the cache is bound to its key", context_cache.get_bound_key(chat_id) == KEY))
+
+    calls.clear()
+    used, data = await apply(make_contents(11))
+    results.append(check("a grown history reuses the cache without requests",
+                         used and not calls and len(data["contents"]) == 3))
+
+    context_cache._entries[chat_id].expires_at = time.time() + 10
+    used, _ = await apply(make_contents(12))
+    results.append(check("a cache close to expiring gets its TTL extended",
+                         used and calls == [("PATCH", "/v1beta/cachedContents/stub1", KEY)]))
+
+    calls.clear()
+    used, _ = await apply(make_contents(12), key=OTHER_KEY)
+    results.append(check("another key doesn't use the cache", not used and not calls))
+
+    used, data = await apply(make_contents(12, edited_block=3))
+    results.append(check("an edited history rebuilds the cache",
+                         used and sorted(calls) == [("DELETE", "/v1beta/cachedContents/stub1", KEY),
+                                                    ("POST", "/v1beta/cachedContents", KEY)]
+                         and data["cachedContent"] == "cachedContents/stub2"))
+
+    calls.clear()
+    rejection = {"error": {"code": 403, "status": "PERMISSION_DENIED",
+                           "message": "CachedContent not found (or permission denied)"}}
+    reason = retry.classify_response(403, rejection, using_context_cache=True)
+    context_cache.invalidate(chat_id)  # What the generation does after CACHE_REJECTED
+    await asyncio.sleep(0.05)
+    results.append(check("a rejected cache is recognized, forgotten and deleted",
+                         reason == "CACHE_REJECTED" and context_cache.get_bound_key(chat_id) is None
+                         and calls == [("DELETE", "/v1beta/cachedContents/stub2", KEY)]))
+
+    calls.clear()
+    fail_creation["value"] = True
+    first_used, _ = await apply(make_contents(10), chat=2)
+    second_used, _ = await apply(make_contents(10), chat=2)
+    results.append(check("a failed creation isn't retried right away",
+                         not first_used and not second_used and len(calls) == 1))
+
+    await sessions.session_manager.close()
+    await runner.cleanup()
+    return all(results)
+
+
+if __name__ == "__main__":
+    logger.remove()
+    sys.exit(0 if asyncio.run(run_checks()) else 1)
@@ -0,0 +1,121 @@
+import asyncio
+import importlib
+import os
+import sys
+import tempfile
+
+from aiohttp import web
+from loguru import logger
+
+from benchmark_keys import load_keys_module
+
+STUB_PORT = 8765
+MODEL = "gemini-1.5-pro"
+
+os.environ.setdefault("MAX_KEY_ROTATION_ATTEMPTS", "15")
+os.environ.setdefault("FEEDBACK_TARGET_ID", "0")  # No admin notifications about removed keys
+os.environ["GEMINI_API_URL"] = f"http://127.0.0.1:{STUB_PORT}"
+
+# Keys end with what the stub answers for them
+KEYS = {
+    "AIzaSyUnused00ok": "never used, valid",
+    "AIzaSyUnusedBad0": "never used, invalid",
+    "AIzaSyUnusedDeny": "never used, denied access",
+    "AIzaSyBack000ok": "exhausted, quota is back",
+    "AIzaSyStill00429": "exhausted, still over the quota",
+    "AIzaSyModel00ok": f"exhausted for {MODEL} on a guess, quota is back",
+    "AIzaSyModel0429": f"exhausted for {MODEL} on a guess, still over the quota",
+    "AIzaSyKnown00ok": f"exhausted for {MODEL} with a known cooldown",
+}
+
+INVALID_KEY_ERROR = {"error": {"code": 400, "status": "INVALID_ARGUMENT", "message": "API key not valid.", "details": [
+    {"@type": "type.googleapis.com/google.rpc.ErrorInfo", "reason": "API_KEY_INVALID"}
+]}}
+PERMISSION_DENIED_ERROR = {"error": {"code": 403, "status": "PERMISSION_DENIED", "message": "Denied."}}
+EXHAUSTED_ERROR = {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "message": "Quota exceeded.", "details": [
+    {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "120s"}
+]}}
+
+
+def answer(key):
+    if key.endswith("Bad0"):
+        return web.json_response(INVALID_KEY_ERROR, status=400)
+    if key.endswith("Deny"):
+        return web.json_response(PERMISSION_DENIED_ERROR, status=403)
+    if key.endswith("429"):
+        return web.json_response(EXHAUSTED_ERROR, status=429)
+    return None
+
+
+async def list_models(request):
+    error = answer(request.headers["x-goog-api-key"])
+    return error if error is not None else web.json_response({"models": [{"name": "models/stub"}]})
+
+
+async def generate(request):
+    error = answer(request.headers["x-goog-api-key"])
+    return error if error is not None else web.json_response({"candidates": [{"content": {"parts": [{"text": "H"}]}}]})
+
+
+def check(description, condition):
+    print(f"{'ok  ' if condition else 'FAIL'} {description}")
+    return condition
+
+
+async def run_checks():
+    app = web.Application()
+    app.router.add_get("/v1beta/models", list_models)
+    app.router.add_post("/v1beta/models/{model}:generateContent", generate)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", STUB_PORT).start()
+
+    keys_module = load_keys_module()
+    prober_module = importlib.import_module("api.google.prober")
+    sessions = importlib.import_module("api.google.sessions")
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as keys_file:
+        keys_file.write("\n".join(KEYS) + "\n")
+    try:
+        manager = keys_module.ApiKeyManager(keys_file.name)
+    finally:
+        os.remove(keys_file.name)
+
+    manager.timeout_key("AIzaSyBack000ok", False)
+    manager.timeout_key("AIzaSyStill00429", False)
+    manager.timeout_key("AIzaSyModel00ok", False, MODEL)
+    manager.timeout_key("AIzaSyModel0429", False, MODEL)
+    manager.timeout_key("AIzaSyKnown00ok", False, MODEL, 3600)
+    for key in ["AIzaSyBack000ok", "AIzaSyStill00429", "AIzaSyModel00ok", "AIzaSyModel0429", "AIzaSyKnown00ok"]:
+        manager.record_result(key, 1.0, "RESOURCE_EXHAUSTED")  # Used before, so not probed for validity
+
+    prober = prober_module.KeyProber(manager)
+    summary = await prober.run_round()
+    print(f"Round: {summary}\n")
+
+    pool = manager.pool
+    now = manager.clock()
+    results = [
+        check("a valid unused key is validated", "AIzaSyUnused00ok" in prober.validated),
+        check("an invalid key is removed", "AIzaSyUnusedBad0" in pool.removed),
+        check("a denied key is kept", "AIzaSyUnusedDeny" in pool.active and "AIzaSyUnusedDeny" not in pool.removed),
+        check("an exhausted key with its quota back is reactivated", "AIzaSyBack000ok" in pool.active),
+        check("a still exhausted key stays out, coming back after the suggested delay",
+              "AIzaSyStill00429" in pool.exhausted and
+              abs(pool.exhausted["AIzaSyStill00429"] + manager.exhausted_key_lifetime - now - 120) < 5),
+        check("a key with its model quota back is reactivated for the model",
+              manager.is_key_available("AIzaSyModel00ok", model=MODEL)),
+        check("a key still over its model quota gets the suggested delay",
+              abs(pool.model_exhausted.get(("AIzaSyModel0429", MODEL), 0) - now - 120) < 5 and
+              ("AIzaSyModel0429", MODEL) not in pool.model_guessed),
+        check("a key with a known cooldown isn't probed", pool.is_exhausted_for("AIzaSyKnown00ok", MODEL)),
+    ]
+
+    await sessions.session_manager.close()
+    await runner.cleanup()
+    return all(results)
+
+
+if __name__ == "__main__":
+    logger.remove()  # The reactivation and removal messages would drown the results
+    sys.exit(0 if asyncio.run(run_checks()) else 1)
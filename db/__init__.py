@@ -4,6 +4,8 @@ from .messages import attempt_delete_message, delete_old_messages, get_messages,
 from .migration import migrate_messages_tables
 from .shared import initialize_connection_pool
 from .statistics import create_statistics_table, get_active_users, get_generation_counts, get_generation_counts_period, \
-    get_request_count, get_token_stats, get_tokens_consumed, get_tokens_consumed_period, get_top_users, \
-    migrate_statistics_table
-from .table_creator import create_blacklist_table, create_chat_config_table, create_messages_table, drop_orphan_columns
+    get_key_usage, get_request_count, get_token_stats, get_tokens_consumed, get_tokens_consumed_period, get_top_users, \
+    log_key_usage, migrate_statistics_table
+from .table_creator import create_blacklist_table, create_chat_config_table, create_file_uploads_table, \
+    create_messages_table, drop_orphan_columns
+from .uploads import delete_expired_uploads, get_cached_upload, get_uploaded_content_hash, save_cached_upload
@@ -5,6 +5,7 @@ from aiogram.types import Message
 
 import db.shared as dbs
 from api.media import get_file
+from db.chats import get_chat_parameter
 from utils import get_message_text
 
 
@@ -77,6 +78,11 @@ async def save_aiogram_message(message: Message):
         media_type
     )
 
+    if file_id and await get_chat_parameter(message.chat.id, "g_media_preload") \
+            and await get_chat_parameter(message.chat.id, "endpoint") == "google":
+        from api.google.media import start_ingestion  # Imported here because of a circular import
+        start_ingestion(message, file_id, media_type)
+
 
 async def save_our_message(trigger_message: Message, text: str, our_message_id: int):
     await _save_message(
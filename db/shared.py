@@ -16,15 +16,26 @@ async def sanitize_chat_id(chat_id: int) -> str:
     return str(chat_id).replace("-", "_")
 
 
+def get_connection_params() -> dict:
+    return {
+        "user": os.getenv("POSTGRES_USER"),
+        "password": os.getenv("POSTGRES_PASSWORD"),
+        "host": os.getenv("POSTGRES_HOST"),
+        "database": os.getenv("POSTGRES_USER"),
+    }
+
+
+async def create_connection() -> asyncpg.Connection:
+    """A standalone connection outside the pool, for long-lived listeners"""
+    return await asyncpg.connect(**get_connection_params())
+
+
 async def initialize_connection_pool() -> None:
     logger.info("Creating a connection pool...")
     try:
         global pool
         pool = await asyncpg.create_pool(
-            user=os.getenv("POSTGRES_USER"),
-            password=os.getenv("POSTGRES_PASSWORD"),
-            host=os.getenv("POSTGRES_HOST"),
-            database=os.getenv("POSTGRES_USER"),
+            **get_connection_params(),
             min_size=int(os.getenv("POSTGRES_POOL_MIN_CONNECTIONS")),
             max_size=int(os.getenv("POSTGRES_POOL_MAX_CONNECTIONS")),
             max_inactive_connection_lifetime=100
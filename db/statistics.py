@@ -28,6 +28,19 @@ async def create_statistics_table(conn: asyncpg.Connection) -> None:
         ON statistics_generations (timestamp DESC)
     """)
 
+    # Per-key usage by Pacific day, which is when Gemini quotas reset. Keys are stored as fingerprints.
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS statistics_key_usage (
+            day date NOT NULL,
+            key text NOT NULL,
+            model text NOT NULL,
+            requests integer DEFAULT 0,
+            tokens bigint DEFAULT 0,
+            errors integer DEFAULT 0,
+            PRIMARY KEY (day, key, model)
+        )
+    """)
+
 
 async def log_generation(
         chat_id: int,
@@ -60,6 +73,31 @@ async def log_generation(
         logger.error(f"Failed to log generation stats: {e}")
 
 
+async def log_key_usage(rows: List[Tuple[datetime.date, str, str, int, int, int]]) -> None:
+    """Adds batched (day, key fingerprint, model, requests, tokens, errors) counts to the key usage ledger"""
+    async with dbs.pool.acquire() as conn:
+        await conn.executemany(
+            """
+            INSERT INTO statistics_key_usage (day, key, model, requests, tokens, errors)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (day, key, model) DO UPDATE SET
+                requests = statistics_key_usage.requests + EXCLUDED.requests,
+                tokens = statistics_key_usage.tokens + EXCLUDED.tokens,
+                errors = statistics_key_usage.errors + EXCLUDED.errors
+            """,
+            rows
+        )
+
+
+async def get_key_usage(day: datetime.date) -> List[asyncpg.Record]:
+    """Get per-key, per-model usage for one quota day"""
+    async with dbs.pool.acquire() as conn:
+        return await conn.fetch(
+            "SELECT key, model, requests, tokens, errors FROM statistics_key_usage WHERE day = $1",
+            day
+        )
+
+
 async def get_active_users(days: int) -> Tuple[int, List[int]]:
     """Get count and list of users who triggered generations in last N days"""
     async with dbs.pool.acquire() as conn:
@@ -453,6 +491,8 @@ async def get_cache_stats():
             "hit_rate": round(cache_info[0] / (cache_info[0] + cache_info[1]) * 100, 1) if
             (cache_info[0] + cache_info[1]) > 0 else 0
         }
+    from api.media_cache import media_cache  # Imported here because of a circular import
+    stats["Медиафайлы"] = media_cache.get_stats()
     return stats
 
 
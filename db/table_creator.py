@@ -137,6 +137,26 @@ async def create_blacklist_table(conn: Connection) -> None:
     await conn.execute(command)
 
 
+async def create_file_uploads_table(conn: Connection) -> None:
+    """
+    Creates the table of files uploaded to the Gemini File API, by content hash and the project (or key)
+    that uploaded them, since uploads are only visible to that project.
+    The Telegram file_id of the upload lets the hash be found without downloading the file again.
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS gemini_file_uploads (
+            content_hash text NOT NULL,
+            owner text NOT NULL,
+            uri text NOT NULL,
+            mime_type text NOT NULL,
+            expires_at timestamptz NOT NULL,
+            file_id text,
+            PRIMARY KEY (content_hash, owner)
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_gemini_file_uploads_file_id ON gemini_file_uploads (file_id)")
+
+
 async def drop_orphan_columns(conn: Connection) -> None:
     # Get the expected columns from chat_configs
     expected_columns = set()
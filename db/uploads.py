@@ -0,0 +1,46 @@
+import datetime
+from typing import Optional
+
+from asyncpg import Record
+
+import db.shared as dbs
+
+
+async def get_cached_upload(content_hash: str, owner: str, valid_for: datetime.timedelta) -> Optional[Record]:
+    """Returns a File API upload of the content made by the owner, if it stays valid for at least `valid_for`"""
+    async with dbs.pool.acquire() as conn:
+        return await conn.fetchrow(
+            "SELECT uri, mime_type, expires_at FROM gemini_file_uploads "
+            "WHERE content_hash = $1 AND owner = $2 AND expires_at > $3",
+            content_hash, owner, datetime.datetime.now(datetime.timezone.utc) + valid_for
+        )
+
+
+async def get_uploaded_content_hash(file_id: str) -> Optional[str]:
+    """Returns the content hash of a Telegram file that has been uploaded before, by any owner"""
+    async with dbs.pool.acquire() as conn:
+        return await conn.fetchval(
+            "SELECT content_hash FROM gemini_file_uploads WHERE file_id = $1 LIMIT 1",
+            file_id
+        )
+
+
+async def save_cached_upload(content_hash: str, owner: str, uri: str, mime_type: str,
+                             expires_at: datetime.datetime, file_id: str) -> None:
+    async with dbs.pool.acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO gemini_file_uploads (content_hash, owner, uri, mime_type, expires_at, file_id)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (content_hash, owner) DO UPDATE SET
+                uri = EXCLUDED.uri, mime_type = EXCLUDED.mime_type, expires_at = EXCLUDED.expires_at,
+                file_id = EXCLUDED.file_id
+            """,
+            content_hash, owner, uri, mime_type, expires_at, file_id
+        )
+
+
+async def delete_expired_uploads() -> int:
+    async with dbs.pool.acquire() as conn:
+        result = await conn.execute("DELETE FROM gemini_file_uploads WHERE expires_at < now()")
+    return int(result.split()[-1])
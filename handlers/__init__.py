@@ -1,5 +1,5 @@
 from .admin_commands import blacklist_command, directsend_command, prune_command, restart_command, sql_command, \
-    stats_command, unblacklist_command, dropcaches_command
+    stats_command, unblacklist_command, dropcaches_command, reloadkeys_command, keyusage_command
 from .all_messages import handle_message_edit, handle_new_message
 from .commands import feedback_command, forget_command, help_command, hide_command, preset_command, \
     replace_command, reset_command, set_command, settings_comand, start_command, status_command, system_command
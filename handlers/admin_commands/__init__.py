@@ -1,7 +1,9 @@
 from .blacklist import blacklist_command, unblacklist_command
 from .directsend import directsend_command
 from .dropcaches import dropcaches_command
+from .keyusage import keyusage_command
 from .prune import prune_command
+from .reloadkeys import reloadkeys_command
 from .restart import restart_command
 from .sql import sql_command
 from .stats import stats_command
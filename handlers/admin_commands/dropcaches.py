@@ -1,5 +1,6 @@
 from aiogram.types import Message, ReactionTypeEmoji
 
+import api.google.media
 import db
 import utils
 
@@ -10,5 +11,6 @@ async def dropcaches_command(message: Message):
     db.chats.blacklist.is_blacklisted.cache_clear()
     db.chats.chat_config.get_chat_parameter.cache_clear()
     utils.usernames.get_entity_title.cache_clear()
+    api.google.media.get_content_hash.cache_clear()
 
     await message.react([ReactionTypeEmoji(emoji="👌")])
@@ -0,0 +1,30 @@
+from aiogram.types import Message
+
+from api.google.google import key_manager
+from api.google.usage_ledger import get_quota_day, get_usage_report
+from utils import log_command
+
+
+async def keyusage_command(message: Message):
+    await log_command(message)
+
+    report = await get_usage_report(key_manager)
+    if not report:
+        await message.reply("🔑 <b>Сегодня ключи ещё не использовались.</b>")
+        return
+
+    response = f"🔑 <b>Использование ключей за {get_quota_day():%d.%m} (по тихоокеанскому времени):</b>\n"
+    for family, usage in sorted(report.items(), key=lambda item: item[1]["requests"], reverse=True):
+        response += f"\n<b>{family}</b>\n"
+        response += f"• Ключей: {usage['keys']:,}, запросов: {usage['requests']:,}, "
+        response += f"токенов: {usage['tokens']:,}, ошибок: {usage['errors']:,}\n"
+        if usage["headroom"] is None:
+            response += "• Дневной лимит не задан\n"
+            continue
+        response += f"• Осталось запросов: {usage['headroom']:,}\n"
+        if usage["exhausted_at"]:
+            response += f"• При текущем темпе закончатся в {usage['exhausted_at']:%H:%M}\n"
+        else:
+            response += "• При текущем темпе хватит до сброса лимитов\n"
+
+    await message.reply(response)
@@ -0,0 +1,33 @@
+from aiogram.types import Message
+
+from api.google.google import key_manager
+from api.google.keys import KeysFileRejectedException
+from utils import log_command
+
+
+async def reloadkeys_command(message: Message):
+    await log_command(message)
+
+    force = "force" in message.text.split()[1:]
+    try:
+        changes = key_manager.reload_keys(force)
+    except OSError as e:
+        await message.reply(f"❌ <b>Не удалось прочитать список ключей:</b> {e}")
+        return
+    except KeysFileRejectedException as e:
+        await message.reply(f"❌ <b>Список ключей не применён:</b> {e}\n"
+                            f"<i>Если ключи убраны намеренно, используйте /reloadkeys force</i>")
+        return
+
+    if not any(changes.values()):
+        await message.reply("👌 <b>Список ключей не изменился.</b>")
+        return
+
+    key_statuses = key_manager.get_key_statuses()
+    await message.reply(
+        f"🔑 <b>Ключи перезагружены:</b>\n"
+        f"• Добавлено: {len(changes['added'])} (Биллинг: {len(changes['billing_added'])})\n"
+        f"• Убрано: {len(changes['retired'])} (Биллинг: {len(changes['billing_retired'])})\n"
+        f"• Активные: {key_statuses['active']['api_keys']} / {key_statuses['total']['api_keys']} "
+        f"(Биллинг: {key_statuses['active']['billing_api_keys']} / {key_statuses['total']['billing_api_keys']})"
+    )
@@ -1,8 +1,12 @@
 from aiogram.types import Message, ReactionTypeEmoji
 from loguru import logger
 
+from api.google.google import key_manager
+
 
 async def restart_command(message: Message) -> None:
     await message.react([ReactionTypeEmoji(emoji="👌")])
     logger.info("Restarting...")
+    await key_manager.save_state()
+    await key_manager.usage_ledger.flush()
     exit(1)  # docker auto restart goes brrr
@@ -1,5 +1,6 @@
 import os
 import random
+import tempfile
 
 from aiogram import html
 from aiogram.types import FSInputFile, Message
@@ -28,11 +29,13 @@ async def sql_command(message: Message):
             await message.reply(html.quote(str(result)))
     except Exception as e:
         if "too long" in str(e):
-            path = os.getenv("CACHE_PATH") + "out.txt"
-            with open(path, "w") as file:
-                file.write(str(result))
-            await bot.send_document(message.chat.id,
-                                    FSInputFile(path=path, filename=f"out{random.randint(100000, 999999)}.txt"))
+            # Not in CACHE_PATH, which the media cache evicts files from
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "out.txt")
+                with open(path, "w") as file:
+                    file.write(str(result))
+                await bot.send_document(message.chat.id,
+                                        FSInputFile(path=path, filename=f"out{random.randint(100000, 999999)}.txt"))
         else:
             await message.reply(str(e))
 
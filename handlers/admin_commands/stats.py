@@ -7,7 +7,12 @@ from aiogram.types import Message
 from loguru import logger
 
 import db.statistics as stats
-from api.google.google import key_manager
+from api.google.breaker import get_breaker_states
+from api.google.google import key_manager, key_prober
+from api.google.hedging import HEDGING_ENABLED, get_hedge_stats
+from api.google.retry import failure_counts, retry_counts
+from api.google.sessions import session_manager
+from handlers.scheduler import generation_scheduler
 from utils import get_entity_title, log_command
 
 
@@ -133,8 +138,33 @@ async def stats_command(message: Message):
         key_stats_text = (
             f"🔑 <b>Ключи:</b>\n"
             f"• Активные: {key_statuses['active']['api_keys']} / {key_statuses['total']['api_keys']} (Биллинг: {key_statuses['active']['billing_api_keys']} / {key_statuses['total']['billing_api_keys']})\n"
-            f"• Истощённые: {key_statuses['exhausted']['api_keys']} (Биллинг: {key_statuses['exhausted']['billing_api_keys']})"
+            f"• Истощённые: {key_statuses['exhausted']['api_keys']} (Биллинг: {key_statuses['exhausted']['billing_api_keys']})\n"
+            f"• Истощённые для отдельных моделей: {key_statuses['exhausted_for_model']['api_keys']} (Биллинг: {key_statuses['exhausted_for_model']['billing_api_keys']})"
         )
+        if key_statuses['groups']:
+            key_stats_text += f"\n• Проектов: {key_statuses['groups']}"
+        for name, pool_status in key_statuses['tag_pools'].items():
+            key_stats_text += f"\n• Пул {name}: {pool_status['active']} активных, {pool_status['exhausted']} истощённых"
+        key_health = key_manager.health.get_stats()
+        for title, keys in [("Лучшие ключи", key_health["best"]), ("Худшие ключи", key_health["worst"])]:
+            if keys:
+                key_stats_text += f"\n• {title}: " + ", ".join(
+                    f"<code>{info['key']}</code> (×{info['speed']:.1f}, {info['success_rate']:.0%}"
+                    f"{', ' + '/'.join(info['recent_errors'][-2:]) if info['recent_errors'] else ''})"
+                    for info in keys
+                )
+        if key_prober.last_round:
+            probe_stats = key_prober.last_round
+            key_stats_text += (
+                f"\n• Последняя проверка ({datetime.fromtimestamp(probe_stats['finished_at']):%H:%M}): "
+                f"{probe_stats['probed']} ключей, {probe_stats['reactivated']} возвращено, "
+                f"{probe_stats['invalid']} недействительных"
+            )
+        for family, levels in key_manager.quotas.get_fill_levels().items():
+            key_stats_text += (
+                f"\n• Квоты {family} ({levels['keys']} ключей): RPM {levels['rpm']:.0%}, TPM {levels['tpm']:.0%}, "
+                f"RPD {levels['rpd']:.0%}, без запаса: {levels['out_of_capacity']}"
+            )
 
         # Build base response
         response = f"""📊 <b>Статистика бота</b> 
@@ -180,6 +210,41 @@ async def stats_command(message: Message):
         for cache_name, info in cache_stats.items():
             response += f"\n• {cache_name}: {info['size']}/{info['maxsize']}"
             response += f" - {info['hit_rate']}% попаданий ({info['hits']:,} к {info['misses']:,})"
+            if "evictions" in info:
+                response += f", вытеснено: {info['evictions']:,}"
+
+        queue_stats = generation_scheduler.get_stats()
+        response += "\n\n⏳ <b>Очередь генераций:</b>"
+        response += f"\n• Выполняется: {queue_stats['in_flight']}/{queue_stats['max_in_flight']}, "
+        response += f"ожидает: {queue_stats['queued']}/{queue_stats['max_queue']}"
+        response += f"\n• Ожидание: {queue_stats['avg_wait']:.1f}с в среднем, {queue_stats['p95_wait']:.1f}с p95"
+        response += f"\n• Принято: {queue_stats['admitted']:,}, отклонено: {queue_stats['rejected']:,}"
+
+        pool_stats = session_manager.get_stats()
+        if pool_stats:
+            response += "\n\n🌐 <b>Соединения с Gemini API:</b>"
+            for route, info in pool_stats.items():
+                response += f"\n• {route}: {info['requests']:,} запросов, "
+                response += f"{info['connections_created']:,} новых соединений, "
+                response += f"{info['connections_reused']:,} переиспользовано"
+
+        if HEDGING_ENABLED:
+            hedge_stats = get_hedge_stats()
+            response += f"\n• Дублированные запросы: {hedge_stats['hedges']:,} из {hedge_stats['requests']:,}"
+            response += f" ({hedge_stats['hedge_wins']:,} оказались быстрее)"
+
+        if retry_counts or failure_counts:
+            response += "\n\n🔁 <b>Повторы запросов к Gemini API:</b>"
+            for reason in sorted(set(retry_counts) | set(failure_counts), key=lambda r: -retry_counts[r]):
+                response += f"\n• {reason}: {retry_counts[reason]:,} повторов, {failure_counts[reason]:,} отказов"
+
+        breaker_states = get_breaker_states()
+        if breaker_states:
+            response += "\n\n🚦 <b>Модели Gemini:</b>"
+            state_names = {"closed": "работает", "open": "отключена", "half_open": "проверяется"}
+            for model, info in breaker_states.items():
+                response += f"\n• {model}: {state_names[info['state']]}"
+                response += f" ({info['recent_failures']} сбоев за последнее время)"
 
         db_stats = await stats.get_database_stats()
 
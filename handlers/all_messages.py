@@ -17,12 +17,15 @@ import handlers.commands.settings_command as settings
 from main import ADMIN_IDS, bot
 from utils import get_message_text
 from .commands.shared import is_allowed_to_alter_memory
+from .scheduler import DM_WEIGHT, GROUP_WEIGHT, PRIORITY_WEIGHT, QueueFullException, generation_scheduler
+from .streaming import StreamingReply
 
 bot_id = int(os.getenv("TELEGRAM_TOKEN").split(":")[0])
 bot_username = os.getenv("BOT_USERNAME")
 FEEDBACK_TARGET_ID = int(os.getenv("FEEDBACK_TARGET_ID"))
 
 chat_semaphores = defaultdict(lambda: asyncio.Semaphore(2))
+latest_triggers = {}  # chat_id: message_id of the newest message waiting for a generated response
 
 
 async def meets_endpoint_requirements(message: Message, endpoint: str) -> bool:
@@ -81,6 +84,29 @@ async def check_rate_limit(message: Message) -> bool:
     return False
 
 
+async def wait_for_newer_triggers(message: Message) -> bool:
+    """
+    Returns True if a newer message has asked for a generated response in the meantime, so this one can be dropped:
+    the newer response sees this message too
+    """
+    coalesce_window = float(await db.get_chat_parameter(message.chat.id, "coalesce_window"))
+    if not coalesce_window:
+        return False
+
+    latest_triggers[message.chat.id] = message.message_id
+    await asyncio.sleep(coalesce_window)
+    return is_superseded(message)
+
+
+def is_superseded(message: Message) -> bool:
+    latest_trigger = latest_triggers.get(message.chat.id)
+    if latest_trigger is not None and latest_trigger != message.message_id:
+        logger.debug(f"{message.chat.id} | Dropping the response to {message.message_id}, "
+                     f"coalesced into the response to {latest_trigger}")
+        return True
+    return False
+
+
 async def handle_forced_response(message: Message) -> bool:
     forced_response = await get_message_text(message, "after_forced")
     if forced_response:
@@ -93,7 +119,7 @@ async def handle_forced_response(message: Message) -> bool:
     return False
 
 
-async def handle_response(message: Message, output: str) -> None:
+async def handle_response(message: Message, output: str, streaming_reply: Optional[StreamingReply] = None) -> None:
     async def send_reply(message: Message, text: str, parse_mode: str) -> Optional[Message]:
         try:
             return await message.reply(text, parse_mode=parse_mode)
@@ -103,7 +129,12 @@ async def handle_response(message: Message, output: str) -> None:
     process_markdown = await db.get_chat_parameter(message.chat.id, "process_markdown")
     parse_mode = ParseMode.MARKDOWN if process_markdown else ParseMode.HTML
 
-    our_message = await send_reply(message, output, parse_mode)
+    our_message = None
+    if streaming_reply:
+        our_message = await streaming_reply.finish(output, parse_mode)
+
+    if not our_message:
+        our_message = await send_reply(message, output, parse_mode)
 
     if not our_message and process_markdown:
         our_message = await send_reply(message, html.quote(output), ParseMode.HTML)
@@ -190,9 +221,20 @@ async def handle_new_message(message: Message) -> None:
     if not await should_generate_response(message):
         return
 
+    # Forced responses don't answer the conversation, so they neither replace other triggers nor get replaced
+    forced = bool(await get_message_text(message, "after_forced"))
+    if not forced and await wait_for_newer_triggers(message):
+        return
+
     semaphore = chat_semaphores[message.chat.id]
 
     async with semaphore:
+        # The window is over, but newer messages may still arrive while waiting for a previous response
+        if not forced and is_superseded(message):
+            return
+        if latest_triggers.get(message.chat.id) == message.message_id:
+            del latest_triggers[message.chat.id]
+
         if await check_token_limit(message):
             return
 
@@ -205,9 +247,41 @@ async def handle_new_message(message: Message) -> None:
                 f"время.</b>\n<i>Подробнее - в /status</i>")
             return
 
-        output = await api.generate_response(message, endpoint)
+        if await db.get_chat_parameter(message.chat.id, "priority"):
+            weight = PRIORITY_WEIGHT
+        elif message.chat.id == message.from_user.id:
+            weight = DM_WEIGHT
+        else:
+            weight = GROUP_WEIGHT
+
+        try:
+            ticket = generation_scheduler.enqueue(message.chat.id, weight)
+        except QueueFullException:
+            await message.reply("❌ <b>Бот сейчас перегружен запросами. Попробуйте снова через пару минут.</b>")
+            return
+
+        queue_message = None
+        if ticket.position:
+            try:
+                queue_message = await message.reply(f"⏳ <i>Запрос в очереди, позиция {ticket.position}</i>")
+            except Exception as e:
+                logger.debug(f"{message.chat.id} | Failed to send the queue position: {e}")
+
+        async with ticket:
+            if queue_message:
+                try:
+                    await queue_message.delete()
+                except TelegramBadRequest:
+                    pass
+
+            streaming_reply = None
+            if endpoint == "google" and await db.get_chat_parameter(message.chat.id, "g_stream"):
+                streaming_reply = StreamingReply(message)
+
+            output = await api.generate_response(message, endpoint,
+                                                 streaming_reply.update if streaming_reply else None)
 
-        await handle_response(message, output)
+            await handle_response(message, output, streaming_reply)
 
 
 async def handle_message_edit(message: Message) -> None:
@@ -4,6 +4,7 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message, ReactionTypeEmoji
 
 import db
+from api.google import context_cache, token_ledger
 from utils import log_command
 from .shared import is_allowed_to_alter_memory
 
@@ -22,6 +23,8 @@ async def forget_command(message: Message) -> None:
 
     successful = await db.attempt_delete_message(message.chat.id, message.reply_to_message.message_id)
     if successful:
+        context_cache.invalidate(message.chat.id)
+        token_ledger.invalidate(message.chat.id)
         if message.reply_to_message.from_user.id == bot_id:
             await message.reply_to_message.delete()
         try:
@@ -17,7 +17,7 @@ async def help_command(message: Message):
 
     help_text = """🤖 <b>Команды бота:</b>
 <b>/help</b> - Показать это сообщение
-<b>/status</b> - Проверить состояние бота
+<b>/status</b> - Проверить состояние бота. <i>С <code>/status exact</code> токены будут посчитаны точно</i>
 <b>/stats</b> - Посмотреть статистику чата
 <b>/feedback <i>[текст]</i></b> - Отправить разработчикам вопрос или пожелание
 
@@ -38,6 +38,8 @@ async def help_command(message: Message):
         help_text += """
 🔧 <b>Команды администраторов бота:</b>
 <b>/dropcaches</b> - Очистка всех кэшей
+<b>/reloadkeys [force]</b> - Перечитать список ключей Gemini API (force - даже если из него пропала большая часть ключей)
+<b>/keyusage</b> - Использование ключей Gemini API за сегодня и запас до лимитов
 <b>/blacklist <i>[id]</i></b> - Добавить чат/пользователя в чёрный список
 <b>/unblacklist <i>[id]</i></b> - Удалить чат/пользователя из чёрного списка
 <b>/stats</b> - Показать статистику бота
@@ -4,6 +4,7 @@ import traceback
 from aiogram.types import Message, ReactionTypeEmoji
 
 import db
+from api.google import context_cache, token_ledger
 from handlers.commands.shared import is_allowed_to_alter_memory
 from utils import log_command
 
@@ -28,6 +29,8 @@ async def replace_command(message: Message) -> None:
     result = await db.replace_message(message.chat.id, target, new_text)
 
     if result:
+        context_cache.invalidate(message.chat.id)
+        token_ledger.invalidate(message.chat.id)
         await message.react([ReactionTypeEmoji(emoji="👌")])
         if message.reply_to_message.from_user.id == bot_id:
             try:
@@ -1,6 +1,7 @@
 from aiogram.types import Message, ReactionTypeEmoji
 
 import db
+from api.google import context_cache, token_ledger
 from utils import log_command
 from .shared import is_allowed_to_alter_memory
 
@@ -12,4 +13,6 @@ async def reset_command(message: Message):
         return
 
     await db.mark_all_messages_as_deleted(message.chat.id)
+    context_cache.invalidate(message.chat.id)
+    token_ledger.invalidate(message.chat.id)
     await message.react([ReactionTypeEmoji(emoji="👌")])
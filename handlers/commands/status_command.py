@@ -48,8 +48,18 @@ async def status_command(message: Message):
     request_count = await db.get_request_count(message.chat.id, datetime.timedelta(hours=1))
     uptime = datetime.datetime.now() - start_time
 
-    token_count_text = "⏱ Секунду..." if endpoint == "google" else str(
-        await api.openai.count_tokens(message.chat.id)) + " токенов"
+    exact_recount = False
+    if endpoint == "google":
+        token_count, is_exact = api.google.get_token_count(message.chat.id, messages)
+        token_count_text = f"{'' if is_exact else '≈'}{token_count} токенов"
+
+        command_parts = message.text.strip().split()
+        if len(command_parts) > 1 and command_parts[1] == "exact" and not is_exact:
+            exact_recount = api.google.can_recount(message.chat.id)
+            if exact_recount:
+                token_count_text = "⏱ Секунду..."
+    else:
+        token_count_text = str(await api.openai.count_tokens(message.chat.id)) + " токенов"
     quota_text = "не ограничен" if rate_limit == 0 else f"{request_count}/{rate_limit}"
     if request_count >= rate_limit * 0.8 > 0:
         quota_text = quota_text + " ⚠️"
@@ -68,7 +78,7 @@ async def status_command(message: Message):
 
     reply = await message.reply(text_to_send)
 
-    if endpoint == "google":
+    if exact_recount:
         token_count_text = await api.google.count_tokens_for_chat(message)
         text_to_send = text_to_send.replace("⏱ Секунду...", f"{token_count_text} токенов")
         await reply.edit_text(text_to_send)
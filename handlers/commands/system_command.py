@@ -1,6 +1,7 @@
 from aiogram.types import Message, ReactionTypeEmoji
 
 import db
+from api.google import context_cache
 from handlers.commands.shared import is_allowed_to_alter_memory
 from utils import get_message_text, log_command
 
@@ -19,4 +20,5 @@ async def system_command(message: Message) -> None:
         return
 
     await db.save_system_message(message.chat.id, text)
+    context_cache.invalidate(message.chat.id)
     await message.react([ReactionTypeEmoji(emoji="👌")])
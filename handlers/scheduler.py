@@ -0,0 +1,160 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from loguru import logger
+
+MAX_IN_FLIGHT = int(os.getenv("GENERATION_MAX_IN_FLIGHT", 16))
+MAX_QUEUE = int(os.getenv("GENERATION_MAX_QUEUE", 200))
+
+# How many requests a chat may start per round-robin turn
+GROUP_WEIGHT = 1
+DM_WEIGHT = 2
+PRIORITY_WEIGHT = 4
+
+WAIT_TIME_WINDOW = 200
+
+
+class QueueFullException(Exception):
+    pass
+
+
+class Ticket:
+    """A place in the generation queue. Use as an async context manager around the generation."""
+
+    def __init__(self, scheduler: "GenerationScheduler", chat_id: int, weight: int, position: int):
+        self.scheduler = scheduler
+        self.chat_id = chat_id
+        self.weight = weight
+        self.position = position  # Requests ahead of this one when it was queued, 0 if it started right away
+        self.enqueued_at = time.monotonic()
+        self.granted = asyncio.get_running_loop().create_future()
+
+    async def __aenter__(self) -> "Ticket":
+        try:
+            await self.granted
+        except asyncio.CancelledError:
+            self.scheduler._abandon(self)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.scheduler._release()
+
+
+class GenerationScheduler:
+    """
+    Bounds the number of generations running at once across all chats.
+    Requests above the bound wait in per-chat queues, which are served with deficit round-robin:
+    on its turn a chat may start as many requests as its weight allows, so a busy group
+    can't starve everyone else. When too many requests are waiting, new ones are refused.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+
+        self.in_flight = 0
+        self.queued = 0
+        self.queues: Dict[int, Deque[Ticket]] = {}
+        self.deficits: Dict[int, int] = {}
+        self.active_chats: Deque[int] = deque()  # Chats with queued requests, in round-robin order
+
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_times: Deque[float] = deque(maxlen=WAIT_TIME_WINDOW)
+
+    def enqueue(self, chat_id: int, weight: int = GROUP_WEIGHT) -> Ticket:
+        if self.in_flight < self.max_in_flight and not self.queued:
+            ticket = Ticket(self, chat_id, weight, 0)
+            self._grant(ticket)
+            return ticket
+
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            logger.warning(f"{chat_id} | Generation queue is full ({self.queued} waiting), refusing the request")
+            raise QueueFullException()
+
+        ticket = Ticket(self, chat_id, weight, self.queued + 1)
+        if chat_id not in self.queues:
+            self.queues[chat_id] = deque()
+            self.deficits[chat_id] = 0
+            self.active_chats.append(chat_id)
+        self.queues[chat_id].append(ticket)
+        self.queued += 1
+        logger.info(f"{chat_id} | Generation queued at position {ticket.position}")
+        return ticket
+
+    def _grant(self, ticket: Ticket) -> None:
+        self.in_flight += 1
+        self.admitted += 1
+        self.wait_times.append(time.monotonic() - ticket.enqueued_at)
+        ticket.granted.set_result(None)
+
+    def _next_ticket(self) -> Optional[Ticket]:
+        if not self.active_chats:
+            return None
+
+        chat_id = self.active_chats[0]
+        queue = self.queues[chat_id]
+        if self.deficits[chat_id] < 1:
+            self.deficits[chat_id] += queue[0].weight
+
+        ticket = queue.popleft()
+        self.queued -= 1
+        self.deficits[chat_id] -= 1
+
+        if not queue:
+            self._forget_chat(chat_id)
+        elif self.deficits[chat_id] < 1:
+            self.active_chats.rotate(-1)
+        return ticket
+
+    def _forget_chat(self, chat_id: int) -> None:
+        del self.queues[chat_id]
+        del self.deficits[chat_id]
+        self.active_chats.remove(chat_id)
+
+    def _dispatch(self) -> None:
+        while self.in_flight < self.max_in_flight:
+            ticket = self._next_ticket()
+            if not ticket:
+                return
+            if ticket.granted.cancelled():
+                continue  # Its task is being cancelled and will clean up after itself
+            self._grant(ticket)
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _abandon(self, ticket: Ticket) -> None:
+        if ticket.granted.done() and not ticket.granted.cancelled():
+            # Cancelled right as it was let through, so give the slot to someone else
+            self._release()
+            return
+
+        queue = self.queues.get(ticket.chat_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self.queued -= 1
+            if not queue:
+                self._forget_chat(ticket.chat_id)
+
+    def get_stats(self) -> dict:
+        wait_times = sorted(self.wait_times)
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+            "p95_wait": wait_times[min(len(wait_times) - 1, int(len(wait_times) * 0.95))] if wait_times else 0.0,
+        }
+
+
+generation_scheduler = GenerationScheduler(MAX_IN_FLIGHT, MAX_QUEUE)
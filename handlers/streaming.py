@@ -0,0 +1,99 @@
+import asyncio
+import time
+from typing import Optional
+
+from aiogram import html
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+from loguru import logger
+
+# Telegram allows roughly one edit per second in DMs and noticeably less in groups
+DM_EDIT_INTERVAL = 1.5
+GROUP_EDIT_INTERVAL = 3.0
+MAX_MESSAGE_LENGTH = 4096
+CURSOR = " ▌"
+MAX_FINAL_EDIT_ATTEMPTS = 3
+
+
+class StreamingReply:
+    """
+    Shows a response while it is still being generated: the first partial text is sent
+    as a reply, and every next one is applied with throttled edits.
+    The partial text is sent without formatting, since half-generated markdown is often invalid.
+    """
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.sent_message: Optional[Message] = None
+        self.edit_interval = DM_EDIT_INTERVAL if message.chat.id == message.from_user.id else GROUP_EDIT_INTERVAL
+
+        self._latest_text = ""
+        self._shown_text = ""
+        self._next_edit_time = 0.0
+        self._edit_task: Optional[asyncio.Task] = None
+
+    async def update(self, text: str) -> None:
+        self._latest_text = text
+        if len(text) + len(CURSOR) > MAX_MESSAGE_LENGTH:
+            return  # Doesn't fit in one message anyway, the final flush will split it
+        if self._edit_task and not self._edit_task.done():
+            return
+        if time.monotonic() < self._next_edit_time:
+            return
+
+        if self._edit_task and not self._edit_task.cancelled() and self._edit_task.exception():
+            logger.debug(f"{self.message.chat.id} | A partial edit failed: {self._edit_task.exception()}")
+        self._edit_task = asyncio.create_task(self._show(text + CURSOR))
+
+    async def _show(self, text: str) -> None:
+        self._next_edit_time = time.monotonic() + self.edit_interval
+        try:
+            if self.sent_message is None:
+                self.sent_message = await self.message.reply(text, parse_mode=None)
+            elif text != self._shown_text:
+                await self.sent_message.edit_text(text, parse_mode=None)
+            self._shown_text = text
+        except TelegramRetryAfter as e:
+            logger.warning(f"{self.message.chat.id} | Streaming edits are rate-limited for {e.retry_after}s")
+            self._next_edit_time = time.monotonic() + e.retry_after
+        except TelegramBadRequest as e:
+            logger.debug(f"{self.message.chat.id} | Failed to show a partial response: {e}")
+
+    async def _try_edit(self, text: str, parse_mode: str) -> bool:
+        for _ in range(MAX_FINAL_EDIT_ATTEMPTS):
+            try:
+                await self.sent_message.edit_text(text, parse_mode=parse_mode)
+                return True
+            except TelegramRetryAfter as e:
+                logger.warning(f"{self.message.chat.id} | The final edit is rate-limited for {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                return "message is not modified" in str(e)
+        return False
+
+    async def finish(self, output: str, parse_mode: str) -> Optional[Message]:
+        """
+        Replaces the partial text with the final formatted output.
+        Returns None if there is no message to edit or the output could not be placed in it,
+        in which case the partial message is removed and the caller should send the output normally.
+        """
+        if self._edit_task:
+            # A failed partial edit doesn't matter anymore, the final text replaces it either way
+            try:
+                await self._edit_task
+            except Exception as e:
+                logger.warning(f"{self.message.chat.id} | The last partial edit failed: {e}")
+        if self.sent_message is None:
+            return None
+
+        if await self._try_edit(output, parse_mode):
+            return self.sent_message
+        if parse_mode == ParseMode.MARKDOWN and await self._try_edit(html.quote(output), ParseMode.HTML):
+            return self.sent_message
+
+        try:
+            await self.sent_message.delete()
+        except TelegramBadRequest:
+            pass
+        return None
@@ -50,6 +50,7 @@ async def main() -> None:
         await db.create_chat_config_table(conn)
         await db.create_blacklist_table(conn)
         await db.create_statistics_table(conn)
+        await db.create_file_uploads_table(conn)
 
         # Migrate if necessary
         await db.migrate_statistics_table(conn)
@@ -57,6 +58,7 @@ async def main() -> None:
 
         await db.drop_orphan_columns(conn)
 
+    await db.delete_expired_uploads()
     logger.info("DB init complete")
 
     logger.info("Initializing handlers...")
@@ -69,7 +71,8 @@ async def main() -> None:
                           start_command, status_command, directsend_command, sql_command, restart_command,
                           forget_command, replace_command, help_command, system_command, feedback_command,
                           stats_command, handle_message_edit, blacklist_command,
-                          unblacklist_command, preset_command, hide_command, dropcaches_command)
+                          unblacklist_command, preset_command, hide_command, dropcaches_command,
+                          reloadkeys_command, keyusage_command)
 
     dp.message.register(directsend_command, Command("directsend"), adminMessageFilter)
     dp.message.register(sql_command, Command("sql"), adminMessageFilter)
@@ -79,6 +82,8 @@ async def main() -> None:
     dp.message.register(prune_command, Command("prune"), adminMessageFilter)
     dp.message.register(stats_command, Command("stats"), adminMessageFilter)
     dp.message.register(dropcaches_command, Command("dropcaches"), adminMessageFilter)
+    dp.message.register(reloadkeys_command, Command("reloadkeys"), adminMessageFilter)
+    dp.message.register(keyusage_command, Command("keyusage"), adminMessageFilter)
 
     dp.message.register(status_command, Command("status"))
 
@@ -109,6 +114,18 @@ async def main() -> None:
     async def on_edited_message(message: Message) -> None:
         await handle_message_edit(message)
 
+    from api.google.sessions import session_manager
+    from api.google.google import key_manager, key_prober
+    dp.shutdown.register(session_manager.close)
+    dp.shutdown.register(key_manager.save_state)
+    dp.shutdown.register(key_manager.state_backend.close)
+    dp.shutdown.register(key_manager.usage_ledger.flush)
+    await key_manager.state_backend.start(key_manager)
+    # Referenced so that they aren't garbage collected
+    keys_watcher = asyncio.create_task(key_manager.watch_keys_file())
+    keys_prober = asyncio.create_task(key_prober.run())
+    usage_flusher = asyncio.create_task(key_manager.usage_ledger.run())
+
     logger.info("Starting to receive messages...")
     await dp.start_polling(bot)
 
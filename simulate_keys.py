@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import csv
+import importlib
+import os
+import random
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+
+from loguru import logger
+
+from benchmark_keys import load_keys_module
+
+os.environ.setdefault("MAX_KEY_ROTATION_ATTEMPTS", "15")
+os.environ.setdefault("FEEDBACK_TARGET_ID", "0")  # No admin notifications
+
+keys_module = load_keys_module()
+quotas = importlib.import_module("api.google.quotas")
+retry = importlib.import_module("api.google.retry")
+
+DEFAULT_MODEL = "gemini-1.5-flash"
+LATENCY = 2.0  # in seconds, simulated response time of every successful request
+
+EXPORT_HINT = (
+    "\\copy (SELECT timestamp, model, tokens_consumed FROM statistics_generations ORDER BY timestamp) "
+    "TO 'generations.csv' CSV HEADER"
+)
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SimulatedQuota:
+    """What the API actually enforces: per-minute buckets, and a daily count that resets at Pacific midnight"""
+
+    def __init__(self, limits, clock):
+        self.rpm, self.tpm, self.rpd = limits
+        self.clock = clock
+        self.minute_requests = quotas.TokenBucket(self.rpm, 60, clock)
+        self.minute_tokens = quotas.TokenBucket(self.tpm, 60, clock)
+        self.day = None
+        self.day_requests = 0
+
+    def _current_day(self):
+        return datetime.fromtimestamp(self.clock(), retry.PACIFIC_TIME).date()
+
+    def check(self, tokens):
+        """Returns the violated quota kind, or None if the request fits"""
+        if self._current_day() != self.day:
+            self.day, self.day_requests = self._current_day(), 0
+        if self.day_requests >= self.rpd:
+            return "PerDay"
+        if self.minute_requests.available() < 1 or self.minute_tokens.available() < min(tokens, self.tpm):
+            return "PerMinute"
+        return None
+
+    def consume(self, tokens):
+        self.day_requests += 1
+        self.minute_requests.consume(1)
+        self.minute_tokens.consume(tokens)
+
+
+def load_csv(path):
+    with open(path, newline="") as f:
+        return [
+            (datetime.fromisoformat(row["timestamp"]).timestamp(), row.get("model") or DEFAULT_MODEL,
+             int(float(row.get("tokens_consumed") or 0)))
+            for row in csv.DictReader(f)
+        ]
+
+
+async def load_database(days):
+    import asyncpg
+    from dotenv import load_dotenv
+
+    if os.path.exists(".env"):
+        load_dotenv()
+    conn = await asyncpg.connect(
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST"),
+        database=os.getenv("POSTGRES_USER"),
+    )
+    try:
+        rows = await conn.fetch(
+            "SELECT timestamp, model, tokens_consumed FROM statistics_generations "
+            "WHERE timestamp > $1 ORDER BY timestamp",
+            datetime.now() - timedelta(days=days)
+        )
+    finally:
+        await conn.close()
+    return [(row["timestamp"].timestamp(), row["model"] or DEFAULT_MODEL, row["tokens_consumed"] or 0)
+            for row in rows]
+
+
+async def simulate(requests, key_count, keys_per_project, key_limits, project_limits, max_rotations, seed):
+    random.seed(seed)
+    clock = SimulatedClock()
+    clock.now = requests[0][0] if requests else 0.0
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as keys_file:
+        for index in range(key_count):
+            keys_file.write(f"AIzaSy{index:033d} project=simulated-{index // keys_per_project}\n")
+    try:
+        manager = keys_module.ApiKeyManager(keys_file.name, clock=clock)
+    finally:
+        os.remove(keys_file.name)
+
+    truth = {}  # (key or project, model family): SimulatedQuota
+
+    def get_quotas(key, model):
+        result = []
+        for owner, limits in [(key, key_limits), (manager.get_key_group(key), project_limits)]:
+            family = quotas.get_model_family(model, limits)
+            if family is None:
+                continue
+            if (owner, family) not in truth:
+                truth[(owner, family)] = SimulatedQuota(limits[family], clock)
+            result.append(truth[(owner, family)])
+        return result
+
+    outcomes = Counter()
+    rotations = 0
+    for timestamp, model, tokens in requests:
+        clock.now = max(clock.now, timestamp)
+        for _ in range(max_rotations):
+            try:
+                key = await manager.get_api_key(model=model)
+            except keys_module.OutOfKeysException:
+                outcomes["no_keys"] += 1
+                break
+
+            key_quotas = get_quotas(key, model)
+            violations = [violation for violation in (quota.check(tokens) for quota in key_quotas) if violation]
+            if not violations:
+                for quota in key_quotas:
+                    quota.consume(tokens)
+                manager.record_usage(key, model, tokens)
+                manager.record_result(key, LATENCY, None, model)
+                outcomes["succeeded"] += 1
+                break
+
+            # What the bot does with a 429, see get_exhaustion_cooldown in api/google/retry.py
+            rotations += 1
+            manager.record_result(key, LATENCY, "RESOURCE_EXHAUSTED", model)
+            if "PerDay" in violations:
+                now = datetime.fromtimestamp(clock.now, retry.PACIFIC_TIME)
+                next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(),
+                                                 tzinfo=retry.PACIFIC_TIME)
+                cooldown = (next_midnight - now).total_seconds()
+            else:
+                cooldown = 60.0
+            manager.timeout_key(key, False, model, cooldown)
+        else:
+            outcomes["out_of_rotations"] += 1
+
+    total = len(requests)
+    return {
+        "keys": key_count,
+        "requests": total,
+        "succeeded": outcomes["succeeded"],
+        "no_keys": outcomes["no_keys"],
+        "out_of_rotations": outcomes["out_of_rotations"],
+        "rotations": rotations,
+        "success_rate": outcomes["succeeded"] / total if total else 1.0,
+    }
+
+
+def print_result(result):
+    print(
+        f"{result['keys']:>6} keys: {result['success_rate'] * 100:6.2f}% succeeded, "
+        f"{result['no_keys']:,} failed with no key left, {result['out_of_rotations']:,} ran out of rotations, "
+        f"{result['rotations']:,} rotations ({result['rotations'] / max(result['requests'], 1):.2f} per request)"
+    )
+
+
+async def find_key_count(requests, target, max_keys, **settings):
+    """The smallest key count reaching the target success rate, assuming more keys never hurt"""
+    key_count, result = 1, None
+    while True:
+        result = await simulate(requests, key_count, **settings)
+        print_result(result)
+        if result["success_rate"] >= target or key_count >= max_keys:
+            break
+        key_count = min(key_count * 2, max_keys)
+    if result["success_rate"] < target:
+        return None
+
+    low, high = key_count // 2 + 1, key_count
+    while low < high:
+        middle = (low + high) // 2
+        middle_result = await simulate(requests, middle, **settings)
+        print_result(middle_result)
+        if middle_result["success_rate"] >= target:
+            high = middle
+        else:
+            low = middle + 1
+    return high
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Replays past generations against a simulated key pool, offline, to size the pool.",
+        epilog=f"A CSV can be exported with: {EXPORT_HINT}"
+    )
+    parser.add_argument("csv", nargs="?", help="generations with timestamp, model and tokens_consumed columns")
+    parser.add_argument("--from-db", type=int, metavar="DAYS",
+                        help="read the last DAYS of statistics_generations from the database instead")
+    parser.add_argument("--keys", type=int, help="simulate this many keys, instead of searching for the count")
+    parser.add_argument("--target", type=float, default=0.99, help="success rate to size the pool for")
+    parser.add_argument("--max-keys", type=int, default=10_000)
+    parser.add_argument("--keys-per-project", type=int, default=1)
+    parser.add_argument("--key-limits", help="limits enforced per key, as family=RPM/TPM/RPD "
+                                             "(default: the configured GEMINI_KEY_LIMITS)")
+    parser.add_argument("--project-limits", help="limits enforced per project (default: same as per key)")
+    parser.add_argument("--max-rotations", type=int, default=int(os.environ["MAX_KEY_ROTATION_ATTEMPTS"]))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.from_db:
+        requests = await load_database(args.from_db)
+    elif args.csv:
+        requests = load_csv(args.csv)
+    else:
+        parser.error("either a CSV file or --from-db is required")
+    if not requests:
+        print("No generations to replay.")
+        return
+
+    key_limits = quotas.parse_limits(args.key_limits) if args.key_limits else quotas.KEY_LIMITS
+    settings = {
+        "keys_per_project": args.keys_per_project,
+        "key_limits": key_limits,
+        "project_limits": quotas.parse_limits(args.project_limits) if args.project_limits else key_limits,
+        "max_rotations": args.max_rotations,
+        "seed": args.seed,
+    }
+
+    requests.sort()
+    hours = (requests[-1][0] - requests[0][0]) / 3600
+    models = Counter(model for _, model, _ in requests)
+    print(f"{len(requests):,} generations over {hours:.1f} hours: "
+          + ", ".join(f"{model} ({count:,})" for model, count in models.most_common()) + "\n")
+
+    if args.keys:
+        print_result(await simulate(requests, args.keys, **settings))
+        return
+
+    key_count = await find_key_count(requests, args.target, args.max_keys, **settings)
+    if key_count is None:
+        print(f"\n{args.max_keys} keys aren't enough for {args.target * 100:g}% of requests to succeed.")
+    else:
+        print(f"\n{key_count} keys are needed for {args.target * 100:g}% of requests to succeed.")
+
+
+if __name__ == "__main__":
+    logger.remove()  # Every rotation is logged, which would drown the results
+    asyncio.run(main())
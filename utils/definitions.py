@@ -105,6 +105,16 @@ chat_configs = {
             "advanced": True,
             "private": False
         },
+        "coalesce_window": {
+            "description": "Сколько секунд ждать следующих обращений к боту перед ответом. Если за это время придёт "
+                           "ещё одно, бот ответит один раз, на последнее. <code>0</code> - отвечать сразу",
+            "type": "decimal",
+            "default_value": 0.0,
+            "accepted_values": frange(0, 10, 0.1),
+            "protected": False,
+            "advanced": True,
+            "private": False
+        },
         "add_system_prompt": {
             "description": "Добавлять ли встроенное системное сообщение, нацеленное на улучшение качества ответов",
             "type": "boolean",
@@ -132,6 +142,16 @@ chat_configs = {
             "protected": True,
             "advanced": False,
             "private": False
+        },
+        "priority": {
+            "description": "Обслуживаются ли запросы чата в первую очередь, когда бот перегружен. Устанавливается "
+                           "администраторами бота",
+            "type": "boolean",
+            "default_value": False,
+            "accepted_values": [True, False],
+            "protected": True,
+            "advanced": True,
+            "private": False
         }
     },
     "google": {
@@ -234,6 +254,37 @@ chat_configs = {
             "advanced": True,
             "private": False
         },
+        "g_stream": {
+            "description": "Показывать ли ответ по мере его генерации. Первые слова появляются почти сразу, "
+                           "а сообщение дописывается, пока модель не закончит",
+            "type": "boolean",
+            "default_value": False,
+            "accepted_values": [True, False],
+            "protected": False,
+            "advanced": False,
+            "private": False
+        },
+        "g_context_cache": {
+            "description": "Кэшировать ли неизменную часть истории чата на стороне Gemini API. Ускоряет и удешевляет "
+                           "запросы в чатах с длинной памятью. Работает не со всеми моделями и не вместе с "
+                           "выполнением кода или веб-поиском",
+            "type": "boolean",
+            "default_value": False,
+            "accepted_values": [True, False],
+            "protected": False,
+            "advanced": True,
+            "private": False
+        },
+        "g_media_preload": {
+            "description": "Заранее скачивать и загружать в Gemini файлы из сообщений чата, чтобы вопросы о них "
+                           "обрабатывались быстрее. Загружает и те файлы, о которых так и не спросят",
+            "type": "boolean",
+            "default_value": False,
+            "accepted_values": [True, False],
+            "protected": False,
+            "advanced": True,
+            "private": False
+        },
         "g_show_thinking": {
             "description": "Для thinking-моделей, включать ли в сообщение их поток мыслей. Не рекомендуется при обычном использовании.",
             "type": "boolean",